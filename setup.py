@@ -68,6 +68,8 @@ setup(name='encrypted_bigquery',
           'encrypted_bigquery_client_test',
           'load_lib',
           'load_lib_test',
+          'metadata_cache',
+          'metadata_cache_test',
           'number',
           'number_test',
           'paillier',
@@ -81,6 +83,8 @@ setup(name='encrypted_bigquery',
           'show_lib',
           'show_lib_test',
           'test_util',
+          'unicode_punctuation',
+          'unicode_punctuation_test',
           'run_all_tests',
           ],
       entry_points={
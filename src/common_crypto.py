@@ -5,6 +5,7 @@
 
   AesCbc: class for encrypting and decrypting in cbc mode with pkcs padding.
   GetRandBytes: function that returns random bytes.
+  KeyedPRF: class for evaluating a pseudorandom function with a fixed key.
   PRF: a pseudorandom function.
 """
 
@@ -15,41 +16,76 @@ import hmac
 import os
 import platform
 import sys
+import threading
 
 from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
 
 
 DEFAULT_PRF_OUTPUT_LEN = 16
-_f_urandom_fh = None
-_f_urandom_func = None
-_F_URANDOM_BUFLEN = 8192
+# Number of random bytes prefetched at a time by GetRandBytes.
+_RAND_POOL_BLOCK_LEN = 65536
 
 
-def GetRandBytes(size, _open=open):  # pylint: disable=invalid-name
-  """Returns size number of bytes."""
-  global _f_urandom_fh
-  global _f_urandom_func
+class _RandomBytePool(object):
+  """Serves random bytes from blocks prefetched from the system source.
 
-  if size <= 0:
-    raise ValueError('Size has to be positive.')
+  The pool is shared by threads under a lock. A forked process inherits the
+  pool with its prefetched bytes, which the parent and every other child would
+  hand out too; so the pool records the pid that filled it, and a process that
+  finds another pid discards the inherited bytes and reopens the source.
+  """
 
-  if _f_urandom_func is not None:
-    return _f_urandom_func(size)
+  def __init__(self, block_len=_RAND_POOL_BLOCK_LEN):
+    self._block_len = block_len
+    self._lock = threading.Lock()
+    self._pid = None
+    self._read = None
+    self._buffer = ''
+    self._offset = 0
+
+  def _Reseed(self, _open):  # pylint: disable=invalid-name
+    if platform.uname()[0] == 'Linux':
+      # unbuffered, so prefetched bytes are only ever held by the pool.
+      self._read = _open('/dev/urandom', 'rb', 0).read  # same args and return
+    else:
+      self._read = os.urandom
+    self._pid = os.getpid()
+    self._buffer = ''
+    self._offset = 0
+
+  def GetBytes(self, size, _open=open):  # pylint: disable=invalid-name
+    """Returns size random bytes, see GetRandBytes."""
+    with self._lock:
+      if self._pid != os.getpid():
+        self._Reseed(_open)
+      if size > self._block_len:
+        return self._read(size)
+      if len(self._buffer) - self._offset < size:
+        self._buffer = (self._buffer[self._offset:] +
+                        self._read(self._block_len))
+        self._offset = 0
+      data = self._buffer[self._offset:self._offset + size]
+      self._offset += size
+      return data
+
+
+_rand_pool = _RandomBytePool()
 
-  if platform.uname()[0] == 'Linux':
-    _f_urandom_fh = _open('/dev/urandom', 'rb', _F_URANDOM_BUFLEN)
-    _f_urandom_func = _f_urandom_fh.read  # same args and return
-  else:
-    _f_urandom_func = os.urandom
 
-  return GetRandBytes(size)
+def GetRandBytes(size, _open=open):  # pylint: disable=invalid-name
+  """Returns size number of bytes."""
+  if size <= 0:
+    raise ValueError('Size has to be positive.')
+  return _rand_pool.GetBytes(size, _open)
 
 
 def PRF(key, input_str, output_len=DEFAULT_PRF_OUTPUT_LEN, hashfunc='sha1'):
   """Creates pseudorandom output based on key and specified input.
 
   The hmac is used to create a prf that accepts input of varying size and
-  outputs pseudorandom str of varying size.
+  outputs pseudorandom str of varying size. Callers that evaluate the prf many
+  times with the same key should use KeyedPRF instead.
 
   Args:
     key: used to create pseudorandom output.
@@ -68,30 +104,98 @@ def PRF(key, input_str, output_len=DEFAULT_PRF_OUTPUT_LEN, hashfunc='sha1'):
   Raises:
     ValueError: When key or output_len is empty, or input_str is not str.
   """
-  if len(key) < 1:
-    raise ValueError('Key to PRF has to be a byte or larger.')
-  if output_len < 1:
-    raise ValueError('Prf output length has to be a byte or larger.')
-  if not isinstance(input_str, str):
-    raise ValueError('Expected str type for input_str, but got: %s'
-                     % type(input_str))
-  try:
-    hasher = hashlib.new(hashfunc)
-  except ValueError:
-    raise  # something like "unsupported hash type {hashfunc}"
-  hasher = getattr(hashlib, hashfunc)
-  count = 0
-  output = []
-  for _ in xrange(output_len / 16):
-    output.append(hmac.new(key, IntToFixedSizeString(count) + input_str,
-                           hasher).digest()[:16])
-    count += 1
-  # if output_len is not a multiple of 16 then add the last partial block.
-  if output_len % 16 != 0:
-    output.append(hmac.new(
-        key, IntToFixedSizeString(count) + input_str,
-        hasher).digest()[:output_len % 16])
-  return ''.join(output)
+  return KeyedPRF(key, hashfunc)(input_str, output_len)
+
+
+class KeyedPRF(object):
+  """PRF with a fixed key and hash function.
+
+  The hmac state with the padded key absorbed is computed once, as is the state
+  that has additionally absorbed each output block counter, so evaluating the
+  prf only hashes the input on copies of these states.
+  """
+
+  def __init__(self, key, hashfunc='sha1'):
+    """Initializes the prf; see PRF for the arguments.
+
+    Raises:
+      ValueError: When key is empty or hashfunc is not supported.
+    """
+    if len(key) < 1:
+      raise ValueError('Key to PRF has to be a byte or larger.')
+    hashlib.new(hashfunc)  # raises ValueError, "unsupported hash type ...".
+    self._hmac = hmac.new(key, digestmod=getattr(hashlib, hashfunc))
+    # Output block counter to the hmac state that has absorbed it.
+    self._block_hmacs = {}
+
+  def _GetBlockHmac(self, count):
+    """Returns a copy of the hmac state with the key and count absorbed."""
+    block_hmac = self._block_hmacs.get(count)
+    if block_hmac is None:
+      block_hmac = self._hmac.copy()
+      block_hmac.update(IntToFixedSizeString(count))
+      self._block_hmacs[count] = block_hmac
+    return block_hmac.copy()
+
+  def __call__(self, input_str, output_len=DEFAULT_PRF_OUTPUT_LEN):
+    """Returns PRF(key, input_str, output_len, hashfunc).
+
+    Raises:
+      ValueError: When output_len is empty, or input_str is not str.
+    """
+    if output_len < 1:
+      raise ValueError('Prf output length has to be a byte or larger.')
+    if not isinstance(input_str, str):
+      raise ValueError('Expected str type for input_str, but got: %s'
+                       % type(input_str))
+    output = []
+    # 16 byte blocks, the last one is truncated if output_len is not a
+    # multiple of 16.
+    for count in xrange(-(-output_len // 16)):
+      block_hmac = self._GetBlockHmac(count)
+      block_hmac.update(input_str)
+      output.append(block_hmac.digest()[:16])
+    return ''.join(output)[:output_len]
+
+  def NewStream(self, output_len=DEFAULT_PRF_OUTPUT_LEN):
+    """Returns a PRFStream that evaluates the prf on an input built up in parts.
+
+    Raises:
+      ValueError: When output_len is empty.
+    """
+    if output_len < 1:
+      raise ValueError('Prf output length has to be a byte or larger.')
+    return PRFStream([self._GetBlockHmac(count)
+                      for count in xrange(-(-output_len // 16))], output_len)
+
+
+class PRFStream(object):
+  """Incremental evaluation of a KeyedPRF.
+
+  Digest returns the prf of the concatenation of all inputs given to Update so
+  far, and Copy allows sharing the work on a common prefix of several inputs.
+  """
+
+  def __init__(self, block_hmacs, output_len):
+    self._block_hmacs = block_hmacs
+    self._output_len = output_len
+
+  def Update(self, input_str):
+    """Appends input_str, a str, to the input."""
+    for block_hmac in self._block_hmacs:
+      block_hmac.update(input_str)
+
+  def Copy(self):
+    """Returns an independent PRFStream of the same input."""
+    return PRFStream([block_hmac.copy() for block_hmac in self._block_hmacs],
+                     self._output_len)
+
+  def Digest(self):
+    """Returns the prf of the input so far, this does not end the stream."""
+    if len(self._block_hmacs) == 1:
+      return self._block_hmacs[0].digest()[:self._output_len]
+    return ''.join([block_hmac.digest()[:16]
+                    for block_hmac in self._block_hmacs])[:self._output_len]
 
 
 def IntToFixedSizeString(value):
@@ -103,7 +207,14 @@ def IntToFixedSizeString(value):
 
 
 class PRG(object):
-  """Deterministically creates a psuedorandom stream based on a seed."""
+  """Deterministically creates a psuedorandom stream based on a seed.
+
+  The stream is the concatenation of PRF(seed, '0'), PRF(seed, '1'), ...; it is
+  generated in bulk and reads are served from a buffer.
+  """
+
+  # Number of PRF blocks generated at a time.
+  _BLOCKS_PER_REFILL = 16
 
   def __init__(self, seed):
     """PRG is initialized with a seed str containing at least 16 bytes."""
@@ -111,20 +222,29 @@ class PRG(object):
       raise ValueError('Expected str type for seed, but got: %s' % type(seed))
     if len(seed) < 16:
       raise ValueError('Size of seed has to be at least 16 characters.')
-    self.__seed = seed
-    self.__count = 0
+    self.__prf = KeyedPRF(seed)
+    self.__next_block = 0
+    self.__buffer = ''
+    self.__offset = 0
+
+  def __Refill(self, n):
+    """Extends the buffer so that it holds at least n unread bytes."""
+    unread = self.__buffer[self.__offset:]
+    num_blocks = max(self._BLOCKS_PER_REFILL,
+                     -(-(n - len(unread)) // DEFAULT_PRF_OUTPUT_LEN))
+    blocks = [unread]
+    for k in xrange(self.__next_block, self.__next_block + num_blocks):
+      blocks.append(self.__prf(str(k)))
+    self.__next_block += num_blocks
+    self.__buffer = ''.join(blocks)
+    self.__offset = 0
 
   def GetNextBytes(self, n):
     """Returns next n bytes in pseudorandom stream created from seed."""
-    first_block = self.__count / DEFAULT_PRF_OUTPUT_LEN
-    last_block = (self.__count + n) / DEFAULT_PRF_OUTPUT_LEN
-    buf = ''.join(PRF(self.__seed, str(k))
-                  for k in xrange(first_block, last_block + 1))
-    # Now adjust the prefix and suffix to get to the byte level.
-    val = buf[self.__count % DEFAULT_PRF_OUTPUT_LEN :
-              -(DEFAULT_PRF_OUTPUT_LEN - ((self.__count + n) %
-                                          DEFAULT_PRF_OUTPUT_LEN))]
-    self.__count += n
+    if len(self.__buffer) - self.__offset < n:
+      self.__Refill(n)
+    val = self.__buffer[self.__offset:self.__offset + n]
+    self.__offset += n
     return val
 
 
@@ -149,6 +269,8 @@ class AesCbc(object):
     if len(key) not in AesCbc.VALID_AES_KEY_LENGTHS:
       raise ValueError('Incorrect sized AES key: %d' % len(key))
     self.__key = key
+    # Block cipher with the expanded key, used to run many cbc chains at once.
+    self.__ecb = AES.new(key, AES.MODE_ECB)
 
   def Encrypt(self, plaintext, iv=None):
     """Encrypts with AES/CBC/PKCS5PADDING mode.
@@ -170,32 +292,71 @@ class AesCbc(object):
       ValueError: When plaintext is empty or of wrong type, or iv is of wrong
       length.
     """
-    if not isinstance(plaintext, str):
-      raise ValueError('Expected str type for plaintext, but got: %s' %
-                       type(plaintext))
-    if not plaintext:
-      raise ValueError('input plaintext cannot be empty.')
-    if iv is not None and len(iv) is not AesCbc.AES_IV_LEN:
-      raise ValueError('Supplied iv size is incorrect: %d' % len(iv))
+    _CheckPlaintext(plaintext)
+    _CheckIv(iv)
 
     if iv is None:
       iv_for_encrypt = GetRandBytes(AesCbc.AES_IV_LEN)
     else:
       iv_for_encrypt = iv
-    # pkcs5 padding repeats the padded byte length value in each padded byte
-    # till block is full. If plaintext is multiple of a block then a full block
-    # of padding is added with the value 16 repeated in each byte.
-    pkcs5_padding_len = (
-        AesCbc.AES_BLOCK_LEN - (len(plaintext) % AesCbc.AES_BLOCK_LEN))
-    pkcs5_padding = pkcs5_padding_len * chr(pkcs5_padding_len)
-
     cipher = AES.new(self.__key, AES.MODE_CBC, iv_for_encrypt)
-    ciphertext = cipher.encrypt(plaintext + pkcs5_padding)
+    ciphertext = cipher.encrypt(_Pkcs5Pad(plaintext))
     if iv is None:
       return iv_for_encrypt + ciphertext
     else:
       return ciphertext
 
+  def EncryptMany(self, plaintexts, iv=None):
+    """Encrypts a list of plaintexts, see Encrypt.
+
+    The cbc chains of all plaintexts are advanced together: the k-th blocks of
+    every plaintext are encrypted by one call of the block cipher, which reuses
+    the expanded key. Random ivs are read all at once.
+
+    Args:
+      plaintexts: list of data to be encrypted, none can be empty.
+      iv: iv to use for every plaintext, if not provided then a random iv is
+          selected for each one.
+
+    Returns:
+      list of ciphertext strs, as returned by Encrypt.
+
+    Raises:
+      ValueError: When a plaintext is empty or of wrong type, or iv is of wrong
+      length.
+    """
+    for plaintext in plaintexts:
+      _CheckPlaintext(plaintext)
+    _CheckIv(iv)
+    if not plaintexts:
+      return []
+
+    block_len = AesCbc.AES_BLOCK_LEN
+    if iv is None:
+      ivs = GetRandBytes(AesCbc.AES_IV_LEN * len(plaintexts))
+      chain = [ivs[i:i + AesCbc.AES_IV_LEN]
+               for i in xrange(0, len(ivs), AesCbc.AES_IV_LEN)]
+    else:
+      chain = [iv] * len(plaintexts)
+    padded = [_Pkcs5Pad(plaintext) for plaintext in plaintexts]
+    # indexes of the plaintexts that have a k-th block, longest first.
+    by_length = sorted(xrange(len(padded)), key=lambda i: -len(padded[i]))
+    outputs = [[] if iv is not None else [chain[i]]
+               for i in xrange(len(padded))]
+    active = len(by_length)
+    for offset in xrange(0, len(padded[by_length[0]]), block_len):
+      while len(padded[by_length[active - 1]]) <= offset:
+        active -= 1
+      indexes = by_length[:active]
+      blocks = strxor(
+          ''.join([padded[i][offset:offset + block_len] for i in indexes]),
+          ''.join([chain[i] for i in indexes]))
+      encrypted = self.__ecb.encrypt(blocks)
+      for k, i in enumerate(indexes):
+        chain[i] = encrypted[k * block_len:(k + 1) * block_len]
+        outputs[i].append(chain[i])
+    return [''.join(output) for output in outputs]
+
   def Decrypt(self, ciphertext, iv=None):
     """Decrypts with AES/CBC/PKCS5PADDING mode.
 
@@ -212,16 +373,8 @@ class AesCbc(object):
     Raises:
       ValueError: When iv and ciphertext is not of right type or length.
     """
-    if not isinstance(ciphertext, str):
-      raise ValueError('Expected str type for ciphertext, but got: %s' %
-                       type(ciphertext))
-    if not ciphertext:
-      raise ValueError('ciphertext input cannot be empty.')
-    if len(ciphertext) % AesCbc.AES_BLOCK_LEN != 0:
-      raise ValueError('ciphertext input must be a multiple of block length: %d'
-                       % len(ciphertext))
-    if iv is not None and len(iv) is not AesCbc.AES_IV_LEN:
-      raise ValueError('Supplied iv size is incorrect: %d' % len(iv))
+    _CheckCiphertext(ciphertext)
+    _CheckIv(iv)
 
     if iv is None:
       iv_for_decrypt = ciphertext[:AesCbc.AES_IV_LEN]
@@ -231,15 +384,96 @@ class AesCbc(object):
       ciphertext_for_decrypt = ciphertext
 
     cipher = AES.new(self.__key, AES.MODE_CBC, iv_for_decrypt)
-    plaintext_with_pad = cipher.decrypt(ciphertext_for_decrypt)
-
-    pkcs5_padding_len = ord(plaintext_with_pad[-1])
-    if pkcs5_padding_len > AesCbc.AES_BLOCK_LEN:
-      raise ValueError('Incorrect ciphertext padding in last block: %s'
-                       % plaintext_with_pad[-1 * AesCbc.AES_BLOCK_LEN:])
-
-    pkcs5_padding = pkcs5_padding_len * chr(pkcs5_padding_len)
-    if plaintext_with_pad[-1 * pkcs5_padding_len:] != pkcs5_padding:
-      raise ValueError('Incorrect ciphertext padding: %s'
-                       % plaintext_with_pad[-1 * pkcs5_padding_len:])
-    return plaintext_with_pad[:-pkcs5_padding_len]
+    return _Pkcs5Unpad(cipher.decrypt(ciphertext_for_decrypt))
+
+  def DecryptMany(self, ciphertexts, iv=None):
+    """Decrypts a list of ciphertexts, see Decrypt.
+
+    Cbc decryption does not chain, so all the blocks of all ciphertexts are
+    decrypted by one call of the block cipher, and xored with the blocks that
+    precede them in one more call.
+
+    Args:
+      ciphertexts: list of data to be decrypted, none can be empty.
+      iv: iv used for every ciphertext in cbc mode, if not provided then assume
+          each iv is prepended to its ciphertext.
+
+    Returns:
+      list of plaintext strs.
+
+    Raises:
+      ValueError: When iv or a ciphertext is not of right type or length.
+    """
+    for ciphertext in ciphertexts:
+      _CheckCiphertext(ciphertext)
+    _CheckIv(iv)
+    if not ciphertexts:
+      return []
+
+    if iv is None:
+      bodies = [ciphertext[AesCbc.AES_IV_LEN:] for ciphertext in ciphertexts]
+      chains = [ciphertext[:-AesCbc.AES_BLOCK_LEN]
+                for ciphertext in ciphertexts]
+    else:
+      bodies = ciphertexts
+      chains = [iv + ciphertext[:-AesCbc.AES_BLOCK_LEN]
+                for ciphertext in ciphertexts]
+    body = ''.join(bodies)
+    if not body:
+      raise ValueError('ciphertext input cannot be empty.')
+    plaintexts_with_pad = strxor(self.__ecb.decrypt(body), ''.join(chains))
+    plaintexts = []
+    offset = 0
+    for ciphertext_body in bodies:
+      end = offset + len(ciphertext_body)
+      plaintexts.append(_Pkcs5Unpad(plaintexts_with_pad[offset:end]))
+      offset = end
+    return plaintexts
+
+
+def _CheckPlaintext(plaintext):
+  if not isinstance(plaintext, str):
+    raise ValueError('Expected str type for plaintext, but got: %s' %
+                     type(plaintext))
+  if not plaintext:
+    raise ValueError('input plaintext cannot be empty.')
+
+
+def _CheckCiphertext(ciphertext):
+  if not isinstance(ciphertext, str):
+    raise ValueError('Expected str type for ciphertext, but got: %s' %
+                     type(ciphertext))
+  if not ciphertext:
+    raise ValueError('ciphertext input cannot be empty.')
+  if len(ciphertext) % AesCbc.AES_BLOCK_LEN != 0:
+    raise ValueError('ciphertext input must be a multiple of block length: %d'
+                     % len(ciphertext))
+
+
+def _CheckIv(iv):
+  if iv is not None and len(iv) is not AesCbc.AES_IV_LEN:
+    raise ValueError('Supplied iv size is incorrect: %d' % len(iv))
+
+
+def _Pkcs5Pad(plaintext):
+  # pkcs5 padding repeats the padded byte length value in each padded byte
+  # till block is full. If plaintext is multiple of a block then a full block
+  # of padding is added with the value 16 repeated in each byte.
+  pkcs5_padding_len = (
+      AesCbc.AES_BLOCK_LEN - (len(plaintext) % AesCbc.AES_BLOCK_LEN))
+  return plaintext + pkcs5_padding_len * chr(pkcs5_padding_len)
+
+
+def _Pkcs5Unpad(plaintext_with_pad):
+  if not plaintext_with_pad:
+    raise ValueError('ciphertext input cannot be empty.')
+  pkcs5_padding_len = ord(plaintext_with_pad[-1])
+  if pkcs5_padding_len > AesCbc.AES_BLOCK_LEN:
+    raise ValueError('Incorrect ciphertext padding in last block: %s'
+                     % plaintext_with_pad[-1 * AesCbc.AES_BLOCK_LEN:])
+
+  pkcs5_padding = pkcs5_padding_len * chr(pkcs5_padding_len)
+  if plaintext_with_pad[-1 * pkcs5_padding_len:] != pkcs5_padding:
+    raise ValueError('Incorrect ciphertext padding: %s'
+                     % plaintext_with_pad[-1 * pkcs5_padding_len:])
+  return plaintext_with_pad[:-pkcs5_padding_len]
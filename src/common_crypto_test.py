@@ -52,37 +52,58 @@ class CommonCryptoTest(googletest.TestCase):
     logging.debug('Running testGetRandBytesWhenPlatformLinux method.')
 
     fmock = self.mox.CreateMockAnything()
-    self.stubs.Set(ccrypto, '_f_urandom_func', None)
+    self.stubs.Set(ccrypto, '_rand_pool', ccrypto._RandomBytePool(32))
     self.mox.StubOutWithMock(ccrypto.platform, 'uname')
     self.mox.StubOutWithMock(ccrypto.os, 'urandom')
     ccrypto.platform.uname().AndReturn(['Linux', 'h', 'v', 'x', 'x86', 'x86'])
-    fmock('/dev/urandom', 'rb', ccrypto._F_URANDOM_BUFLEN).AndReturn(fmock)
-    fmock.read(16).AndReturn('a' * 16)
-    fmock.read(16).AndReturn('b' * 16)
+    fmock('/dev/urandom', 'rb', 0).AndReturn(fmock)
+    fmock.read(32).AndReturn('a' * 16 + 'b' * 16)
+    fmock.read(40).AndReturn('c' * 40)
 
     self.mox.ReplayAll()
-    b = ccrypto.GetRandBytes(16, _open=fmock)
-    self.assertEqual(len(b), 16)
-    b = ccrypto.GetRandBytes(16, _open=fmock)
-    self.assertEqual(len(b), 16)
+    self.assertEqual('a' * 16, ccrypto.GetRandBytes(16, _open=fmock))
+    self.assertEqual('b' * 16, ccrypto.GetRandBytes(16, _open=fmock))
+    # requests larger than a block bypass the pool.
+    self.assertEqual('c' * 40, ccrypto.GetRandBytes(40, _open=fmock))
     self.mox.VerifyAll()
 
   def testGetRandBytesWhenPlatformOther(self):
     logging.debug('Running testGetRandBytesWhenPlatformOther method.')
 
     fmock = self.mox.CreateMockAnything()
-    self.stubs.Set(ccrypto, '_f_urandom_func', None)
+    self.stubs.Set(ccrypto, '_rand_pool', ccrypto._RandomBytePool(32))
     self.mox.StubOutWithMock(ccrypto.platform, 'uname')
     self.mox.StubOutWithMock(ccrypto.os, 'urandom')
     ccrypto.platform.uname().AndReturn(['OFQv', 'h', 'v', 'x', 'x86', 'x86'])
-    ccrypto.os.urandom(16).AndReturn('a' * 16)
-    ccrypto.os.urandom(16).AndReturn('b' * 16)
+    ccrypto.os.urandom(32).AndReturn('a' * 32)
+    ccrypto.os.urandom(32).AndReturn('b' * 32)
 
     self.mox.ReplayAll()
-    b = ccrypto.GetRandBytes(16, _open=fmock)
-    self.assertEqual(len(b), 16)
-    b = ccrypto.GetRandBytes(16, _open=fmock)
-    self.assertEqual(len(b), 16)
+    self.assertEqual('a' * 24, ccrypto.GetRandBytes(24, _open=fmock))
+    # the remaining prefetched bytes are used first.
+    self.assertEqual('a' * 8 + 'b' * 8, ccrypto.GetRandBytes(16, _open=fmock))
+    self.mox.VerifyAll()
+
+  def testGetRandBytesAfterFork(self):
+    logging.debug('Running testGetRandBytesAfterFork method.')
+
+    self.stubs.Set(ccrypto, '_rand_pool', ccrypto._RandomBytePool(32))
+    self.mox.StubOutWithMock(ccrypto.platform, 'uname')
+    self.mox.StubOutWithMock(ccrypto.os, 'urandom')
+    self.mox.StubOutWithMock(ccrypto.os, 'getpid')
+    ccrypto.os.getpid().AndReturn(1)
+    ccrypto.platform.uname().AndReturn(['OFQv', 'h', 'v', 'x', 'x86', 'x86'])
+    ccrypto.os.getpid().AndReturn(1)
+    ccrypto.os.urandom(32).AndReturn('a' * 32)
+    # a forked child discards the bytes prefetched by its parent.
+    ccrypto.os.getpid().AndReturn(2)
+    ccrypto.platform.uname().AndReturn(['OFQv', 'h', 'v', 'x', 'x86', 'x86'])
+    ccrypto.os.getpid().AndReturn(2)
+    ccrypto.os.urandom(32).AndReturn('b' * 32)
+
+    self.mox.ReplayAll()
+    self.assertEqual('a' * 16, ccrypto.GetRandBytes(16))
+    self.assertEqual('b' * 16, ccrypto.GetRandBytes(16))
     self.mox.VerifyAll()
 
   def testPRFWhenUnsupportedHash(self):
@@ -112,6 +133,37 @@ class CommonCryptoTest(googletest.TestCase):
     self.assertEqual(16, len(output4))
     self.assertNotEqual(output1, output4)
 
+  def testKeyedPRF(self):
+    logging.debug('Running testKeyedPRF method.')
+    for hashfunc in ['sha1', 'sha256', 'md5']:
+      prf = ccrypto.KeyedPRF(_KEY1, hashfunc)
+      for output_len in [1, 8, 16, 17, 37, 64]:
+        for input_str in [_PLAINTEXT1, _PLAINTEXT2, '']:
+          self.assertEqual(
+              ccrypto.PRF(_KEY1, input_str, output_len, hashfunc),
+              prf(input_str, output_len))
+    self.assertEqual('\xa7\x15\xd9\xbbyO@\xad\xfc\x9f\x02\xcb\x9cD\xb7\x29',
+                     ccrypto.KeyedPRF(_KEY1, 'sha256')(_PLAINTEXT1))
+    self.assertRaises(ValueError, ccrypto.KeyedPRF, _KEY1, 'sha999')
+    self.assertRaises(ValueError, ccrypto.KeyedPRF, '')
+    self.assertRaises(ValueError, prf, _PLAINTEXT1, 0)
+    self.assertRaises(ValueError, prf, u'unicode')
+
+  def testPRFStream(self):
+    logging.debug('Running testPRFStream method.')
+    prf = ccrypto.KeyedPRF(_KEY1, 'sha256')
+    for output_len in [5, 16, 37]:
+      stream = prf.NewStream(output_len)
+      stream.Update(_PLAINTEXT1[:4])
+      copied = stream.Copy()
+      stream.Update(_PLAINTEXT1[4:])
+      self.assertEqual(ccrypto.PRF(_KEY1, _PLAINTEXT1, output_len, 'sha256'),
+                       stream.Digest())
+      self.assertEqual(prf(_PLAINTEXT1[:4], output_len), copied.Digest())
+      copied.Update(_PLAINTEXT1[4:])
+      self.assertEqual(stream.Digest(), copied.Digest())
+    self.assertRaises(ValueError, prf.NewStream, 0)
+
 
 class PRGTest(googletest.TestCase):
 
@@ -158,6 +210,15 @@ class PRGTest(googletest.TestCase):
     self.assertEqual(15, len(val4))
     self.assertEqual(expected[58:73], val4)
 
+  def testGetNextBytesMatchesPrfBlocks(self):
+    logging.debug('Running testGetNextBytesMatchesPrfBlocks method.')
+    stream = ''.join(ccrypto.PRF(_KEY1, str(k)) for k in xrange(100))
+    prg = ccrypto.PRG(_KEY1)
+    position = 0
+    for n in [0, 1, 15, 16, 17, 300, 64, 0, 500, 7]:
+      self.assertEqual(stream[position:position + n], prg.GetNextBytes(n))
+      position += n
+
 
 class AesCbcTest(googletest.TestCase):
 
@@ -202,6 +263,26 @@ class AesCbcTest(googletest.TestCase):
     plaintext3 = self.cipher.Decrypt(ciphertext3, 16 * '\x00')
     self.assertEqual(_PLAINTEXT1, plaintext3)
 
+  def testCbcEncryptManyDecryptMany(self):
+    logging.debug('Running testCbcEncryptManyDecryptMany method.')
+    plaintexts = ['22', _PLAINTEXT1, 16 * 'a', _PLAINTEXT1 + _PLAINTEXT2, '3']
+    ciphertexts = self.cipher.EncryptMany(plaintexts)
+    self.assertEqual(plaintexts, [self.cipher.Decrypt(c) for c in ciphertexts])
+    self.assertEqual(plaintexts, self.cipher.DecryptMany(ciphertexts))
+    # with a given iv the batch matches the single value encryptions.
+    iv = 16 * '\x00'
+    ciphertexts = self.cipher.EncryptMany(plaintexts, iv)
+    self.assertEqual([self.cipher.Encrypt(p, iv) for p in plaintexts],
+                     ciphertexts)
+    self.assertEqual(plaintexts, self.cipher.DecryptMany(ciphertexts, iv))
+    self.assertEqual([], self.cipher.EncryptMany([]))
+    self.assertEqual([], self.cipher.DecryptMany([]))
+    self.assertRaises(ValueError, self.cipher.EncryptMany, ['22', ''])
+    self.assertRaises(ValueError, self.cipher.EncryptMany, ['22'], '1')
+    self.assertRaises(ValueError, self.cipher.DecryptMany,
+                      [ciphertexts[0], ciphertexts[1][:-1]])
+    self.assertRaises(ValueError, self.cipher.DecryptMany, [iv])
+
   def testCbcEncryptDecryptFailureWithBadKey(self):
     logging.debug('Running testCbcEncryptDecryptFailureWithBadKey method.')
     # test fail for key empty, None, wrong type, non-16, 24, or 32 length
@@ -6,7 +6,9 @@
 
 
 import base64
+import collections
 import datetime
+import multiprocessing.pool
 import re
 import time
 
@@ -30,15 +32,21 @@ _DISTINCT_STRING = 'p698000442118338_'
 # Rename encrypted fields based on their encryption type.
 HOMOMORPHIC_FLOAT_PREFIX = _DISTINCT_STRING + 'HOMOMORPHIC_FLOAT_'
 HOMOMORPHIC_INT_PREFIX = _DISTINCT_STRING + 'HOMOMORPHIC_INT_'
+# Several homomorphic integer columns packed into one ciphertext column.
+HOMOMORPHIC_PACKED_INT_PREFIX = HOMOMORPHIC_INT_PREFIX + 'PACKED_'
 PROBABILISTIC_PREFIX = _DISTINCT_STRING + 'PROBABILISTIC_'
 PSEUDONYM_PREFIX = _DISTINCT_STRING + 'PSEUDONYM_'
 SEARCHWORDS_PREFIX = _DISTINCT_STRING + 'SEARCHWORDS_'
+# Bloom filter of the word sequence hashes instead of their list.
+SEARCHWORDS_BLOOM_PREFIX = SEARCHWORDS_PREFIX + 'BLOOM_'
 
 ENCRYPTED_FIELD_PREFIXES = [
+    HOMOMORPHIC_PACKED_INT_PREFIX,  # before HOMOMORPHIC_INT_PREFIX, it extends
     HOMOMORPHIC_FLOAT_PREFIX,
     HOMOMORPHIC_INT_PREFIX,
     PROBABILISTIC_PREFIX,
     PSEUDONYM_PREFIX,
+    SEARCHWORDS_BLOOM_PREFIX,  # before SEARCHWORDS_PREFIX, it extends it
     SEARCHWORDS_PREFIX,
 ]
 
@@ -224,6 +232,22 @@ class HomomorphicIntToken(EncryptedToken):
         cls, value, HOMOMORPHIC_INT_PREFIX)
 
 
+class HomomorphicPackedIntToken(HomomorphicIntToken):
+  """Homomorphic integer field stored in a lane of a packed column.
+
+  The token names the packed column; lane is the (negative) index of the
+  field's value in the list of int64s decrypted from the packed column.
+  """
+
+  def __new__(cls, value, packing_group, lane):
+    value = value.split('.')
+    value[-1] = packing_group
+    o = EncryptedToken.__new__(
+        cls, '.'.join(value), HOMOMORPHIC_PACKED_INT_PREFIX)
+    o.lane = lane
+    return o
+
+
 class ProbabilisticToken(EncryptedToken):
 
   def __new__(cls, value):
@@ -245,11 +269,117 @@ class SearchwordsToken(EncryptedToken):
         cls, value, SEARCHWORDS_PREFIX)
 
 
+class SearchwordsBloomToken(SearchwordsToken):
+
+  def __new__(cls, value):
+    return EncryptedToken.__new__(cls, value, SEARCHWORDS_BLOOM_PREFIX)
+
+
 # =============================================================================
 # = EBQ common utility functions.
 # =============================================================================
 def ConstructPaillierSumQuery(field, nsquare):
-  return AggregationQueryToken(PAILLIER_SUM_STRING % (field, nsquare))
+  query = AggregationQueryToken(PAILLIER_SUM_STRING % (field, nsquare))
+  # the sum of a packed column holds all of its lanes, remember which is wanted.
+  lane = getattr(field, 'lane', None)
+  if lane is not None:
+    query.lane = lane
+  return query
+
+
+def GetPackingGroups(schema):
+  """Returns the packed homomorphic integer columns of a schema.
+
+  Arguments:
+    schema: The user defined json which characterizes each field; only its top
+    level fields can be packed.
+
+  Returns:
+    A dictionary mapping each packing group to the names of its fields, in
+    schema order, which is also the order of the packed int64s.
+  """
+  groups = {}
+  for entry in schema:
+    if isinstance(entry, dict) and 'packing_group' in entry:
+      groups.setdefault(entry['packing_group'], []).append(entry['name'])
+  return groups
+
+
+def GetPackingLane(field_name, schema):
+  """Returns the lane of a packed field, or None if it is not packed.
+
+  Arguments:
+    field_name: Name of a top level field.
+    schema: The user defined json which characterizes each field.
+
+  Returns:
+    Negative index of the field's value in the list decrypted from its packed
+    column, or None.
+  """
+  entry = GetEntryFromSchema(field_name, schema)
+  if not entry or 'packing_group' not in entry:
+    return None
+  names = GetPackingGroups(schema)[entry['packing_group']]
+  return names.index(field_name) - len(names)
+
+
+def OrderedThreadMap(func, items, num_threads, max_in_flight=None):
+  """Yields func(item) for each item, computed by a pool of threads.
+
+  Meant for work that releases the GIL, e.g. Paillier arithmetic done by
+  OpenSSL through ctypes. Results are yielded in the order of items and at
+  most max_in_flight items are submitted ahead of the one being yielded, so
+  memory stays bounded however many items there are.
+
+  Arguments:
+    func: Function of one argument, safe to call from several threads.
+    items: Iterable of arguments, consumed from the calling thread.
+    num_threads: Number of worker threads; if < 1 items are mapped inline.
+    max_in_flight: Maximum number of submitted items not yet yielded,
+      default 2 * num_threads.
+
+  Yields:
+    func(item) for each item, in order. An exception raised by func is
+    raised here, when its result would have been yielded.
+  """
+  if num_threads < 1:
+    for item in items:
+      yield func(item)
+    return
+  if max_in_flight is None:
+    max_in_flight = 2 * num_threads
+  pool = multiprocessing.pool.ThreadPool(num_threads)
+  try:
+    for result in OrderedPoolMap(pool, func, items, max_in_flight):
+      yield result
+  finally:
+    pool.terminate()
+
+
+def OrderedPoolMap(pool, func, items, max_in_flight):
+  """Yields func(item) for each item, computed by pool.
+
+  Unlike pool.imap, which submits every item up front, at most max_in_flight
+  items are submitted ahead of the one being yielded.
+
+  Arguments:
+    pool: A multiprocessing.pool.Pool or ThreadPool; with a process pool func
+      and the items must be picklable.
+    func: Function of one argument.
+    items: Iterable of arguments, consumed from the calling thread.
+    max_in_flight: Maximum number of submitted items not yet yielded.
+
+  Yields:
+    func(item) for each item, in order. An exception raised by func is
+    raised here, when its result would have been yielded.
+  """
+  in_flight = collections.deque()
+  for item in items:
+    in_flight.append(pool.apply_async(func, (item,)))
+    if len(in_flight) >= max_in_flight:
+      yield in_flight.popleft().get()
+  while in_flight:
+    yield in_flight.popleft().get()
 
 
 def ConstructTableDescription(description, hashed_key, table_version, schema):
@@ -41,6 +41,41 @@ class CommonUtilityTest(googletest.TestCase):
         'citiesLived.non_existent_field', nested_schema)
     self.assertEqual(row, None)
 
+  def testGetPackingGroupsAndLane(self):
+    schema = [
+        {'name': 'a', 'type': 'integer', 'mode': 'required',
+         'encrypt': 'homomorphic', 'packing_group': 'm'},
+        {'name': 'b', 'type': 'integer', 'mode': 'required',
+         'encrypt': 'none'},
+        {'name': 'c', 'type': 'integer', 'mode': 'required',
+         'encrypt': 'homomorphic', 'packing_group': 'm'},
+    ]
+    self.assertEqual({'m': ['a', 'c']}, util.GetPackingGroups(schema))
+    self.assertEqual(-2, util.GetPackingLane('a', schema))
+    self.assertEqual(-1, util.GetPackingLane('c', schema))
+    self.assertEqual(None, util.GetPackingLane('b', schema))
+    token = util.HomomorphicPackedIntToken('a', 'm', -2)
+    self.assertEqual(util.HOMOMORPHIC_PACKED_INT_PREFIX + 'm', token)
+    self.assertTrue(isinstance(token, util.HomomorphicIntToken))
+    self.assertEqual(-2, util.ConstructPaillierSumQuery(token, '0').lane)
+
+  def testOrderedThreadMap(self):
+    items = range(50)
+    for num_threads in (0, 1, 4):
+      self.assertEqual(
+          [i * i for i in items],
+          list(util.OrderedThreadMap(lambda i: i * i, iter(items),
+                                     num_threads, max_in_flight=3)))
+
+    def Fail(i):
+      if i == 7:
+        raise ValueError('bad item')
+      return i
+
+    results = util.OrderedThreadMap(Fail, items, 4)
+    self.assertEqual(range(7), [results.next() for _ in xrange(7)])
+    self.assertRaises(ValueError, results.next)
+
   def testConvertFromTimestamp(self):
     """Test _ConvertFromTimestamp()."""
     t = util.time.time()
@@ -18,6 +18,7 @@ import gflags as flags
 import bigquery_client
 import bq
 import encrypted_bigquery_client
+import paillier
 import show_lib
 
 
@@ -25,6 +26,11 @@ flags.DEFINE_string(
     'master_key_filename', None,
     'The path of the file containing the master key to use in encrypting '
     'table data.')
+flags.DEFINE_boolean(
+    'calibrate_bigint_backend', False,
+    'Time the available big integer backends (openssl, gmpy2, pow) used for '
+    'homomorphic encryption, select the fastest and record the choice in %s '
+    'for later runs.' % paillier.BACKEND_CONFIG_PATH)
 
 FLAGS = flags.FLAGS
 
@@ -169,6 +175,32 @@ class _Make(bq._Make):  # pylint: disable=protected-access
     super(_Make, self).RunWithArgs(identifier, schema)
 
 
+class _FillRandomizerBank(bq.BigqueryCmd):
+  usage = """fill_randomizer_bank --master_key_filename=<key filepath>
+             --paillier_randomizer_bank=<bank filepath> <table> <count>"""
+
+  def RunWithArgs(self, identifier, count):
+    """Precompute Paillier randomizers for later loads into a table.
+
+    Appends <count> randomizers to the encrypted bank file. The next load into
+    <table> with --paillier_randomizer_pool_size set and the same
+    --paillier_randomizer_bank uses them up first, then deletes the file.
+
+    Examples:
+      ebq fill_randomizer_bank --master_key_filename=key_file
+        --paillier_randomizer_bank=bank_file dataset.table 100000
+    """
+    try:
+      count = int(count)
+    except ValueError:
+      raise app.UsageError('<count> must be an integer.')
+    if count < 1:
+      raise app.UsageError('<count> must be positive.')
+    client = bq.Client.Get()
+    reference = client.GetTableReference(identifier)
+    client.FillRandomizerBank(reference, count)
+
+
 class _Version(bq._Version):  # pylint: disable=protected-access
 
   @staticmethod
@@ -217,9 +249,12 @@ def run_main():
 
 
 def main(unused_argv):
+  if FLAGS.calibrate_bigint_backend:
+    paillier.CalibrateBackends()
   bq.Factory.SetBigqueryClientFactory(
       encrypted_bigquery_client.EncryptedBigqueryClient)
   ebq_commands = {
+      'fill_randomizer_bank': _FillRandomizerBank,
       'load': _Load,
       'mk': _Make,
       'query': _Query,
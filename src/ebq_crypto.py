@@ -6,30 +6,25 @@
 
 
 import base64
+import collections
 import hashlib
 import random
-import sys
-from unicodedata import category
+import threading
 
 import common_crypto as ccrypto
 import number
 import paillier as pcrypto
-
-
-# Dict which maps all unicode punctuation symbols to None.
-_PUNCTUATION_DICT = {}
+import unicode_punctuation
 
 
 # TODO(user): This way of punctuation may not be exactly what we want, for
 # example '$' is overlooked.
-def _GetPunctuationDict():
-  if not _PUNCTUATION_DICT:
-    # Need to be careful since sys.maxunicode may depend upon if UCS-2 or UCS-4
-    # is used.
-    for k in xrange(sys.maxunicode):
-      if category(unichr(k)).startswith('P'):
-        _PUNCTUATION_DICT[k] = None
-  return _PUNCTUATION_DICT
+# Dict mapping all unicode punctuation symbols to None, for unicode.translate.
+_PUNCTUATION_DICT = dict.fromkeys(
+    k for first, last in unicode_punctuation.PUNCTUATION_RANGES
+    for k in xrange(first, last + 1))
+# The ascii punctuation characters, for str.translate.
+_ASCII_PUNCTUATION = ''.join(chr(k) for k in _PUNCTUATION_DICT if k < 128)
 
 
 def CleanUnicodeString(s, separator=None):
@@ -48,28 +43,51 @@ def CleanUnicodeString(s, separator=None):
   """
   if not isinstance(s, unicode):
     raise ValueError('Expected unicode string type data but got: %s' % type(s))
-  words = s.lower().split(separator)
+  s = s.lower()
   if separator is None:
-    # Remove punctuation
-    words = [w.translate(_GetPunctuationDict()) for w in words]
+    # Remove punctuation; it is never whitespace, so this can be done before
+    # splitting.
+    try:
+      s = s.encode('ascii').translate(None, _ASCII_PUNCTUATION).decode('ascii')
+    except UnicodeEncodeError:
+      s = s.translate(_PUNCTUATION_DICT)
+  words = s.split(separator)
   words = [w for w in words if w]
   return words
 
 
+# Keyed prfs of the master keys that cipher keys are derived from.
+_MASTER_KEY_PRFS = {}
+
+
+def _GetMasterKeyPrf(key):
+  if key not in _MASTER_KEY_PRFS:
+    _MASTER_KEY_PRFS[key] = ccrypto.KeyedPRF(key)
+  return _MASTER_KEY_PRFS[key]
+
+
 def GeneratePseudonymCipherKey(key, identifier):
-  return ccrypto.PRF(key, 'pseudonym_' + str(identifier))
+  return _GetMasterKeyPrf(key)('pseudonym_' + str(identifier))
 
 
 def GenerateProbabilisticCipherKey(key, identifier):
-  return ccrypto.PRF(key, 'probabilistic_' + str(identifier))
+  return _GetMasterKeyPrf(key)('probabilistic_' + str(identifier))
 
 
 def GenerateHomomorphicCipherKey(key, identifier):
-  return ccrypto.PRF(key, 'homomorphic_' + str(identifier))
+  return _GetMasterKeyPrf(key)('homomorphic_' + str(identifier))
 
 
 def GenerateStringHashKey(key, identifier):
-  return ccrypto.PRF(key, 'stringhash_' + str(identifier))
+  return _GetMasterKeyPrf(key)('stringhash_' + str(identifier))
+
+
+def GenerateRandomizerBankKey(key, identifier):
+  return _GetMasterKeyPrf(key)('randomizerbank_' + str(identifier))
+
+
+def GenerateTableMetadataKey(key, identifier):
+  return _GetMasterKeyPrf(key)('tablemetadata_' + str(identifier))
 
 
 class _Cipher(object):
@@ -81,6 +99,14 @@ class _Cipher(object):
   def Decrypt(self, unused_plaintext):
     raise ValueError('Not implemented yet.')
 
+  def EncryptColumn(self, plaintexts):
+    """Encrypts a list of plaintexts, see Encrypt."""
+    return [self.Encrypt(plaintext) for plaintext in plaintexts]
+
+  def DecryptColumn(self, ciphertexts):
+    """Decrypts a list of ciphertexts, see Decrypt."""
+    return [self.Decrypt(ciphertext) for ciphertext in ciphertexts]
+
 
 class ProbabilisticCipher(_Cipher):
   """Class for probabilistic encryption of unicode or any bytes str."""
@@ -105,14 +131,7 @@ class ProbabilisticCipher(_Cipher):
     Raises:
       ValueError: when plaintext is empty or not a proper type.
     """
-    if isinstance(plaintext, unicode):
-      plaintext = plaintext.encode('utf-8')
-
-    if not isinstance(plaintext, str):
-      raise ValueError('Expected str or unicode type plaintext but got: %s' %
-                       type(plaintext))
-    if not plaintext:
-      raise ValueError('Input plaintext cannot be empty.')
+    plaintext = _EncodePlaintext(plaintext)
     return base64.b64encode(self._cipher.Encrypt(plaintext))
 
   def Decrypt(self, ciphertext, raw=False):
@@ -136,6 +155,20 @@ class ProbabilisticCipher(_Cipher):
     else:
       return raw_plaintext
 
+  def EncryptColumn(self, plaintexts):
+    """Encrypts a list of plaintexts in one batch, see Encrypt."""
+    raw_plaintexts = [_EncodePlaintext(plaintext) for plaintext in plaintexts]
+    b64encode = base64.b64encode
+    return [b64encode(ciphertext)
+            for ciphertext in self._cipher.EncryptMany(raw_plaintexts)]
+
+  def DecryptColumn(self, ciphertexts, raw=False):
+    """Decrypts a list of ciphertexts in one batch, see Decrypt."""
+    raw_plaintexts = self._cipher.DecryptMany(_DecodeBase64s(ciphertexts))
+    if raw:
+      return raw_plaintexts
+    return [raw_plaintext.decode('utf-8') for raw_plaintext in raw_plaintexts]
+
 
 class PseudonymCipher(_Cipher):
   """Class for Pseudonym encryption of unicode or any bytes str."""
@@ -144,6 +177,33 @@ class PseudonymCipher(_Cipher):
     """Cipher is initialized with a key of valid Aes key lengths."""
     super(PseudonymCipher, self).__init__()
     self._cipher = ccrypto.AesCbc(key)
+    # plaintext to ciphertext and ciphertext to plaintext, when enabled.
+    self._encrypt_cache = None
+    self._decrypt_cache = None
+
+  def EnableCache(self, max_entries):
+    """Memoizes encryptions and decryptions.
+
+    Pseudonyms are deterministic, so the values of low cardinality columns only
+    need to be encrypted or decrypted once; each result is remembered in both
+    directions.
+
+    Args:
+      max_entries: maximum number of values kept in each direction, the least
+        recently used are evicted first; 0 disables the cache.
+    """
+    if max_entries:
+      self._encrypt_cache = _LruCache(max_entries)
+      self._decrypt_cache = _LruCache(max_entries)
+    else:
+      self._encrypt_cache = self._decrypt_cache = None
+
+  def GetCacheStats(self):
+    """Returns a dict of 'encrypt' and 'decrypt' to the cache (hits, misses)."""
+    if self._encrypt_cache is None:
+      return {}
+    return {'encrypt': (self._encrypt_cache.hits, self._encrypt_cache.misses),
+            'decrypt': (self._decrypt_cache.hits, self._decrypt_cache.misses)}
 
   # TODO(user): Add a tweak based on field name, so pseudonyms are different
   # for the same value if they are in different fields. An easy solution is to
@@ -163,16 +223,18 @@ class PseudonymCipher(_Cipher):
     Raises:
       ValueError: when plaintext is empty or not a proper type.
     """
-    if isinstance(plaintext, unicode):
-      plaintext = plaintext.encode('utf-8')
-
-    if not isinstance(plaintext, str):
-      raise ValueError('Expected str or unicode type plaintext but got: %s' %
-                       type(plaintext))
-    if not plaintext:
-      raise ValueError('Input plaintext cannot be empty.')
-    return base64.b64encode(
+    plaintext = _EncodePlaintext(plaintext)
+    encrypt_cache, decrypt_cache = self._encrypt_cache, self._decrypt_cache
+    if encrypt_cache is not None:
+      ciphertext = encrypt_cache.Get(plaintext)
+      if ciphertext is not None:
+        return ciphertext
+    ciphertext = base64.b64encode(
         self._cipher.Encrypt(plaintext, iv=16 * '\x00'))
+    if encrypt_cache is not None:
+      encrypt_cache.Put(plaintext, ciphertext)
+      decrypt_cache.Put(ciphertext, plaintext)
+    return ciphertext
 
   def Decrypt(self, ciphertext, raw=False):
     """Decrypts base64 ciphertext and returns a unicode or str plaintext.
@@ -189,20 +251,119 @@ class PseudonymCipher(_Cipher):
     """
     if not isinstance(ciphertext, str):
       raise ValueError('Expected type data str but got: %s' % type(ciphertext))
-    raw_plaintext = self._cipher.Decrypt(base64.b64decode(ciphertext),
-                                         iv=16 * '\x00')
+    encrypt_cache, decrypt_cache = self._encrypt_cache, self._decrypt_cache
+    raw_plaintext = None
+    if decrypt_cache is not None:
+      raw_plaintext = decrypt_cache.Get(ciphertext)
+    if raw_plaintext is None:
+      raw_plaintext = self._cipher.Decrypt(base64.b64decode(ciphertext),
+                                           iv=16 * '\x00')
+      if decrypt_cache is not None:
+        decrypt_cache.Put(ciphertext, raw_plaintext)
+        encrypt_cache.Put(raw_plaintext, ciphertext)
     if not raw:
       return raw_plaintext.decode('utf-8')
     else:
       return raw_plaintext
 
+  def EncryptColumn(self, plaintexts):
+    """Encrypts a list of plaintexts in one batch, see Encrypt.
+
+    Each distinct plaintext that is not cached is encrypted once.
+    """
+    raw_plaintexts = [_EncodePlaintext(plaintext) for plaintext in plaintexts]
+    encrypt_cache, decrypt_cache = self._encrypt_cache, self._decrypt_cache
+    ciphertexts = {}
+    if encrypt_cache is not None:
+      for raw_plaintext in set(raw_plaintexts):
+        ciphertext = encrypt_cache.Get(raw_plaintext)
+        if ciphertext is not None:
+          ciphertexts[raw_plaintext] = ciphertext
+    missing = list(set(raw_plaintexts).difference(ciphertexts))
+    b64encode = base64.b64encode
+    for raw_plaintext, ciphertext in zip(
+        missing, self._cipher.EncryptMany(missing, iv=16 * '\x00')):
+      ciphertext = b64encode(ciphertext)
+      ciphertexts[raw_plaintext] = ciphertext
+      if encrypt_cache is not None:
+        encrypt_cache.Put(raw_plaintext, ciphertext)
+        decrypt_cache.Put(ciphertext, raw_plaintext)
+    return [ciphertexts[raw_plaintext] for raw_plaintext in raw_plaintexts]
+
+  def DecryptColumn(self, ciphertexts, raw=False):
+    """Decrypts a list of ciphertexts in one batch, see Decrypt.
+
+    Each distinct ciphertext that is not cached is decrypted once.
+    """
+    for ciphertext in ciphertexts:
+      if not isinstance(ciphertext, str):
+        raise ValueError('Expected type data str but got: %s' %
+                         type(ciphertext))
+    encrypt_cache, decrypt_cache = self._encrypt_cache, self._decrypt_cache
+    raw_plaintexts = {}
+    if decrypt_cache is not None:
+      for ciphertext in set(ciphertexts):
+        raw_plaintext = decrypt_cache.Get(ciphertext)
+        if raw_plaintext is not None:
+          raw_plaintexts[ciphertext] = raw_plaintext
+    missing = list(set(ciphertexts).difference(raw_plaintexts))
+    for ciphertext, raw_plaintext in zip(missing, self._cipher.DecryptMany(
+        _DecodeBase64s(missing), iv=16 * '\x00')):
+      raw_plaintexts[ciphertext] = raw_plaintext
+      if decrypt_cache is not None:
+        decrypt_cache.Put(ciphertext, raw_plaintext)
+        encrypt_cache.Put(raw_plaintext, ciphertext)
+    if raw:
+      return [raw_plaintexts[ciphertext] for ciphertext in ciphertexts]
+    decoded = dict((ciphertext, raw_plaintext.decode('utf-8'))
+                   for ciphertext, raw_plaintext in raw_plaintexts.iteritems())
+    return [decoded[ciphertext] for ciphertext in ciphertexts]
+
+
+def _EncodePlaintext(plaintext):
+  """Returns plaintext as a non empty str, encoding unicode as utf-8.
+
+  Raises:
+    ValueError: when plaintext is empty or not a proper type.
+  """
+  if isinstance(plaintext, unicode):
+    plaintext = plaintext.encode('utf-8')
+  if not isinstance(plaintext, str):
+    raise ValueError('Expected str or unicode type plaintext but got: %s' %
+                     type(plaintext))
+  if not plaintext:
+    raise ValueError('Input plaintext cannot be empty.')
+  return plaintext
+
+
+def _DecodeBase64s(ciphertexts):
+  """Returns the base64 decoding of a list of str ciphertexts.
+
+  Raises:
+    ValueError: when a ciphertext is not a str.
+  """
+  b64decode = base64.b64decode
+  decoded = []
+  for ciphertext in ciphertexts:
+    if not isinstance(ciphertext, str):
+      raise ValueError('Expected type data str but got: %s' % type(ciphertext))
+    decoded.append(b64decode(ciphertext))
+  return decoded
+
 
 class HomomorphicIntCipher(_Cipher):
   """Class for homomorphically encrypting and adding ints and float."""
 
-  def __init__(self, key):
+  def __init__(self, key, paillier=None):
+    """Cipher is initialized with a seed key or an existing Paillier object.
+
+    Args:
+      key: str, seed used to derive the Paillier parameters.
+      paillier: optional paillier.Paillier instance already derived from key,
+        used to avoid regenerating the Paillier primes.
+    """
     super(HomomorphicIntCipher, self).__init__()
-    self._paillier = pcrypto.Paillier(key)
+    self._paillier = paillier or pcrypto.Paillier(key)
     # Store raw binary nsquare as a string using '\x' syntax which can be passed
     # in a query.
     nsquare_bytes = number.LongToBytes(self._paillier.nsquare)
@@ -244,13 +405,82 @@ class HomomorphicIntCipher(_Cipher):
     return self._paillier.DecryptInt64(
         number.BytesToLong(base64.b64decode(ciphertext)))
 
+  def EncryptMultiple(self, plaintexts):
+    """Encrypts up to PACKING_LIMIT int64s into one base64 encoded ciphertext.
+
+    Args:
+      plaintexts: list of ints or longs to be packed and encrypted.
+
+    Returns:
+      encrypted packed plaintexts, converted to bytes, and base64 encoded.
+
+    Raises:
+      ValueError: when there are too many plaintexts, or one is neither an int,
+        nor a long.
+    """
+    return base64.b64encode(
+        number.LongToBytes(self._paillier.EncryptMultipleInt64s(plaintexts)))
+
+  def DecryptMultiple(self, ciphertext):
+    """Takes a packed ciphertext and decrypts it to a list of longs.
+
+    Args:
+      ciphertext: a string, as returned by EncryptMultiple or a sum of those.
+
+    Returns:
+      list of PACKING_LIMIT int64s, the packed values being the last ones.
+
+    Raises:
+      ValueError: when ciphertext is not a string.
+    """
+    if not isinstance(ciphertext, str):
+      raise ValueError('Expected type data str but got: %s' % type(ciphertext))
+    return self._paillier.DecryptMultipleInt64s(
+        number.BytesToLong(base64.b64decode(ciphertext)))
+
+  def EncryptColumn(self, plaintexts):
+    """Encrypts a column of int64s in one batch.
+
+    Args:
+      plaintexts: list of ints or longs to be encrypted.
+
+    Returns:
+      list of encrypted plaintexts, converted to bytes, and base64 encoded.
+
+    Raises:
+      ValueError: when a plaintext is neither an int, nor a long.
+    """
+    return _EncodeCiphertexts(self._paillier.EncryptInt64s(plaintexts))
+
+  def DecryptColumn(self, ciphertexts):
+    """Decrypts a column of ciphertexts to longs in one batch.
+
+    Args:
+      ciphertexts: list of strings, each an encrypted int that is converted to
+        bytes and base64 encoded.
+
+    Returns:
+      list of decrypted int64s.
+
+    Raises:
+      ValueError: when a ciphertext is not a string.
+    """
+    return self._paillier.DecryptInt64s(_DecodeCiphertexts(ciphertexts))
+
 
 class HomomorphicFloatCipher(_Cipher):
   """Class for homomorphic encrypting and adding floats."""
 
-  def __init__(self, key):
+  def __init__(self, key, paillier=None):
+    """Cipher is initialized with a seed key or an existing Paillier object.
+
+    Args:
+      key: str, seed used to derive the Paillier parameters.
+      paillier: optional paillier.Paillier instance already derived from key,
+        used to avoid regenerating the Paillier primes.
+    """
     super(HomomorphicFloatCipher, self).__init__()
-    self._paillier = pcrypto.Paillier(key)
+    self._paillier = paillier or pcrypto.Paillier(key)
     # Store raw binary nsquare as a string using '\x' syntax which can be passed
     # in a query.
     nsquare_bytes = number.LongToBytes(self._paillier.nsquare)
@@ -292,6 +522,123 @@ class HomomorphicFloatCipher(_Cipher):
     return self._paillier.DecryptFloat(
         number.BytesToLong(base64.b64decode(ciphertext)))
 
+  def EncryptColumn(self, plaintexts):
+    """Encrypts a column of floats in one batch.
+
+    Args:
+      plaintexts: list of floats to be encrypted.
+
+    Returns:
+      list of encrypted plaintexts, converted to bytes, and base64 encoded.
+
+    Raises:
+      ValueError: when a plaintext is not a float.
+    """
+    return _EncodeCiphertexts(self._paillier.EncryptFloats(plaintexts))
+
+  def DecryptColumn(self, ciphertexts):
+    """Decrypts a column of ciphertexts to floats in one batch.
+
+    Args:
+      ciphertexts: list of strings, each an encrypted float, converted to
+        bytes, and base64 encoded.
+
+    Returns:
+      list of decrypted floats.
+
+    Raises:
+      ValueError: when a ciphertext is not a string.
+    """
+    return self._paillier.DecryptFloats(_DecodeCiphertexts(ciphertexts))
+
+
+def _EncodeCiphertexts(ciphertexts):
+  """Converts paillier ciphertexts to base64 encoded bytes."""
+  b64encode = base64.b64encode
+  long_to_bytes = number.LongToBytes
+  return [b64encode(long_to_bytes(ciphertext)) for ciphertext in ciphertexts]
+
+
+def _DecodeCiphertexts(ciphertexts):
+  """Converts base64 encoded ciphertexts back to longs.
+
+  Args:
+    ciphertexts: list of strings, as returned by _EncodeCiphertexts.
+
+  Returns:
+    list of longs.
+
+  Raises:
+    ValueError: when a ciphertext is not a string.
+  """
+  for ciphertext in ciphertexts:
+    if not isinstance(ciphertext, str):
+      raise ValueError('Expected type data str but got: %s' % type(ciphertext))
+  b64decode = base64.b64decode
+  bytes_to_long = number.BytesToLong
+  return [bytes_to_long(b64decode(ciphertext)) for ciphertext in ciphertexts]
+
+
+# Standard base64 alphabet, searchwords bloom filters are written with it 6 bits
+# per character so that the server can test their bits with string functions.
+BASE64_ALPHABET = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                   '0123456789+/')
+_BASE64_VALUES = dict((c, i) for i, c in enumerate(BASE64_ALPHABET))
+_BASE64_TRANSLATION = BASE64_ALPHABET + '\0' * (256 - len(BASE64_ALPHABET))
+# Default size and number of bits set per word subsequence of searchwords
+# bloom filters; up to a few hundred subsequences per row, this is a false
+# positive rate below 1%.
+SEARCHWORDS_BLOOM_BITS = 6144
+SEARCHWORDS_BLOOM_HASHES = 4
+# A probe takes 3 characters of a base64 encoded sha1, its slot is given by 2
+# of them.
+SEARCHWORDS_BLOOM_MAX_BITS = 6 * 64 * 64
+SEARCHWORDS_BLOOM_MAX_HASHES = 8
+
+
+def GetSearchwordsBloomProbes(iv, keyed_hash, num_bits, num_hashes):
+  """Returns the bits of a searchwords bloom filter that keyed_hash sets.
+
+  The probes are derived from the base64 encoded sha1 of iv and keyed_hash: the
+  values of each 3 of its characters, v1, v2 and v3, give the slot
+  (64 * v1 + v2) % (num_bits / 6) and the bit v3 % 6 of the slot. The query
+  rewrite computes the same from the IV stored in each row.
+
+  Args:
+    iv: str, base64 encoded IV of the row.
+    keyed_hash: str, base64 encoded keyed hash of a word subsequence.
+    num_bits: size of the filter.
+    num_hashes: number of probes.
+
+  Returns:
+    list of num_hashes (slot, bit) tuples.
+  """
+  probe_hash = base64.b64encode(hashlib.sha1(iv + keyed_hash).digest())
+  values = [_BASE64_VALUES[c] for c in probe_hash[:3 * num_hashes]]
+  num_slots = num_bits // 6
+  return [((64 * values[k] + values[k + 1]) % num_slots, values[k + 2] % 6)
+          for k in xrange(0, 3 * num_hashes, 3)]
+
+
+def SearchwordsBloomMightContain(bloom_filter, keyed_hash, num_hashes):
+  """Returns whether a searchwords bloom filter may contain keyed_hash.
+
+  Args:
+    bloom_filter: str, as returned by GetBloomFilterForWordSubsequencesWithIv.
+    keyed_hash: str, base64 encoded keyed hash of a word subsequence.
+    num_hashes: number of bits set per word subsequence.
+
+  Returns:
+    False if keyed_hash was not added to the filter, True if it was or in case
+    of a false positive.
+  """
+  iv, slots = bloom_filter[:24], bloom_filter[24:]
+  for slot, bit in GetSearchwordsBloomProbes(iv, keyed_hash, len(slots) * 6,
+                                             num_hashes):
+    if not _BASE64_VALUES[slots[slot]] >> bit & 1:
+      return False
+  return True
+
 
 class StringHash(object):
   """Key hashes of word sequences."""
@@ -301,6 +648,34 @@ class StringHash(object):
     self._key = key
     self._output_len = output_len
     self._hashfunc = hashfunc
+    # Hash function name to the prf keyed with key.
+    self._prfs = {}
+    # (field_name, output_len, hashfunc) to the stream of _GetFieldStream.
+    self._field_streams = {}
+    self._cache_max_entries = 0
+    self._caches = {}
+    self._caches_lock = threading.Lock()
+
+  def EnableKeyedHashCache(self, max_entries):
+    """Memoizes the keyed hashes of word subsequences, per field.
+
+    The keyed hash of a word subsequence only depends on the field and the
+    subsequence, so when the same words repeat across rows only the IV mixing
+    of GetHashesForWordSubsequencesWithIv has to be recomputed.
+
+    Args:
+      max_entries: maximum number of keyed hashes kept per field, the least
+        recently used are evicted first; 0 disables the cache.
+    """
+    with self._caches_lock:
+      self._cache_max_entries = max_entries
+      self._caches = {}
+
+  def GetKeyedHashCacheStats(self):
+    """Returns a dict of field name to keyed hash cache (hits, misses)."""
+    with self._caches_lock:
+      return dict((field_name, (cache.hits, cache.misses))
+                  for field_name, cache in self._caches.iteritems())
 
   def GetStringKeyHash(self, field_name, data, output_len=None, hashfunc=None):
     """Calculates a keyed hash of a string.
@@ -324,20 +699,37 @@ class StringHash(object):
     if not isinstance(data, unicode):
       raise ValueError('SubstringHash methods only works with data '
                        'input type unicode, given: %s' % type(data))
-    if not isinstance(field_name, unicode):
-      raise ValueError('fieldname input type should be unicode, given: %s' %
-                       type(field_name))
-    if not field_name:
-      raise ValueError('field_name cannot be empty.')
-    output_digest_len = output_len or self._output_len
-    digest_hashfunc = hashfunc or self._hashfunc
-    # data --> len, field_name, data
-    extended_data = ccrypto.IntToFixedSizeString(len(field_name))
-    extended_data += field_name + data
-    utf8_data = extended_data.encode('utf-8')
-    raw_hash = ccrypto.PRF(self._key, utf8_data,
-                           output_digest_len, digest_hashfunc)
-    return base64.b64encode(raw_hash)
+    stream = self._GetFieldStream(field_name, output_len or self._output_len,
+                                  hashfunc or self._hashfunc).Copy()
+    stream.Update(data.encode('utf-8'))
+    return base64.b64encode(stream.Digest())
+
+  def _GetFieldStream(self, field_name, output_len, hashfunc):
+    """Returns the keyed hash PRFStream that has absorbed the field prefix.
+
+    The keyed hash of data is the prf of the utf8 encoding of the 8 byte
+    length of field_name, field_name and data, so the returned stream must be
+    copied before data is appended to it.
+
+    Raises:
+      ValueError: when fieldname is not a unicode string or is empty.
+    """
+    stream_key = (field_name, output_len, hashfunc)
+    stream = self._field_streams.get(stream_key)
+    if stream is None:
+      if not isinstance(field_name, unicode):
+        raise ValueError('fieldname input type should be unicode, given: %s' %
+                         type(field_name))
+      if not field_name:
+        raise ValueError('field_name cannot be empty.')
+      prf = self._prfs.get(hashfunc)
+      if prf is None:
+        prf = self._prfs[hashfunc] = ccrypto.KeyedPRF(self._key, hashfunc)
+      stream = prf.NewStream(output_len)
+      stream.Update((ccrypto.IntToFixedSizeString(len(field_name)) +
+                     field_name).encode('utf-8'))
+      self._field_streams[stream_key] = stream
+    return stream
 
   def GetHashesForWordSubsequencesWithIv(
       self, field_name, data, max_sequence_len=5, random_permute='True',
@@ -381,19 +773,259 @@ class StringHash(object):
     words = CleanUnicodeString(data, separator)
     hashes = []
     iv = base64.b64encode(rand_gen(16))
-    separator = separator or u' '
     output_digest_len = output_len or self._output_len
-    for i in xrange(len(words)):
-      for j in xrange(max_sequence_len):
-        if i + j < len(words):
-          subsequence = separator.join(words[i:i+j+1])
-          keyed_hash = self.GetStringKeyHash(field_name, subsequence,
-                                             output_digest_len, hashfunc)
-          # pylint: disable=too-many-function-args
-          hash_of_iv_and_keyed_hash = (
-              hashlib.sha1(iv + keyed_hash).digest()[:output_digest_len])
-          hashes.append(base64.b64encode(hash_of_iv_and_keyed_hash))
+    for keyed_hash in self._IterKeyedHashes(
+        field_name, words, max_sequence_len, separator, output_len, hashfunc):
+      # pylint: disable=too-many-function-args
+      hash_of_iv_and_keyed_hash = (
+          hashlib.sha1(iv + keyed_hash).digest()[:output_digest_len])
+      hashes.append(base64.b64encode(hash_of_iv_and_keyed_hash))
     # TODO(user): use a better random generator to shuffle, it accepts one.
     if random_permute:
       random.shuffle(hashes)
     return ' '.join([iv] + hashes)
+
+  def GetBloomFilterForWordSubsequencesWithIv(
+      self, field_name, data, max_sequence_len=5, separator=None,
+      num_bits=SEARCHWORDS_BLOOM_BITS, num_hashes=SEARCHWORDS_BLOOM_HASHES,
+      rand_gen=ccrypto.GetRandBytes):
+    """Returns a bloom filter of the word subsequences of a max length in data.
+
+    The word subsequences and their keyed hashes are the same as in
+    GetHashesForWordSubsequencesWithIv, but instead of listing the hashes of
+    the keyed hashes with a prepended IV, these hashes are used to set
+    num_hashes bits each of a filter of num_bits; see GetSearchwordsBloomProbes.
+
+    Args:
+      field_name: unicode string that is used as part of hash calculation.
+      data: unicode string.
+      max_sequence_len: maximum subsequence length in words to be hashed.
+      separator: used to split string, default is white space.
+      num_bits: size of the filter, a multiple of 6 of at most
+        SEARCHWORDS_BLOOM_MAX_BITS.
+      num_hashes: number of bits set per word subsequence, at most
+        SEARCHWORDS_BLOOM_MAX_HASHES.
+      rand_gen: a random generator function that takes an int argument for size
+        and returns that many random bytes, used to create IV.
+
+    Returns:
+      base64 encoded IV followed by the filter, which is written 6 bits per
+      base64 character, so always has 24 + num_bits / 6 characters.
+
+    Raises:
+      ValueError: when data is not a unicode string.
+    """
+    if not isinstance(data, unicode):
+      raise ValueError('SubstringHash methods only works with data '
+                       'input type %s, given: %s' % (type(u''), type(data)))
+    words = CleanUnicodeString(data, separator)
+    iv = base64.b64encode(rand_gen(16))
+    slots = bytearray(num_bits // 6)
+    for keyed_hash in self._IterKeyedHashes(
+        field_name, words, max_sequence_len, separator, None, None):
+      for slot, bit in GetSearchwordsBloomProbes(iv, keyed_hash, num_bits,
+                                                 num_hashes):
+        slots[slot] |= 1 << bit
+    return iv + str(slots).translate(_BASE64_TRANSLATION)
+
+  def _IterKeyedHashes(self, field_name, words, max_sequence_len, separator,
+                       output_len, hashfunc):
+    """Yields the keyed hashes of the word subsequences of words, in order."""
+    if not words:
+      return
+    separator = separator or u' '
+    output_digest_len = output_len or self._output_len
+    # Each subsequence extends the one before it that has the same first word,
+    # so their keyed hashes are computed on a single stream per first word that
+    # absorbs one more word at a time. With the cache, the stream only absorbs
+    # words when a subsequence misses, so hits are not hashed at all.
+    field_stream = self._GetFieldStream(
+        field_name, output_digest_len, hashfunc or self._hashfunc)
+    cache = self._GetKeyedHashCache(field_name)
+    utf8_words = [word.encode('utf-8') for word in words]
+    utf8_separator = separator.encode('utf-8')
+    # cache keys are slices of this tuple, no subsequence string is built.
+    word_tuple = tuple(words)
+    for i in xrange(len(words)):
+      stream = None
+      absorbed = i  # words[i:absorbed] have been absorbed by stream.
+      for end in xrange(i + 1, min(i + max_sequence_len, len(words)) + 1):
+        keyed_hash = None
+        if cache is not None:
+          cache_key = (word_tuple[i:end], separator, output_digest_len,
+                       hashfunc)
+          keyed_hash = cache.Get(cache_key)
+        if keyed_hash is None:
+          if stream is None:
+            stream = field_stream.Copy()
+          for k in xrange(absorbed, end):
+            if k > i:
+              stream.Update(utf8_separator)
+            stream.Update(utf8_words[k])
+          absorbed = end
+          keyed_hash = base64.b64encode(stream.Digest())
+          if cache is not None:
+            cache.Put(cache_key, keyed_hash)
+        yield keyed_hash
+
+  def _GetKeyedHashCache(self, field_name):
+    """Returns the field's keyed hash cache, or None if it is disabled."""
+    if not self._cache_max_entries:
+      return None
+    cache = self._caches.get(field_name)
+    if cache is None:
+      with self._caches_lock:
+        cache = self._caches.setdefault(
+            field_name, _LruCache(self._cache_max_entries))
+    return cache
+
+
+class _LruCache(object):
+  """Thread safe, bounded, least recently used cache with hit counters."""
+
+  def __init__(self, max_entries):
+    self._max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def Get(self, key):
+    """Returns the value of key, or None if it is not cached."""
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+      else:
+        # reinserting moves key to the most recently used end.
+        self._entries[key] = value
+        self.hits += 1
+      return value
+
+  def Put(self, key, value):
+    with self._lock:
+      self._entries[key] = value
+      if len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+
+class CipherSuite(object):
+  """Derives and memoizes all ciphers used for a single table.
+
+  Every cipher is created lazily the first time it is requested and reused
+  afterwards. In particular the Paillier key, whose derivation from the seed
+  requires generating two large primes, is computed at most once and shared by
+  the homomorphic int and float ciphers.
+  """
+
+  def __init__(self, master_key, table_id):
+    """Suite is initialized with the master key and the table identifier."""
+    self._master_key = master_key
+    self._table_id = table_id
+    self._ciphers = {}
+    self._related_pseudonym_ciphers = {}
+    self._pseudonym_cache_entries = 0
+
+  def _GetCipher(self, name, factory):
+    if name not in self._ciphers:
+      self._ciphers[name] = factory()
+    return self._ciphers[name]
+
+  @property
+  def probabilistic_cipher(self):
+    return self._GetCipher('probabilistic', lambda: ProbabilisticCipher(
+        GenerateProbabilisticCipherKey(self._master_key, self._table_id)))
+
+  @property
+  def pseudonym_cipher(self):
+    return self._GetCipher('pseudonym', lambda: self._NewPseudonymCipher(
+        GeneratePseudonymCipherKey(self._master_key, self._table_id)))
+
+  @property
+  def string_hasher(self):
+    # TODO(user): ciphers and hash should not use the same key.
+    return self._GetCipher('stringhash', lambda: StringHash(
+        GenerateStringHashKey(self._master_key, self._table_id)))
+
+  @property
+  def paillier(self):
+    return self._GetCipher('paillier', lambda: pcrypto.Paillier(
+        GenerateHomomorphicCipherKey(self._master_key, self._table_id)))
+
+  @property
+  def homomorphic_int_cipher(self):
+    return self._GetCipher('homomorphic_int', lambda: HomomorphicIntCipher(
+        GenerateHomomorphicCipherKey(self._master_key, self._table_id),
+        paillier=self.paillier))
+
+  @property
+  def homomorphic_float_cipher(self):
+    return self._GetCipher('homomorphic_float', lambda: HomomorphicFloatCipher(
+        GenerateHomomorphicCipherKey(self._master_key, self._table_id),
+        paillier=self.paillier))
+
+  @property
+  def nsquare(self):
+    """Paillier nsquare in the escaped form used by PAILLIER_SUM queries."""
+    return self.homomorphic_int_cipher.nsquare
+
+  def GetRelatedPseudonymCipher(self, related):
+    """Returns the pseudonym cipher shared by all fields with this related tag.
+
+    Args:
+      related: unicode or str, value of the 'related' attribute in the schema.
+
+    Returns:
+      PseudonymCipher keyed by the master key and related instead of table_id,
+      so that values are comparable across tables.
+    """
+    related = str(related).encode('utf-8')
+    if related not in self._related_pseudonym_ciphers:
+      self._related_pseudonym_ciphers[related] = self._NewPseudonymCipher(
+          GeneratePseudonymCipherKey(self._master_key, related))
+    return self._related_pseudonym_ciphers[related]
+
+  def _NewPseudonymCipher(self, key):
+    cipher = PseudonymCipher(key)
+    if self._pseudonym_cache_entries:
+      cipher.EnableCache(self._pseudonym_cache_entries)
+    return cipher
+
+  def _GetPseudonymCiphers(self):
+    """Returns a dict of related tag, None for table_id, to pseudonym cipher."""
+    pseudonym_ciphers = dict(self._related_pseudonym_ciphers)
+    if 'pseudonym' in self._ciphers:
+      pseudonym_ciphers[None] = self._ciphers['pseudonym']
+    return pseudonym_ciphers
+
+  def EnablePseudonymCache(self, max_entries):
+    """Enables the cache of the pseudonym ciphers, see PseudonymCipher.
+
+    Applies to the table's pseudonym cipher and the related pseudonym ciphers,
+    including those created afterwards.
+
+    Args:
+      max_entries: maximum number of values cached in each direction by each
+        cipher; 0 disables the caches.
+    """
+    self._pseudonym_cache_entries = max_entries
+    for cipher in self._GetPseudonymCiphers().itervalues():
+      cipher.EnableCache(max_entries)
+
+  def GetPseudonymCacheStats(self):
+    """Returns a dict of related tag, None for table_id, to the cache stats."""
+    return dict((related, cipher.GetCacheStats())
+                for related, cipher in self._GetPseudonymCiphers().iteritems()
+                if cipher.GetCacheStats())
+
+
+# Process-wide cache of CipherSuite objects keyed by (master_key, table_id).
+_CIPHER_SUITES = {}
+
+
+def GetCipherSuite(master_key, table_id):
+  """Returns the memoized CipherSuite for master_key and table_id."""
+  suite_key = (master_key, table_id)
+  if suite_key not in _CIPHER_SUITES:
+    _CIPHER_SUITES[suite_key] = CipherSuite(master_key, table_id)
+  return _CIPHER_SUITES[suite_key]
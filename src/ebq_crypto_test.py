@@ -5,12 +5,17 @@
 
 
 
+import base64
+import hashlib
+import time
 
 from google.apputils import app
 import logging
 from google.apputils import basetest as googletest
 
 import ebq_crypto as ecrypto
+import paillier as pcrypto
+import unicode_punctuation
 
 _KEY1 = '0123456789abcdef'
 _PLAINTEXT1 = 'this is test string one'
@@ -55,6 +60,20 @@ class ProbabilisticCiphertTest(googletest.TestCase):
     self.assertRaises(
         UnicodeDecodeError, self.cipher.Decrypt, ciphertext, raw=False)
 
+  def testEncryptColumnDecryptColumn(self):
+    plaintexts = [u'22', u'\xe9', u'this is test string one', u'22']
+    ciphertexts = self.cipher.EncryptColumn(plaintexts)
+    self.assertEqual(plaintexts,
+                     [self.cipher.Decrypt(c) for c in ciphertexts])
+    self.assertEqual(plaintexts, self.cipher.DecryptColumn(ciphertexts))
+    self.assertEqual(['\xc3\xa9'], self.cipher.DecryptColumn(
+        [self.cipher.Encrypt(u'\xe9')], raw=True))
+    # each value gets its own iv.
+    self.assertNotEqual(ciphertexts[0], ciphertexts[3])
+    self.assertEqual([], self.cipher.EncryptColumn([]))
+    self.assertRaises(ValueError, self.cipher.EncryptColumn, [u'a', u''])
+    self.assertRaises(ValueError, self.cipher.DecryptColumn, [u'abc'])
+
 
 class PseudonymCiphertTest(googletest.TestCase):
 
@@ -78,6 +97,46 @@ class PseudonymCiphertTest(googletest.TestCase):
     except ValueError:
       pass  # success
 
+  def testPseudonymCache(self):
+    logging.debug('Running testPseudonymCache method.')
+    uncached = ecrypto.PseudonymCipher(_KEY1)
+    self.assertEqual({}, self.cipher.GetCacheStats())
+    self.cipher.EnableCache(2)
+    for plaintext in [u'ford', u'ford', u'jeep', u'ford']:
+      self.assertEqual(uncached.Encrypt(plaintext),
+                       self.cipher.Encrypt(plaintext))
+    self.assertEqual({'encrypt': (2, 2), 'decrypt': (0, 0)},
+                     self.cipher.GetCacheStats())
+    # encryptions are remembered for decryption, and the other way around.
+    self.assertEqual(u'jeep', self.cipher.Decrypt(uncached.Encrypt(u'jeep')))
+    self.assertEqual('\xc3\xa9', self.cipher.Decrypt(
+        uncached.Encrypt(u'\xe9'), raw=True))
+    self.assertEqual(u'\xe9', self.cipher.Decrypt(uncached.Encrypt(u'\xe9')))
+    self.assertEqual(uncached.Encrypt(u'\xe9'), self.cipher.Encrypt(u'\xe9'))
+    # jeep was evicted.
+    self.assertEqual(uncached.Encrypt(u'jeep'), self.cipher.Encrypt(u'jeep'))
+    self.assertEqual({'encrypt': (3, 3), 'decrypt': (2, 1)},
+                     self.cipher.GetCacheStats())
+    self.assertRaises(ValueError, self.cipher.Encrypt, u'')
+    self.cipher.EnableCache(0)
+    self.assertEqual({}, self.cipher.GetCacheStats())
+
+  def testEncryptColumnDecryptColumn(self):
+    plaintexts = [u'ford', u'\xe9', u'ford', u'this is test string one']
+    ciphertexts = [self.cipher.Encrypt(p) for p in plaintexts]
+    self.assertEqual(ciphertexts, self.cipher.EncryptColumn(plaintexts))
+    self.assertEqual(plaintexts, self.cipher.DecryptColumn(ciphertexts))
+    self.assertEqual(['ford'], self.cipher.DecryptColumn(ciphertexts[:1],
+                                                         raw=True))
+    self.cipher.EnableCache(10)
+    self.assertEqual(ciphertexts, self.cipher.EncryptColumn(plaintexts))
+    self.assertEqual(plaintexts, self.cipher.DecryptColumn(ciphertexts))
+    # distinct values are looked up once per batch.
+    self.assertEqual({'encrypt': (0, 3), 'decrypt': (3, 0)},
+                     self.cipher.GetCacheStats())
+    self.assertRaises(ValueError, self.cipher.EncryptColumn, [22])
+    self.assertRaises(ValueError, self.cipher.DecryptColumn, [u'abc'])
+
 
 def _GetRandForTesting(size):
   # return some constant of appropriate size
@@ -108,6 +167,32 @@ class HomomorphicIntCiphertTest(googletest.TestCase):
     except ValueError:
       pass  # success
 
+  def testHomomorphicEncryptColumnDecryptColumn(self):
+    int_cipher = ecrypto.HomomorphicIntCipher(_KEY1)
+    int64s = [0, -5, 7, 2 ** 63 - 1]
+    ciphertexts = int_cipher.EncryptColumn(int64s)
+    self.assertEqual(len(int64s), len(ciphertexts))
+    self.assertEqual(int64s, int_cipher.DecryptColumn(ciphertexts))
+    self.assertEqual(int64s, [int_cipher.Decrypt(c) for c in ciphertexts])
+    self.assertRaises(ValueError, int_cipher.DecryptColumn, [u'abc'])
+    float_cipher = ecrypto.HomomorphicFloatCipher(_KEY1)
+    floats = [0.0, -2.5, 1e-10]
+    ciphertexts = float_cipher.EncryptColumn(floats)
+    self.assertEqual(floats, float_cipher.DecryptColumn(ciphertexts))
+    self.assertEqual(floats, [float_cipher.Decrypt(c) for c in ciphertexts])
+    self.assertRaises(ValueError, float_cipher.EncryptColumn, [1])
+
+  def testHomomorphicEncryptMultipleDecryptMultiple(self):
+    logging.debug('Running testHomomorphicEncryptMultipleDecryptMultiple '
+                  'method.')
+    ciphertext = self.cipher.EncryptMultiple([3, -5, 2 ** 40])
+    decrypted = self.cipher.DecryptMultiple(ciphertext)
+    self.assertEqual(pcrypto.PACKING_LIMIT, len(decrypted))
+    self.assertEqual([3, -5, 2 ** 40], decrypted[-3:])
+    self.assertRaises(ValueError, self.cipher.EncryptMultiple,
+                      range(pcrypto.PACKING_LIMIT + 1))
+    self.assertRaises(ValueError, self.cipher.DecryptMultiple, 1)
+
 
 class HomomorphicFloatCipherTest(googletest.TestCase):
 
@@ -135,6 +220,36 @@ class HomomorphicFloatCipherTest(googletest.TestCase):
       pass  # success
 
 
+class CleanUnicodeStringTest(googletest.TestCase):
+
+  def testCleanUnicodeString(self):
+    self.assertEqual([u'hello', u'world', u'its', u'me'],
+                     ecrypto.CleanUnicodeString(u'Hello,  World! (it\'s me)'))
+    self.assertEqual([u'\xe9t\xe9', u'caf\xe9', u'a\u4e2db'],
+                     ecrypto.CleanUnicodeString(
+                         u'\xc9t\xe9 \xbfcaf\xe9? a\u4e2d\u3002b'))
+    self.assertEqual([u'a,b', u'c.'],
+                     ecrypto.CleanUnicodeString(u'A,B;c.', separator=u';'))
+    self.assertEqual([], ecrypto.CleanUnicodeString(u'; ,. \u3001'))
+    self.assertEqual([u'$5'], ecrypto.CleanUnicodeString(u'$5'))
+    self.assertRaises(ValueError, ecrypto.CleanUnicodeString, 'str')
+
+  def testPunctuationTableBenchmark(self):
+    start = time.time()
+    unicode_punctuation.ComputePunctuationRanges()
+    scan_seconds = time.time() - start
+    start = time.time()
+    reload(unicode_punctuation)
+    punctuation = dict.fromkeys(
+        k for first, last in unicode_punctuation.PUNCTUATION_RANGES
+        for k in xrange(first, last + 1))
+    table_seconds = time.time() - start
+    self.assertEqual(ecrypto._PUNCTUATION_DICT, punctuation)
+    logging.info('Punctuation dict from a unicodedata scan: %.3fs, from the '
+                 'range table: %.5fs', scan_seconds, table_seconds)
+    self.assertTrue(table_seconds < scan_seconds)
+
+
 class StringHashTest(googletest.TestCase):
 
   def setUp(self):
@@ -238,6 +353,149 @@ class StringHashTest(googletest.TestCase):
     # - expect base64 encoding of IV of 16 ones.
     self.assertEqual('MTExMTExMTExMTExMTExMQ==', hashes_empty)
 
+  def testGetHashesForWordSubsequencesMatchesKeyedHashes(self):
+    text = u'na\xefve caf\xe9 \u4e2d\u6587 over the lazy dog the end'
+    words = ecrypto.CleanUnicodeString(text)
+    iv = base64.b64encode(_GetRandForTesting(16))
+    for output_len, hashfunc in [(8, None), (20, 'sha256'), (37, 'md5')]:
+      expected = []
+      for i in xrange(len(words)):
+        for j in xrange(i + 1, min(i + 4, len(words) + 1)):
+          keyed_hash = self.hasher.GetStringKeyHash(
+              self.fieldname, u' '.join(words[i:j]), output_len, hashfunc)
+          expected.append(base64.b64encode(
+              hashlib.sha1(iv + keyed_hash).digest()[:output_len]))
+      self.assertEqual(
+          ' '.join([iv] + expected),
+          self.hasher.GetHashesForWordSubsequencesWithIv(
+              self.fieldname, text, max_sequence_len=3, random_permute=False,
+              output_len=output_len, hashfunc=hashfunc,
+              rand_gen=_GetRandForTesting))
+
+  def testGetHashesForWordSubsequencesBenchmark(self):
+    text = u' '.join(u'word%d' % (i % 50) for i in xrange(200))
+    start = time.time()
+    for unused_i in xrange(10):
+      self.hasher.GetHashesForWordSubsequencesWithIv(self.fieldname, text)
+    seconds = time.time() - start
+    logging.info('Searchwords hashing of 200 words: %.1fms per row',
+                 seconds * 100)
+
+  def testGetBloomFilterForWordSubsequencesWithIv(self):
+    text = u'The quick brown fox jumps over the lazy dog'
+    bloom_filter = self.hasher.GetBloomFilterForWordSubsequencesWithIv(
+        self.fieldname, text, num_bits=6 * 512, num_hashes=3,
+        rand_gen=_GetRandForTesting)
+    self.assertEqual('MTExMTExMTExMTExMTExMQ==', bloom_filter[:24])
+    self.assertEqual(24 + 512, len(bloom_filter))
+    # 35 word subsequences set at most 105 bits.
+    num_set_bits = sum(bin(ecrypto.BASE64_ALPHABET.index(c)).count('1')
+                       for c in bloom_filter[24:])
+    self.assertTrue(0 < num_set_bits <= 105)
+    words = ecrypto.CleanUnicodeString(text)
+    for i in xrange(len(words)):
+      for j in xrange(i + 1, min(i + 5, len(words)) + 1):
+        self.assertTrue(ecrypto.SearchwordsBloomMightContain(
+            bloom_filter, self.hasher.GetStringKeyHash(
+                self.fieldname, u' '.join(words[i:j])), 3))
+    for absent in [u'cat', u'the dog', u'quick fox', u'jumps over the lazy dog '
+                   u'again']:
+      self.assertFalse(ecrypto.SearchwordsBloomMightContain(
+          bloom_filter, self.hasher.GetStringKeyHash(self.fieldname, absent),
+          3))
+    # the bits depend on the IV.
+    self.assertNotEqual(
+        bloom_filter[24:],
+        self.hasher.GetBloomFilterForWordSubsequencesWithIv(
+            self.fieldname, text, num_bits=6 * 512, num_hashes=3)[24:])
+    self.assertEqual(
+        'MTExMTExMTExMTExMTExMQ==' + 'A' * 16,
+        self.hasher.GetBloomFilterForWordSubsequencesWithIv(
+            self.fieldname, u' ;,.', num_bits=96, rand_gen=_GetRandForTesting))
+
+  def testKeyedHashCache(self):
+    text = u'the quick brown fox jumps over the lazy dog'
+    expected = self.hasher.GetHashesForWordSubsequencesWithIv(
+        self.fieldname, text, random_permute=False, rand_gen=_GetRandForTesting)
+    self.hasher.EnableKeyedHashCache(100)
+    for unused_i in xrange(2):
+      self.assertEqual(expected, self.hasher.GetHashesForWordSubsequencesWithIv(
+          self.fieldname, text, random_permute=False,
+          rand_gen=_GetRandForTesting))
+    # 35 subsequences per call, of which 34 distinct ('the' appears twice).
+    self.assertEqual((36, 34),
+                     self.hasher.GetKeyedHashCacheStats()[self.fieldname])
+    self.hasher.GetHashesForWordSubsequencesWithIv(
+        self.fieldname, text, output_len=16, random_permute=False,
+        rand_gen=_GetRandForTesting)
+    self.assertEqual(
+        70 + 35, sum(self.hasher.GetKeyedHashCacheStats()[self.fieldname]))
+    self.hasher.EnableKeyedHashCache(0)
+    self.assertEqual({}, self.hasher.GetKeyedHashCacheStats())
+
+  def testLruCache(self):
+    cache = ecrypto._LruCache(2)
+    cache.Put('a', 1)
+    cache.Put('b', 2)
+    self.assertEqual(1, cache.Get('a'))
+    cache.Put('c', 3)  # evicts b, the least recently used.
+    self.assertEqual(None, cache.Get('b'))
+    self.assertEqual(1, cache.Get('a'))
+    self.assertEqual(3, cache.Get('c'))
+    self.assertEqual((3, 1), (cache.hits, cache.misses))
+
+
+class CipherSuiteTest(googletest.TestCase):
+
+  def testGetCipherSuiteIsMemoized(self):
+    suite1 = ecrypto.GetCipherSuite(_KEY1, '1')
+    suite2 = ecrypto.GetCipherSuite(_KEY1, '1')
+    self.assertTrue(suite1 is suite2)
+    self.assertFalse(suite1 is ecrypto.GetCipherSuite(_KEY1, '2'))
+    self.assertTrue(suite1.pseudonym_cipher is suite2.pseudonym_cipher)
+
+  def testEnablePseudonymCache(self):
+    suite = ecrypto.CipherSuite(_KEY1, '1')
+    related_cipher = suite.GetRelatedPseudonymCipher(u'123')
+    suite.EnablePseudonymCache(10)
+    suite.pseudonym_cipher.Encrypt(u'abc')
+    related_cipher.Encrypt(u'abc')
+    suite.GetRelatedPseudonymCipher(u'456').Encrypt(u'abc')
+    stats = {'encrypt': (0, 1), 'decrypt': (0, 0)}
+    self.assertEqual({None: stats, '123': stats, '456': stats},
+                     suite.GetPseudonymCacheStats())
+    suite.EnablePseudonymCache(0)
+    self.assertEqual({}, suite.GetPseudonymCacheStats())
+
+  def testHomomorphicCiphersSharePaillier(self):
+    suite = ecrypto.CipherSuite(_KEY1, '1')
+    int_cipher = suite.homomorphic_int_cipher
+    float_cipher = suite.homomorphic_float_cipher
+    self.assertTrue(int_cipher._paillier is suite.paillier)
+    self.assertTrue(float_cipher._paillier is suite.paillier)
+    expected = ecrypto.HomomorphicIntCipher(
+        ecrypto.GenerateHomomorphicCipherKey(_KEY1, '1'))
+    self.assertEqual(expected.nsquare, suite.nsquare)
+    self.assertEqual(5, expected.Decrypt(int_cipher.Encrypt(5)))
+    self.assertEqual(1.5, float_cipher.Decrypt(float_cipher.Encrypt(1.5)))
+
+  def testCiphersMatchDirectlyDerivedCiphers(self):
+    suite = ecrypto.CipherSuite(_KEY1, '1')
+    pseudonym_cipher = ecrypto.PseudonymCipher(
+        ecrypto.GeneratePseudonymCipherKey(_KEY1, '1'))
+    self.assertEqual(pseudonym_cipher.Encrypt(u'abc'),
+                     suite.pseudonym_cipher.Encrypt(u'abc'))
+    related_cipher = ecrypto.PseudonymCipher(
+        ecrypto.GeneratePseudonymCipherKey(_KEY1, '123'))
+    self.assertEqual(related_cipher.Encrypt(u'abc'),
+                     suite.GetRelatedPseudonymCipher(u'123').Encrypt(u'abc'))
+    self.assertTrue(suite.GetRelatedPseudonymCipher(u'123') is
+                    suite.GetRelatedPseudonymCipher('123'))
+    string_hasher = ecrypto.StringHash(
+        ecrypto.GenerateStringHashKey(_KEY1, '1'))
+    self.assertEqual(string_hasher.GetStringKeyHash(u'f', u'abc'),
+                     suite.string_hasher.GetStringKeyHash(u'f', u'abc'))
+
 
 def main(_):
   googletest.main()
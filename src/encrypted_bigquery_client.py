@@ -23,6 +23,7 @@ import bq
 import common_util as util
 import ebq_crypto as ecrypto
 import load_lib
+import metadata_cache
 import query_interpreter as interpreter
 import query_lib
 import query_parser as parser
@@ -30,6 +31,9 @@ import query_parser as parser
 
 FLAGS = flags.FLAGS
 
+# number of ciphertexts of a column decrypted by one --paillier_threads task.
+_DECRYPT_CHUNK_SIZE = 64
+
 
 class EncryptedTablePrinter(bq.TablePrinter):
   """Class encapsulating encrypted table printing for Encrypted BigQuery."""
@@ -116,23 +120,25 @@ class EncryptedBigqueryClient(bigquery_client.BigqueryClient):
           '\nMust specify a local source file, cannot upload '
           'URIs with encryption yet.')
 
-  def _GetTableCreationTime(self, identifier):
+  def _GetObjectInfo(self, identifier):
     reference = super(EncryptedBigqueryClient, self).GetReference(identifier)
     object_info = super(EncryptedBigqueryClient, self).GetObjectInfo(reference)
     if object_info is None:
       raise bigquery_client.BigqueryNotFoundError(
           'Table %s not found.' % identifier, None, None, None)
+    return object_info
+
+  def _GetTableCreationTime(self, identifier, object_info=None):
+    if object_info is None:
+      object_info = self._GetObjectInfo(identifier)
     if 'creationTime' not in object_info:
       raise bigquery_client.BigqueryNotFoundError(
           'Could not gather creation time from table.', None, None, None)
     return object_info['creationTime']
 
-  def _GetEBQTableInfo(self, identifier):
-    reference = super(EncryptedBigqueryClient, self).GetReference(identifier)
-    object_info = super(EncryptedBigqueryClient, self).GetObjectInfo(reference)
+  def _GetEBQTableInfo(self, identifier, object_info=None):
     if object_info is None:
-      raise bigquery_client.BigqueryNotFoundError(
-          'Table %s not found.' % identifier, None, None, None)
+      object_info = self._GetObjectInfo(identifier)
     if 'description' not in object_info:
       raise bigquery_client.BigqueryNotFoundError(
           'Could not get essential EBQ info from description. Only use ebq '
@@ -149,6 +155,68 @@ class EncryptedBigqueryClient(bigquery_client.BigqueryClient):
           None)
     return hashed_key, version_number, schema
 
+  def _GetTableMetadata(self, identifier, master_key, check_unchanged=False):
+    """Returns the creation time and the decrypted schema of a table.
+
+    Both are read from a single lookup of the table. With
+    --table_metadata_cache_dir they are cached: a cached entry is used without
+    any lookup for --table_metadata_cache_ttl seconds, unless check_unchanged,
+    and afterwards for as long as the etag and last modified time of the table
+    do not change.
+
+    Arguments:
+      identifier: str, the table reference.
+      master_key: str, the master key of the table.
+      check_unchanged: bool, always check the cached entry against the table.
+
+    Returns:
+      A tuple of the creation time and the original schema of the table.
+
+    Raises:
+      BigqueryAccessDeniedError: When master_key is not the key of the table.
+      BigqueryNotFoundError: When the table, or its EBQ info, is not found or
+        the table version is invalid.
+    """
+    cache = None
+    entry = None
+    if FLAGS.table_metadata_cache_dir:
+      cache = metadata_cache.TableMetadataCache(
+          FLAGS.table_metadata_cache_dir, master_key,
+          FLAGS.table_metadata_cache_ttl)
+      entry = cache.Get(identifier)
+      if entry is not None and not check_unchanged and cache.IsFresh(entry):
+        return entry['creation_time'], entry['schema']
+    object_info = self._GetObjectInfo(identifier)
+    if entry is None or not metadata_cache.IsUnchanged(entry, object_info):
+      hashed_table_key, table_version, table_schema = self._GetEBQTableInfo(
+          identifier, object_info)
+      entry = {
+          'creation_time': self._GetTableCreationTime(identifier, object_info),
+          'hashed_key': hashed_table_key,
+          'version': table_version,
+          'etag': object_info.get('etag'),
+          'last_modified': object_info.get('lastModifiedTime'),
+      }
+    hashed_master_key = hashlib.sha1(master_key)
+    # pylint: disable=too-many-function-args
+    hashed_master_key = base64.b64encode(hashed_master_key.digest())
+    if hashed_master_key != entry['hashed_key']:
+      raise bigquery_client.BigqueryAccessDeniedError(
+          'Invalid master key for this table.', None, None, None)
+    if entry['version'] != util.EBQ_TABLE_VERSION:
+      raise bigquery_client.BigqueryNotFoundError(
+          'Invalid table version.', None, None, None)
+    if 'schema' not in entry:
+      # TODO(user): Generate a different key.
+      cipher = ecrypto.ProbabilisticCipher(master_key)
+      table_schema = cipher.Decrypt(base64.b64decode(table_schema), raw=True)
+      table_schema = zlib.decompress(table_schema)
+      table_schema = table_schema.decode('utf-8')
+      entry['schema'] = json.loads(table_schema)
+    if cache is not None:
+      cache.Put(identifier, entry)
+    return entry['creation_time'], entry['schema']
+
   def _LoadJobStatistics(self, manifest, job):
     """Load statistics from the bq job into manifest.
 
@@ -217,25 +285,10 @@ class EncryptedBigqueryClient(bigquery_client.BigqueryClient):
     # TODO(user): Put the filepath to the master key in .bigqueryrc file.
     master_key = load_lib.ReadMasterKeyFile(self.master_key_filename, True)
     table_name = str(destination_table).split(':')[-1]
-    table_id = '%s_%s' % (table_name,
-                          self._GetTableCreationTime(str(destination_table)))
-    hashed_table_key, table_version, table_schema = self._GetEBQTableInfo(
-        str(destination_table))
-    hashed_master_key = hashlib.sha1(master_key)
-    # pylint: disable=too-many-function-args
-    hashed_master_key = base64.b64encode(hashed_master_key.digest())
-    if hashed_master_key != hashed_table_key:
-      raise bigquery_client.BigqueryAccessDeniedError(
-          'Invalid master key for this table.', None, None, None)
-    if table_version != util.EBQ_TABLE_VERSION:
-      raise bigquery_client.BigqueryNotFoundError(
-          'Invalid table version.', None, None, None)
-    # TODO(user): Generate a different key.
-    cipher = ecrypto.ProbabilisticCipher(master_key)
-    table_schema = cipher.Decrypt(base64.b64decode(table_schema), raw=True)
-    table_schema = zlib.decompress(table_schema)
-    table_schema = table_schema.decode('utf-8')
-    table_schema = json.loads(table_schema)
+    # the table may just have been created, so a cached entry is checked.
+    creation_time, table_schema = self._GetTableMetadata(
+        str(destination_table), master_key, check_unchanged=True)
+    table_id = '%s_%s' % (table_name, creation_time)
     if table_schema != orig_schema:
       raise bigquery_client.BigqueryAccessDeniedError(
           'Invalid schema for this table.', None, None, None)
@@ -275,23 +328,9 @@ class EncryptedBigqueryClient(bigquery_client.BigqueryClient):
     except ParseException as e:
       raise bigquery_client.BigqueryInvalidQueryError(e, None, None, None)
     if clauses['FROM']:
-      table_id = '%s_%s' % (clauses['FROM'][0],
-                            self._GetTableCreationTime(clauses['FROM'][0]))
-      hashed_table_key, table_version, table_schema = self._GetEBQTableInfo(
-          clauses['FROM'][0])
-      hashed_master_key = hashlib.sha1(master_key)
-      # pylint: disable=too-many-function-args
-      hashed_master_key = base64.b64encode(hashed_master_key.digest())
-      if hashed_master_key != hashed_table_key:
-        raise bigquery_client.BigqueryAccessDeniedError(
-            'Invalid master key for this table.', None, None, None)
-      if table_version != util.EBQ_TABLE_VERSION:
-        raise bigquery_client.BigqueryNotFoundError(
-            'Invalid table version.', None, None, None)
-      cipher = ecrypto.ProbabilisticCipher(master_key)
-      orig_schema = zlib.decompress(
-          cipher.Decrypt(base64.b64decode(table_schema), raw=True))
-      orig_schema = json.loads(orig_schema.decode('utf-8'))
+      creation_time, orig_schema = self._GetTableMetadata(
+          clauses['FROM'][0], master_key)
+      table_id = '%s_%s' % (clauses['FROM'][0], creation_time)
     else:
       table_id = None
       orig_schema = []
@@ -349,6 +388,10 @@ class EncryptedBigqueryClient(bigquery_client.BigqueryClient):
 
     super(EncryptedBigqueryClient, self).UpdateTable(
         reference, schema, description, friendly_name, expiration)
+    if description and schema and FLAGS.table_metadata_cache_dir:
+      metadata_cache.TableMetadataCache(
+          FLAGS.table_metadata_cache_dir, master_key,
+          FLAGS.table_metadata_cache_ttl).Remove(str(reference))
 
   def CreateTable(self, reference, ignore_existing=False, schema=None,
                   description=None, friendly_name=None, expiration=None):
@@ -390,6 +433,29 @@ class EncryptedBigqueryClient(bigquery_client.BigqueryClient):
         reference, ignore_existing, new_schema, new_description, friendly_name,
         expiration)
 
+  def FillRandomizerBank(self, reference, count):
+    """Precomputes Paillier randomizers for later loads into a table.
+
+    Arguments:
+      reference: the TableReference of the table loads will go into.
+      count: number of randomizers to append to --paillier_randomizer_bank.
+
+    Raises:
+      UsageError: if --paillier_randomizer_bank is not given.
+    """
+    self._CheckKeyfileFlag()
+    if not FLAGS.paillier_randomizer_bank:
+      raise app.UsageError(
+          'Must specify --paillier_randomizer_bank, the file to add '
+          'randomizers to.')
+    master_key = load_lib.ReadMasterKeyFile(self.master_key_filename)
+    # the same table id as Load uses, since the bank is encrypted for it.
+    table_name = str(reference).split(':')[-1]
+    creation_time, _ = self._GetTableMetadata(str(reference), master_key)
+    table_id = '%s_%s' % (table_name, creation_time)
+    load_lib.FillRandomizerBank(
+        master_key, table_id, FLAGS.paillier_randomizer_bank, count)
+
 
 def _DecryptRows(fields, rows, master_key, table_id, schema, query_list,
                  aggregation_query_list, unencrypted_query_list,
@@ -413,23 +479,29 @@ def _DecryptRows(fields, rows, master_key, table_id, schema, query_list,
     bigquery_client.BigqueryInvalidQueryError: User trying to query for a
     SEARCHWORD encrypted field. SEARCHWORD encrypted fields cannot be decrypted.
   """
-  # create ciphers for decryption
-  prob_cipher = ecrypto.ProbabilisticCipher(
-      ecrypto.GenerateProbabilisticCipherKey(master_key, table_id))
-  pseudonym_cipher = ecrypto.PseudonymCipher(
-      ecrypto.GeneratePseudonymCipherKey(master_key, table_id))
-  homomorphic_int_cipher = ecrypto.HomomorphicIntCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id))
-  homomorphic_float_cipher = ecrypto.HomomorphicFloatCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id))
-
+  # get ciphers for decryption, these are shared with the query rewriting.
+  cipher_suite = ecrypto.GetCipherSuite(master_key, table_id)
   ciphers = {
-      util.PROBABILISTIC_PREFIX: prob_cipher,
-      util.PSEUDONYM_PREFIX: pseudonym_cipher,
-      util.HOMOMORPHIC_INT_PREFIX: homomorphic_int_cipher,
-      util.HOMOMORPHIC_FLOAT_PREFIX: homomorphic_float_cipher,
+      util.PROBABILISTIC_PREFIX: cipher_suite.probabilistic_cipher,
+      util.PSEUDONYM_PREFIX: cipher_suite.pseudonym_cipher,
+      util.HOMOMORPHIC_INT_PREFIX: cipher_suite.homomorphic_int_cipher,
+      util.HOMOMORPHIC_FLOAT_PREFIX: cipher_suite.homomorphic_float_cipher,
   }
-
+  # repeated pseudonyms of the result are decrypted once. The cipher suite is
+  # shared by the whole process, so the cache only lives for this result.
+  cipher_suite.EnablePseudonymCache(FLAGS.pseudonym_cache_size)
+  try:
+    return _DecryptRowsWithCiphers(
+        fields, rows, ciphers, schema, query_list, aggregation_query_list,
+        unencrypted_query_list, manifest)
+  finally:
+    cipher_suite.EnablePseudonymCache(0)
+
+
+def _DecryptRowsWithCiphers(fields, rows, ciphers, schema, query_list,
+                            aggregation_query_list, unencrypted_query_list,
+                            manifest):
+  """Decrypts all values in rows with ciphers, keyed by field prefix."""
   queried_values = {}
   for query in query_list:
     if len(query.split(' ')) >= 3 and query.split(' ')[-2] == 'AS':
@@ -475,6 +547,9 @@ def _DecryptRows(fields, rows, master_key, table_id, schema, query_list,
           'Cannot decrypt searchwords encryption. Decryption of SEARCHWORDS '
           'is limited to PROBABILISTIC_SEARCHWORDS encryption.', None, None,
           None)
+    elif encrypted_name.startswith(util.HOMOMORPHIC_PACKED_INT_PREFIX):
+      queried_values[fields[i]['name']] = (
+          _DecryptPackedValues(rows, i, ciphers))
     elif encrypted_name.startswith(util.HOMOMORPHIC_INT_PREFIX):
       queried_values[fields[i]['name']] = (
           _DecryptValues(fields[i]['name'], rows, i, ciphers, schema,
@@ -544,7 +619,10 @@ def _DecryptRows(fields, rows, master_key, table_id, schema, query_list,
         real_fieldname = original_fieldname.split(
             util.PAILLIER_SUM_PREFIX)[1]
         real_fieldname = real_fieldname.split(',')[0][:-1]
-        if sum_argument.startswith(util.HOMOMORPHIC_INT_PREFIX):
+        if sum_argument.startswith(util.HOMOMORPHIC_PACKED_INT_PREFIX):
+          queried_values[original_fieldname] = (
+              _DecryptPackedValues(rows, i, ciphers))
+        elif sum_argument.startswith(util.HOMOMORPHIC_INT_PREFIX):
           queried_values[original_fieldname] = (
               _DecryptValues(real_fieldname, rows, i, ciphers, schema,
                              util.HOMOMORPHIC_INT_PREFIX))
@@ -570,13 +648,17 @@ def _DecryptValues(field, table, column_index, ciphers, schema, prefix):
   if value_type not in ['string', 'integer', 'float']:
     raise ValueError('Not an known type.')
   cipher = ciphers[prefix]
+  # decrypt all non null values of the column in one batch.
+  non_null_rows = [i for i in range(len(table))
+                   if table[i][column_index] is not None]
+  decrypted_values = dict(zip(non_null_rows, _DecryptColumn(
+      cipher, [table[i][column_index].encode('utf-8') for i in non_null_rows])))
   decrypted_column = []
   for i in range(len(table)):
     if table[i][column_index] is None:
       decrypted_value = util.LiteralToken('null', None)
     else:
-      decrypted_value = unicode(
-          cipher.Decrypt(table[i][column_index].encode('utf-8'))).strip()
+      decrypted_value = unicode(decrypted_values[i]).strip()
       if value_type == 'string':
         decrypted_value = util.StringLiteralToken('"%s"' % decrypted_value)
       elif value_type == 'integer':
@@ -587,6 +669,41 @@ def _DecryptValues(field, table, column_index, ciphers, schema, prefix):
   return decrypted_column
 
 
+def _DecryptColumn(cipher, ciphertexts):
+  """Decrypts ciphertexts in chunks, spread over --paillier_threads threads."""
+  chunks = [ciphertexts[i:i + _DECRYPT_CHUNK_SIZE]
+            for i in xrange(0, len(ciphertexts), _DECRYPT_CHUNK_SIZE)]
+  decrypted_values = []
+  for decrypted_chunk in util.OrderedThreadMap(
+      cipher.DecryptColumn, chunks, FLAGS.paillier_threads):
+    decrypted_values.extend(decrypted_chunk)
+  return decrypted_values
+
+
+def _DecryptPackedValues(table, column_index, ciphers):
+  """Decrypts a packed homomorphic integer column.
+
+  Arguments:
+    table: Table values.
+    column_index: Index of the packed column in each row.
+    ciphers: Ciphers by field prefix.
+
+  Returns:
+    For each row, either a null literal or the list of int64s decrypted from
+    the packed ciphertext; the lanes are selected by _ComputeRows.
+  """
+  cipher = ciphers[util.HOMOMORPHIC_INT_PREFIX]
+
+  def DecryptValue(value):
+    if value is None:
+      return util.LiteralToken('null', None)
+    return cipher.DecryptMultiple(value.encode('utf-8'))
+
+  return list(util.OrderedThreadMap(
+      DecryptValue, [row[column_index] for row in table],
+      FLAGS.paillier_threads))
+
+
 def _GetUnencryptedValuesWithType(table, column_index, value_type):
   if (value_type is None or
       value_type.lower() not in ['string', 'integer', 'float']):
@@ -632,15 +749,19 @@ def _DecryptGroupConcatValues(field, table, column_index, ciphers, schema,
     raise bigquery_client.BigqueryInvalidQueryError(
         'Cannot GROUP_CONCAT non-string type.', None, None, None)
   cipher = ciphers[prefix]
+  # decrypt the words of all non null values of the column in one batch.
+  rows_words = [None if row[column_index] is None
+                else row[column_index].encode('utf-8').split(',')
+                for row in table]
+  decrypted_words = iter(_DecryptColumn(
+      cipher, [word for words in rows_words if words is not None
+               for word in words]))
   decrypted_column = []
-  for i in range(len(table)):
-    if table[i][column_index] is None:
+  for words in rows_words:
+    if words is None:
       decrypted_column.append(util.LiteralToken('null', None))
       continue
-    list_words = table[i][column_index].split(',')
-    for k in range(len(list_words)):
-      list_words[k] = unicode(cipher.Decrypt(
-          list_words[k].encode('utf-8'))).strip()
+    list_words = [unicode(next(decrypted_words)).strip() for _ in words]
     decrypted_column.append(
         util.StringLiteralToken('"%s"' % ','.join(list_words)))
   return decrypted_column
@@ -718,7 +839,12 @@ def _ComputeRows(new_postfix_stack, queried_values, manifest=None):
             raise bigquery_client.BigqueryInvalidQueryError(
                 'Required %s column does not exist.' % temp_stack[k],
                 None, None, None)
-          temp_stack[k] = queried_values[k_use][i]
+          value = queried_values[k_use][i]
+          # packed columns hold a list with one value per packed field.
+          lane = getattr(temp_stack[k], 'lane', None)
+          if lane is not None and isinstance(value, list):
+            value = value[lane]
+          temp_stack[k] = value
       ans = interpreter.Evaluate(temp_stack)
       if ans is None:
         ans = 'NULL'
@@ -5,8 +5,15 @@
 
 
 
+import base64
 from copy import deepcopy
+import hashlib
+import json
+import os
 import random
+import shutil
+import tempfile
+import zlib
 
 import mox
 import stubout
@@ -66,6 +73,19 @@ class EncryptedBigqueryClientTest(googletest.TestCase):
     result = encrypted_bigquery_client._ComputeRows(stack, query)
     self.assertEqual(result, real_result)
 
+  def testComputeRowsWithPackedLanes(self):
+    # Query is 'SELECT a, b' where a and b share one packed ciphertext; each
+    # queried value is the full list of lanes decrypted from that ciphertext.
+    packed_a = util.FieldToken('p')
+    packed_a.lane = -2
+    packed_b = util.FieldToken('p')
+    packed_b.lane = -1
+    stack = [[packed_a], [packed_b]]
+    query = {'p': [[0, 1, 2], [0, 3, 4]]}
+    real_result = [['1', '2'], ['3', '4']]
+    result = encrypted_bigquery_client._ComputeRows(stack, query)
+    self.assertEqual(result, real_result)
+
   def testComputeRowsWithTableNoManifest(self):
     """Test _ComputeRows() with a query that returns simple row values."""
     # Query is
@@ -216,6 +236,29 @@ class EncryptedBigqueryClientTest(googletest.TestCase):
                       field, table, 1, ciphers, cars_schema,
                       util.HOMOMORPHIC_FLOAT_PREFIX)
 
+  def testDecryptRowsScopesPseudonymCache(self):
+    """Test _DecryptRows() only caches pseudonyms while decrypting."""
+    jobs_schema = test_util.GetJobsSchema()
+    master_key = test_util.GetMasterKey()
+    field = 'citiesLived.job.%sposition' % util.PSEUDONYM_PREFIX
+    cipher_suite = ecrypto.GetCipherSuite(master_key, 'jobs_1')
+    enabled = []
+
+    def _EnablePseudonymCache(max_size):
+      enabled.append(max_size)
+
+    self.stubs.Set(encrypted_bigquery_client.FLAGS, 'pseudonym_cache_size',
+                   10)
+    self.stubs.Set(cipher_suite, 'EnablePseudonymCache', _EnablePseudonymCache)
+    table = self._EncryptTable(cipher_suite.pseudonym_cipher,
+                               [[u'Hello'], [u'Hello']], 0)
+    queried_values = encrypted_bigquery_client._DecryptRows(
+        [{'name': field, 'type': 'STRING'}], table, master_key, 'jobs_1',
+        jobs_schema, [field], [], [])
+    self.assertEqual([util.StringLiteralToken('"Hello"')] * 2,
+                     queried_values[field])
+    self.assertEqual([10, 0], enabled)
+
   def testGetUnencryptedValues(self):
     table = [[1], [2], [3], [None]]
     column = encrypted_bigquery_client._GetUnencryptedValuesWithType(
@@ -373,6 +416,107 @@ class EncryptedBigqueryClientTest(googletest.TestCase):
         expiration=in_expiration)
     self.mox.VerifyAll()
 
+  def testGetTableMetadata(self):
+    """Test _GetTableMetadata() with the metadata cache."""
+
+    ebc_module = encrypted_bigquery_client
+
+    class SimpleTestEBC(ebc_module.EncryptedBigqueryClient):
+      """Class with simpler __init__, rather than lots of mox."""
+
+      def __init__(self, **kwds):
+        """Intentionally do not call parent __init__()."""
+
+    master_key = '0123456789abcdef'
+    hashed_key = base64.b64encode(hashlib.sha1(master_key).digest())
+    schema = [{'name': 'Year', 'type': 'integer', 'encrypt': 'none'}]
+    encrypted_schema = base64.b64encode(
+        ecrypto.ProbabilisticCipher(master_key).Encrypt(
+            zlib.compress(json.dumps(schema))))
+    object_info = {
+        'creationTime': '1400000000000',
+        'etag': 'etag1',
+        'lastModifiedTime': '1400000000001',
+        'description': util.ConstructTableDescription(
+            '', hashed_key, util.EBQ_TABLE_VERSION, encrypted_schema),
+    }
+    cache_dir = tempfile.mkdtemp()
+    mock_get_reference = self.mox.CreateMockAnything()
+    mock_get_object_info = self.mox.CreateMockAnything()
+    self.stubs.Set(ebc_module.FLAGS, 'table_metadata_cache_dir', cache_dir)
+    self.stubs.Set(ebc_module.FLAGS, 'table_metadata_cache_ttl', 300)
+    self.stubs.Set(
+        ebc_module.bigquery_client.BigqueryClient, 'GetReference',
+        mock_get_reference)
+    self.stubs.Set(
+        ebc_module.bigquery_client.BigqueryClient, 'GetObjectInfo',
+        mock_get_object_info)
+
+    # the first lookup reads the table once.
+    mock_get_reference('dataset.cars').AndReturn('reference')
+    mock_get_object_info('reference').AndReturn(object_info)
+    # check_unchanged reads the table again.
+    mock_get_reference('dataset.cars').AndReturn('reference')
+    mock_get_object_info('reference').AndReturn(object_info)
+    # the entry cached under master_key is not visible to other keys.
+    mock_get_reference('dataset.cars').AndReturn('reference')
+    mock_get_object_info('reference').AndReturn(object_info)
+
+    self.mox.ReplayAll()
+    ebc = SimpleTestEBC()
+    expected = ('1400000000000', schema)
+    self.assertEqual(expected, ebc._GetTableMetadata('dataset.cars',
+                                                     master_key))
+    # a fresh entry is used without reading the table.
+    self.assertEqual(expected, ebc._GetTableMetadata('dataset.cars',
+                                                     master_key))
+    self.assertEqual(expected, ebc._GetTableMetadata(
+        'dataset.cars', master_key, check_unchanged=True))
+    self.assertRaises(bigquery_client.BigqueryAccessDeniedError,
+                      ebc._GetTableMetadata, 'dataset.cars',
+                      'fedcba9876543210')
+    self.mox.VerifyAll()
+    shutil.rmtree(cache_dir)
+
+  def testFillRandomizerBank(self):
+    """Test FillRandomizerBank() fills the bank Load of the table reads."""
+
+    ebc_module = encrypted_bigquery_client
+
+    class SimpleTestEBC(ebc_module.EncryptedBigqueryClient):
+      """Class with simpler __init__, rather than lots of mox."""
+
+      def __init__(self, **kwds):
+        """Intentionally do not call parent __init__()."""
+
+    master_key = '0123456789abcdef'
+    key_dir = tempfile.mkdtemp()
+    key_file = os.path.join(key_dir, 'key')
+    with open(key_file, 'wb') as f:
+      f.write(base64.b64encode(master_key))
+    mock_get_table_metadata = self.mox.CreateMockAnything()
+    mock_fill_randomizer_bank = self.mox.CreateMockAnything()
+    self.stubs.Set(SimpleTestEBC, '_GetTableMetadata',
+                   mock_get_table_metadata)
+    self.stubs.Set(ebc_module.load_lib, 'FillRandomizerBank',
+                   mock_fill_randomizer_bank)
+    self.stubs.Set(ebc_module.FLAGS, 'paillier_randomizer_bank', None)
+
+    mock_get_table_metadata('project:dataset.cars', master_key).AndReturn(
+        ('1400000000000', []))
+    mock_fill_randomizer_bank(
+        master_key, 'dataset.cars_1400000000000', 'bank', 5)
+
+    self.mox.ReplayAll()
+    ebc = SimpleTestEBC()
+    ebc.master_key_filename = key_file
+    self.assertRaises(app.UsageError, ebc.FillRandomizerBank,
+                      'project:dataset.cars', 5)
+    self.stubs.Set(ebc_module.FLAGS, 'paillier_randomizer_bank', 'bank')
+    ebc.FillRandomizerBank('project:dataset.cars', 5)
+    self.mox.VerifyAll()
+    shutil.rmtree(key_dir)
+
 
 class EncryptedTablePrinterTest(googletest.TestCase):
   """Test the EncryptedTablePrinter class."""
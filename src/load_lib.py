@@ -15,20 +15,28 @@ and what kind of encryption to use. The possible encryption types are:
   4)"probabilistic_searchwords" - instead of replacing the field data with word
   sequence hashes, it both a) probabilistically encrypts the field and b)
   appends another field to enable wordsearch over private data.
-  5)"homomorphic" - encryption (i.e. paillier) of integers and floats that allow
+  5)"searchwords_bloom" - like "searchwords", but the hashes of the word
+  sequences set bits of a fixed size bloom filter instead of being listed,
+  trading a false positive rate for smaller fields.
+  6)"homomorphic" - encryption (i.e. paillier) of integers and floats that allow
   the server to sum over plaintexts by operating on ciphertexts.
-  6)"none".
+  7)"none".
 """
 
 
 
 import base64
+import contextlib
 from copy import deepcopy
 import csv
+import functools
 import json
+import multiprocessing
 import os
 import re
+import tempfile
 
+from google.apputils import app
 import gflags as flags
 import logging
 
@@ -36,6 +44,13 @@ import bigquery_client
 import common_crypto as ccrypto
 import common_util as util
 import ebq_crypto as ecrypto
+import paillier as pcrypto
+
+try:
+  # simplejson is a faster, compatible, implementation of the json module.
+  import simplejson as _json_codec  # pylint: disable=g-import-not-at-top
+except ImportError:
+  _json_codec = json
 
 
 FLAGS = flags.FLAGS
@@ -61,9 +76,65 @@ flags.DEFINE_string('encrypted_table_data_file', None,
                     'creates the name using table_data_file by replacing '
                     '.data suffix with .enc_data or else adding it if .data '
                     'is not present.')
+flags.DEFINE_integer('paillier_randomizer_pool_size', 0,
+                     'Number of Paillier randomizers to precompute in '
+                     'background threads while loading homomorphic columns. '
+                     '0 disables the pool.')
+flags.DEFINE_integer('paillier_threads', 0,
+                     'Number of threads doing Paillier encryption and '
+                     'decryption of homomorphic columns, in parallel since '
+                     'OpenSSL releases the GIL. 0 does them in the main '
+                     'thread.')
+flags.DEFINE_integer('load_workers', 0,
+                     'Number of processes encrypting a csv data file, each '
+                     'converting chunks of rows. Encrypted rows are written '
+                     'in input order. 0 or 1 converts in this process. '
+                     'Cannot be combined with the Paillier randomizer pool.')
+flags.DEFINE_integer('searchwords_cache_size', 0,
+                     'Number of searchwords keyed hashes memoized per field '
+                     'while loading, the least recently used are evicted '
+                     'first. Only worth it for very repetitive text, since '
+                     'keyed hashes are computed incrementally. 0 disables the '
+                     'cache.')
+flags.DEFINE_integer('pseudonym_cache_size', 0,
+                     'Number of values whose pseudonym encryption, and '
+                     'decryption, is memoized per pseudonym key while loading '
+                     'and decrypting query results; the least recently used '
+                     'are evicted first. Worth it when pseudonym columns '
+                     'repeat a few values. 0 disables the cache.')
+flags.DEFINE_string('paillier_randomizer_bank', None,
+                    'The path of an encrypted file of precomputed Paillier '
+                    'randomizers. It is consumed, and then deleted, by the '
+                    'next load that uses the randomizer pool.')
 
 
 NONE = 'none'  # frequently used in JSON schema files
+_SEARCHWORDS_ENCRYPT_TYPES = ['searchwords', 'probabilistic_searchwords',
+                              'searchwords_bloom']
+
+# Per the BigQuery documentation these timestamp formats are valid:
+# 2014-08-19 07:41:35.220 -05:00
+# 2014-08-19 12:41:35.220 UTC
+# 2014-08-19 12:41:35.220
+# 2014-08-19 12:41:35.220000
+# 2014-08-19T12:41:35.220Z
+# 1969-07-20 20:18:04
+# 1969-07-20 20:18:04 UTC
+# 1969-07-20T20:18:04
+_TIMESTAMP_RE = re.compile(
+    r'^(?P<YMD>\d{4}-\d{2}-\d{2})[T ](?P<HMS>\d{2}:\d{2}:\d{2})'
+    r'(?P<FRACTS>\.\d{1,6})?'
+    r'((?P<ZULU>Z)|'
+    r'\s(?P<UTC>)|'
+    r'\s(?P<TZOFFSET>[\+\-]\d{2}:\d{2})|'
+    r'\s(?P<TZ>[A-Z]{3})|'
+    r')$'
+)
+
+# number of csv rows whose homomorphic columns are encrypted in one batch.
+_CSV_BATCH_ROWS = 256
+# number of json lines being converted ahead of the one being written.
+_JSON_LINES_IN_FLIGHT = 256
 
 
 class EncryptConvertError(Exception):
@@ -179,13 +250,14 @@ def ReadSchemaFile(filepath):
     return schema
 
 
-def _ValidateExtendedSchema(schema):
+def _ValidateExtendedSchema(schema, nested=False):
   """Validates extended bigquery table schema.
 
   Does some basic checks to catch errors in extended table schema. It
   checks that an 'encrypt' subfield is entered for each field.
   Args:
     schema: extended bigquery table schema.
+    nested: whether schema holds the fields of a record.
   Raises:
     EncryptConvertError: when schema contains unexpected types.
   """
@@ -218,9 +290,9 @@ def _ValidateExtendedSchema(schema):
         continue
       elif (key == 'encrypt' and column[key].lower() in
             [NONE, 'probabilistic', 'pseudonym', 'searchwords',
-             'probabilistic_searchwords', 'homomorphic']):
-        if (column['encrypt'].lower() in
-            ['searchwords', 'probabilistic_searchwords'] and
+             'probabilistic_searchwords', 'searchwords_bloom',
+             'homomorphic']):
+        if (column['encrypt'].lower() in _SEARCHWORDS_ENCRYPT_TYPES and
             column['type'] != 'string'):
           raise EncryptConvertError('%s needs to be string type in column %s.'
                                     % (column['encrypt'], column))
@@ -237,21 +309,56 @@ def _ValidateExtendedSchema(schema):
       elif (key == 'searchwords_separator' and
             isinstance(column[key], unicode) and
             column[key] and column['encrypt'].lower()
-            in ['searchwords', 'probabilistic_searchwords']):
+            in _SEARCHWORDS_ENCRYPT_TYPES):
         continue
       elif (key == 'max_word_sequence' and
             isinstance(column[key], int) and
             column['encrypt'].lower()
-            in ['searchwords', 'probabilistic_searchwords']):
+            in _SEARCHWORDS_ENCRYPT_TYPES):
+        continue
+      elif (key == 'searchwords_bloom_bits' and
+            isinstance(column[key], int) and
+            column['encrypt'].lower() == 'searchwords_bloom'):
+        if (column[key] <= 0 or column[key] % 6 or
+            column[key] > ecrypto.SEARCHWORDS_BLOOM_MAX_BITS):
+          raise EncryptConvertError(
+              '%s needs to be a positive multiple of 6 of at most %d in '
+              'column %s.' % (key, ecrypto.SEARCHWORDS_BLOOM_MAX_BITS, column))
+        continue
+      elif (key == 'searchwords_bloom_hashes' and
+            isinstance(column[key], int) and
+            column['encrypt'].lower() == 'searchwords_bloom'):
+        if not 0 < column[key] <= ecrypto.SEARCHWORDS_BLOOM_MAX_HASHES:
+          raise EncryptConvertError(
+              '%s needs to be between 1 and %d in column %s.'
+              % (key, ecrypto.SEARCHWORDS_BLOOM_MAX_HASHES, column))
+        continue
+      elif (key == 'packing_group' and isinstance(column[key], unicode) and
+            column[key]):
+        if (column.get('encrypt', NONE).lower() != 'homomorphic' or
+            column['type'].lower() != 'integer'):
+          raise EncryptConvertError('%s needs homomorphic integer column %s.'
+                                    % (key, column))
+        if column.get('mode', 'required').lower() != 'required':
+          raise EncryptConvertError('%s needs required mode in column %s.'
+                                    % (key, column))
+        if nested:
+          raise EncryptConvertError('%s is not supported inside records: %s.'
+                                    % (key, column))
         continue
       elif (key == 'fields' and column['type'].lower() == 'record' and
             isinstance(column[key], list)):
-        _ValidateExtendedSchema(column[key])
+        _ValidateExtendedSchema(column[key], nested=True)
         continue
       else:
         error_string = ('Unexpected field key: %s, or unexpected field '
                         'value: %s' % (key, column[key]))
         raise EncryptConvertError(error_string)
+  for group, names in util.GetPackingGroups(schema).iteritems():
+    if len(names) > pcrypto.PACKING_LIMIT:
+      raise EncryptConvertError('At most %d columns can be packed together, '
+                                'but packing group %s has %d.'
+                                % (pcrypto.PACKING_LIMIT, group, len(names)))
 
 
 def RewriteSchema(schema):
@@ -300,6 +407,13 @@ def _RewriteField(field, schema):
     schema: the new schema that is going to contain the rewritten fields
   """
 
+  if 'packing_group' in field:
+    # all fields of a packing group share one column, added by the first one.
+    packed_name = util.HOMOMORPHIC_PACKED_INT_PREFIX + field['packing_group']
+    if packed_name not in [f['name'] for f in schema]:
+      schema.append({'name': packed_name, 'type': 'string',
+                     'mode': field['mode']})
+    return
   new_field = deepcopy(field)
   # a separate count for new_schema since may insert field due to
   # probabilistic_searchwords mode for encrypt.
@@ -325,6 +439,14 @@ def _RewriteField(field, schema):
       del new_field['searchwords_separator']
     if 'max_word_sequence' in new_field:
       del new_field['max_word_sequence']
+  elif field['encrypt'] == 'searchwords_bloom':
+    new_field['name'] = util.SEARCHWORDS_BLOOM_PREFIX + field['name']
+    new_field['type'] = 'string'
+    del new_field['encrypt']
+    for key in ['searchwords_separator', 'max_word_sequence',
+                'searchwords_bloom_bits', 'searchwords_bloom_hashes']:
+      if key in new_field:
+        del new_field[key]
   elif (field['encrypt'] == 'homomorphic' and
         field['type'] == 'integer'):
     new_field['name'] = util.HOMOMORPHIC_INT_PREFIX + field['name']
@@ -348,13 +470,13 @@ def _RewriteField(field, schema):
   schema.append(new_field)
 
 
-def _GenerateRelatedCiphers(schema, master_key, default_cipher):
+def _GenerateRelatedCiphers(schema, cipher_suite):
   """Reads schema for pseudonym encrypt types and adds generating ciphers.
 
   Args:
     schema: list of dict, the db schema. modified by
-    master_key: str, the master key
-    default_cipher: obj, cipher that encrypt() can be called on.
+    cipher_suite: ecrypto.CipherSuite, provides the table's default pseudonym
+      cipher and the related pseudonym ciphers.
   Returns:
     dict, mapping field names to index in schema.
   """
@@ -365,86 +487,319 @@ def _GenerateRelatedCiphers(schema, master_key, default_cipher):
     if schema[i].get('encrypt', None) == 'pseudonym':
       related = schema[i].get('related', None)
       if related is not None:
-        pseudonym_cipher_related = ecrypto.PseudonymCipher(
-            ecrypto.GeneratePseudonymCipherKey(
-                master_key, str(related).encode('utf-8')))
-        schema[i]['cipher'] = pseudonym_cipher_related
+        schema[i]['cipher'] = cipher_suite.GetRelatedPseudonymCipher(related)
       else:
-        schema[i]['cipher'] = default_cipher
+        schema[i]['cipher'] = cipher_suite.pseudonym_cipher
   return map_name_to_index
 
 
+@contextlib.contextmanager
+def _CommittedOutput(outfile):
+  """Yields a temporary file which replaces outfile if the block succeeds.
+
+  Args:
+    outfile: str, path of the file to write.
+  Yields:
+    file object opened for binary writing, in the directory of outfile.
+  """
+  fd, temp_path = tempfile.mkstemp(
+      prefix=os.path.basename(outfile) + '.', suffix='.tmp',
+      dir=os.path.dirname(os.path.abspath(outfile)))
+  committed = False
+  try:
+    with os.fdopen(fd, 'wb') as out_file:
+      yield out_file
+    if os.name == 'nt' and os.path.exists(outfile):
+      # rename does not replace an existing file on Windows, so outfile is
+      # only replaced atomically on POSIX.
+      os.remove(outfile)
+    os.rename(temp_path, outfile)
+    committed = True
+  finally:
+    if not committed:
+      os.remove(temp_path)
+
+
+@contextlib.contextmanager
+def _ConversionCaches(cipher_suite):
+  """Memoizes searchwords keyed hashes and pseudonyms for a load."""
+  string_hasher = cipher_suite.string_hasher
+  string_hasher.EnableKeyedHashCache(FLAGS.searchwords_cache_size)
+  cipher_suite.EnablePseudonymCache(FLAGS.pseudonym_cache_size)
+  try:
+    yield
+  finally:
+    _LogCacheStats([_GetCacheStats(cipher_suite)])
+    string_hasher.EnableKeyedHashCache(0)
+    cipher_suite.EnablePseudonymCache(0)
+
+
+def _GetCacheStats(cipher_suite):
+  """Returns the searchwords and pseudonym encryption cache stats of a load.
+
+  Returns:
+    tuple of a dict of field name to keyed hash cache (hits, misses), and a
+    dict of related tag, None for the table key, to pseudonym encryption cache
+    (hits, misses).
+  """
+  pseudonym_stats = dict(
+      (related, cipher_stats['encrypt']) for related, cipher_stats
+      in cipher_suite.GetPseudonymCacheStats().iteritems())
+  return cipher_suite.string_hasher.GetKeyedHashCacheStats(), pseudonym_stats
+
+
+def _LogCacheStats(stats_list):
+  """Logs the sum of cache stats, as returned by _GetCacheStats."""
+  for i, message in enumerate([
+      'Searchwords keyed hash cache of %s: %d hits, %d misses (%.1f%% hit '
+      'rate).',
+      'Pseudonym cache of %s: %d hits, %d misses (%.1f%% hit rate).']):
+    totals = {}
+    for stats in stats_list:
+      for name, (hits, misses) in stats[i].iteritems():
+        total_hits, total_misses = totals.get(name, (0, 0))
+        totals[name] = (total_hits + hits, total_misses + misses)
+    for name, (hits, misses) in sorted(totals.iteritems()):
+      logging.info(message, name or 'the table key', hits, misses,
+                   100.0 * hits / max(hits + misses, 1))
+
+
+@contextlib.contextmanager
+def _RandomizerPool(cipher_suite, master_key, table_id):
+  """Precomputes Paillier randomizers for the duration of a load, if enabled."""
+  if FLAGS.paillier_randomizer_pool_size <= 0:
+    yield
+    return
+  pool = pcrypto.RandomizerPool(
+      cipher_suite.paillier,
+      high_water_mark=FLAGS.paillier_randomizer_pool_size)
+  bank = FLAGS.paillier_randomizer_bank
+  if bank and os.path.exists(bank):
+    try:
+      loaded = pool.LoadBank(
+          bank, ecrypto.GenerateRandomizerBankKey(master_key, table_id))
+      logging.info('Loaded %d randomizers from %s.', loaded, bank)
+    except ValueError as e:
+      logging.warning('Skipping randomizer bank: %s', e)
+  pool.Start()
+  cipher_suite.paillier.SetRandomizerPool(pool)
+  try:
+    yield
+  finally:
+    cipher_suite.paillier.SetRandomizerPool(None)
+    pool.Stop()
+
+
+def FillRandomizerBank(master_key, table_id, filepath, count):
+  """Appends count precomputed Paillier randomizers to a randomizer bank.
+
+  The bank is consumed by the next load into table_id that is run with
+  --paillier_randomizer_bank=filepath and the randomizer pool enabled.
+  """
+  if count < 1:
+    raise ValueError('count has to be positive.')
+  cipher_suite = ecrypto.GetCipherSuite(master_key, table_id)
+  pool = pcrypto.RandomizerPool(cipher_suite.paillier)
+  pool.FillBank(filepath,
+                ecrypto.GenerateRandomizerBankKey(master_key, table_id), count)
+
+
 def ConvertCsvDataFile(schema, master_key, table_id, infile, outfile):
-  """Reads utf8 csv data, encrypts and stores into a new csv utf8 data file."""
-  prob_cipher = ecrypto.ProbabilisticCipher(
-      ecrypto.GenerateProbabilisticCipherKey(master_key, table_id))
-  pseudonym_cipher = ecrypto.PseudonymCipher(
-      ecrypto.GeneratePseudonymCipherKey(master_key, table_id))
-  # TODO(user): ciphers and hash should not use the same key.
-  string_hasher = ecrypto.StringHash(
-      ecrypto.GenerateStringHashKey(master_key, table_id))
-  homomorphic_int_cipher = ecrypto.HomomorphicIntCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id))
-  homomorphic_float_cipher = ecrypto.HomomorphicFloatCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id))
-
-  with open(infile, 'rb') as in_file:
-    with open(outfile, 'wb') as out_file:
-      num_columns = len(schema)
-      csv_writer = csv.writer(out_file)
-      _ValidateCsvDataFile(schema, infile)
-      _GenerateRelatedCiphers(schema, master_key, pseudonym_cipher)
-      csv_reader = _Utf8CsvReader(in_file, csv_writer)
-      for row in csv_reader:
-        new_row = []
-        if len(row) != num_columns:
-          raise EncryptConvertError('Number of fields in schema do not match '
-                                    'in row: %s' % row)
-        for i in xrange(num_columns):
-          encrypt_mode = schema[i]['encrypt']
-          if encrypt_mode == NONE:
-            new_row.append(row[i].encode('utf-8'))
-          elif encrypt_mode == 'probabilistic':
-            new_row.append(
-                prob_cipher.Encrypt(row[i]).encode('utf-8'))
-          elif encrypt_mode == 'pseudonym':
-            cipher = schema[i]['cipher']
-            new_row.append(cipher.Encrypt(row[i]).encode('utf-8'))
-          elif encrypt_mode == 'homomorphic' and schema[i]['type'] == 'integer':
-            new_row.append(
-                homomorphic_int_cipher.Encrypt(long(row[i])).encode('utf-8'))
-          elif encrypt_mode == 'homomorphic' and schema[i]['type'] == 'float':
-            new_row.append(
-                homomorphic_float_cipher.Encrypt(float(row[i])).encode('utf-8'))
-          elif encrypt_mode == 'searchwords':
-            if 'searchwords_separator' in schema[i]:
-              searchwords_separator = schema[i]['searchwords_separator']
-            else:
-              searchwords_separator = None
-            if 'max_word_sequence' in schema[i]:
-              max_word_sequence = schema[i]['max_word_sequence']
-            else:
-              max_word_sequence = 5
-            new_row.append(string_hasher.GetHashesForWordSubsequencesWithIv(
-                util.SEARCHWORDS_PREFIX + schema[i]['name'], row[i],
-                separator=searchwords_separator,
-                max_sequence_len=max_word_sequence).encode('utf-8'))
-          elif encrypt_mode == 'probabilistic_searchwords':
-            if 'searchwords_separator' in schema[i]:
-              searchwords_separator = schema[i]['searchwords_separator']
-            else:
-              searchwords_separator = None
-            if 'max_word_sequence' in schema[i]:
-              max_word_sequence = schema[i]['max_word_sequence']
-            else:
-              max_word_sequence = 5
-            new_row.append(string_hasher.GetHashesForWordSubsequencesWithIv(
-                util.SEARCHWORDS_PREFIX + schema[i]['name'], row[i],
-                separator=searchwords_separator,
-                max_sequence_len=max_word_sequence).encode('utf-8'))
-            new_row.append(
-                prob_cipher.Encrypt(row[i]).encode('utf-8'))
-        csv_writer.writerow(new_row)
+  """Reads utf8 csv data, encrypts and stores into a new csv utf8 data file.
+
+  Rows are validated as they are converted; outfile is only written once the
+  whole file has validated.
+  """
+  if not os.path.exists(infile):
+    raise EncryptConvertError('%s file does not exist' % infile)
+  if FLAGS.load_workers > 1 and (FLAGS.paillier_randomizer_pool_size > 0 or
+                                 FLAGS.paillier_randomizer_bank):
+    # each worker process would need its own pool, and a bank can only be
+    # consumed by one of them.
+    raise app.UsageError(
+        '--load_workers cannot be combined with '
+        '--paillier_randomizer_pool_size or --paillier_randomizer_bank.')
+  with open(infile, 'rb') as in_file, _CommittedOutput(outfile) as out_file:
+    csv_writer = csv.writer(out_file)
+    # rows are parsed here, so chunks never split a quoted newline.
+    csv_reader = _Utf8CsvReader(in_file, csv_writer, decode=False)
+    batches = _ReadCsvBatches(csv_reader, schema)
+    if FLAGS.load_workers > 1:
+      pool = multiprocessing.Pool(
+          FLAGS.load_workers, _InitLoadWorker,
+          (deepcopy(schema), master_key, table_id))
+      # the latest cache stats of each worker, keyed by its pid.
+      worker_stats = {}
+      try:
+        for pid, new_rows, stats in util.OrderedPoolMap(
+            pool, _ConvertCsvRowsInLoadWorker, batches,
+            2 * FLAGS.load_workers):
+          csv_writer.writerows(new_rows)
+          worker_stats[pid] = stats
+        pool.close()
+      finally:
+        pool.terminate()
+        pool.join()
+      _LogCacheStats(worker_stats.values())
+      return
+    cipher_suite = ecrypto.GetCipherSuite(master_key, table_id)
+    with _RandomizerPool(cipher_suite, master_key, table_id), _ConversionCaches(
+        cipher_suite):
+      plan = _CompileCsvPlan(schema, cipher_suite)
+      convert_rows = lambda rows: _ConvertCsvRows(rows, plan)
+      for new_rows in util.OrderedThreadMap(
+          convert_rows, batches, FLAGS.paillier_threads):
+        csv_writer.writerows(new_rows)
+
+
+# Cipher suite and conversion plan of the table, set up once in each
+# --load_workers process.
+_load_worker_cipher_suite = None
+_load_worker_plan = None
+
+
+def _InitLoadWorker(schema, master_key, table_id):
+  """Initializes the ciphers of a --load_workers process."""
+  global _load_worker_cipher_suite, _load_worker_plan
+  cipher_suite = ecrypto.GetCipherSuite(master_key, table_id)
+  cipher_suite.string_hasher.EnableKeyedHashCache(FLAGS.searchwords_cache_size)
+  cipher_suite.EnablePseudonymCache(FLAGS.pseudonym_cache_size)
+  _load_worker_cipher_suite = cipher_suite
+  _load_worker_plan = _CompileCsvPlan(schema, cipher_suite)
+
+
+def _ConvertCsvRowsInLoadWorker(rows):
+  """Encrypts a batch of csv rows in a --load_workers process.
+
+  Returns:
+    tuple of the pid of the worker, the encrypted rows and the cache stats of
+    the worker so far, for the parent to log.
+  """
+  return (os.getpid(), _ConvertCsvRows(rows, _load_worker_plan),
+          _GetCacheStats(_load_worker_cipher_suite))
+
+
+def _ReadCsvBatches(csv_reader, schema):
+  """Yields lists of up to _CSV_BATCH_ROWS validated rows from csv_reader.
+
+  Args:
+    csv_reader: iterable of rows, as returned by _Utf8CsvReader.
+    schema: describes the type of data each field contains.
+  Yields:
+    lists of rows.
+  Raises:
+    EncryptConvertError: if a row has more or less fields than the schema, is
+      not valid utf8 or a value does not match the type of its field.
+  """
+  num_columns = len(schema)
+  types = [field['type'] for field in schema]
+  rows = []
+  for row_num, row in enumerate(csv_reader, 1):
+    if len(row) != num_columns:
+      raise EncryptConvertError('Incorrect number of fields in row %d: %s'
+                                % (row_num, row))
+    # cells stay utf8 encoded, but are validated as a whole row. the ascii
+    # separator cannot complete or start a multibyte sequence.
+    try:
+      ','.join(row).decode('utf-8')
+    except UnicodeDecodeError as e:
+      raise EncryptConvertError('Invalid utf8 in row %d: %s' % (row_num, e))
+    for type_value, data_value in zip(types, row):
+      _ValidateDataType(type_value, data_value)
+    rows.append(row)
+    if len(rows) == _CSV_BATCH_ROWS:
+      yield rows
+      rows = []
+  if rows:
+    yield rows
+
+
+def _CompileCsvPlan(schema, cipher_suite):
+  """Compiles the schema into one converter per csv column.
+
+  Args:
+    schema: list of dict, the db schema. modified by _GenerateRelatedCiphers.
+    cipher_suite: ecrypto.CipherSuite of the table.
+  Returns:
+    list of functions, one per schema field. Each takes the columns of a batch
+    of rows, as utf8 encoded values, and returns the list of encrypted columns
+    it contributes to the output (none, one or two).
+  """
+  map_name_to_index = _GenerateRelatedCiphers(schema, cipher_suite)
+  packing_groups = util.GetPackingGroups(schema)
+  return [_CompileCsvColumn(i, schema[i], cipher_suite, map_name_to_index,
+                            packing_groups)
+          for i in xrange(len(schema))]
+
+
+def _CompileCsvColumn(i, field, cipher_suite, map_name_to_index,
+                      packing_groups):
+  """Returns the converter of column i, see _CompileCsvPlan."""
+  encrypt_mode = field['encrypt']
+  if 'packing_group' in field:
+    names = packing_groups[field['packing_group']]
+    if field['name'] != names[0]:
+      return lambda columns: []
+    indexes = [map_name_to_index[name] for name in names]
+    encrypt_multiple = cipher_suite.homomorphic_int_cipher.EncryptMultiple
+    return lambda columns: [
+        [encrypt_multiple([long(value) for value in values])
+         for values in zip(*[columns[k] for k in indexes])]]
+  elif encrypt_mode == NONE:
+    # passthrough values are written back as the bytes that were read.
+    return lambda columns: [columns[i]]
+  elif encrypt_mode == 'probabilistic':
+    encrypt_column = cipher_suite.probabilistic_cipher.EncryptColumn
+    return lambda columns: [encrypt_column(columns[i])]
+  elif encrypt_mode == 'pseudonym':
+    encrypt_column = field['cipher'].EncryptColumn
+    return lambda columns: [encrypt_column(columns[i])]
+  elif encrypt_mode == 'homomorphic' and field['type'] == 'integer':
+    encrypt_column = cipher_suite.homomorphic_int_cipher.EncryptColumn
+    return lambda columns: [
+        encrypt_column([long(value) for value in columns[i]])]
+  elif encrypt_mode == 'homomorphic' and field['type'] == 'float':
+    encrypt_column = cipher_suite.homomorphic_float_cipher.EncryptColumn
+    return lambda columns: [
+        encrypt_column([float(value) for value in columns[i]])]
+  elif encrypt_mode in ['searchwords', 'probabilistic_searchwords']:
+    get_hashes = functools.partial(
+        cipher_suite.string_hasher.GetHashesForWordSubsequencesWithIv,
+        util.SEARCHWORDS_PREFIX + field['name'],
+        separator=field.get('searchwords_separator', None),
+        max_sequence_len=field.get('max_word_sequence', 5))
+    searchwords = lambda value: get_hashes(value.decode('utf-8'))
+    if encrypt_mode == 'searchwords':
+      return _MapCsvColumn(i, searchwords)
+    prob_encrypt_column = cipher_suite.probabilistic_cipher.EncryptColumn
+    return lambda columns: [map(searchwords, columns[i]),
+                            prob_encrypt_column(columns[i])]
+  elif encrypt_mode == 'searchwords_bloom':
+    get_bloom_filter = _GetBloomFilterFunction(field, cipher_suite)
+    return _MapCsvColumn(
+        i, lambda value: get_bloom_filter(value.decode('utf-8')))
+  return lambda columns: []
+
+
+def _MapCsvColumn(i, convert):
+  """Returns a converter applying convert to each value of column i."""
+  return lambda columns: [map(convert, columns[i])]
+
+
+def _ConvertCsvRows(rows, plan):
+  """Encrypts a batch of csv rows.
+
+  Args:
+    rows: list of rows, each a list of utf8 encoded values.
+    plan: list of column converters, as returned by _CompileCsvPlan.
+  Returns:
+    list of encrypted rows, each a sequence of utf8 encoded values.
+  """
+  columns = zip(*rows)
+  output_columns = []
+  for convert in plan:
+    output_columns.extend(convert(columns))
+  return zip(*output_columns)
 
 
 def ConvertJsonDataFile(schema, master_key, table_id, infile, outfile):
@@ -457,142 +812,230 @@ def ConvertJsonDataFile(schema, master_key, table_id, infile, outfile):
     infile: File to be encrypted.
     outfile: Location of encrypted file to outputted.
   """
-  prob_cipher = ecrypto.ProbabilisticCipher(
-      ecrypto.GenerateProbabilisticCipherKey(master_key, table_id))
-  pseudonym_cipher = ecrypto.PseudonymCipher(
-      ecrypto.GeneratePseudonymCipherKey(master_key, table_id))
-  # TODO(user): ciphers and hash should not use the same key.
-  string_hasher = ecrypto.StringHash(
-      ecrypto.GenerateStringHashKey(master_key, table_id))
-  homomorphic_int_cipher = ecrypto.HomomorphicIntCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id))
-  homomorphic_float_cipher = ecrypto.HomomorphicFloatCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id))
-
-  _ValidateJsonDataFile(schema, infile)
-  with open(infile, 'rb') as in_file:
-    with open(outfile, 'wb') as out_file:
-      for line in in_file:
-        data = json.loads(line)
-        data = _StrToUnicode(data)
-        rewritten_data = _ConvertJsonField(
-            data, schema, prob_cipher, pseudonym_cipher, string_hasher,
-            homomorphic_int_cipher, homomorphic_float_cipher)
-        rewritten_data = json.dumps(rewritten_data)
-        out_file.write(rewritten_data + '\n')
-
-
-def _ConvertJsonField(data, schema, prob_cipher, pseudonym_cipher,
-                      string_hasher, homomorphic_int_cipher,
-                      homomorphic_float_cipher):
-  rewritten_data = {}
-  for schema_field in schema:
-    field_name = schema_field['name']
-    if field_name not in data:
-      continue
-    data_value = data[field_name]
-    type_value = schema_field['type']
-    mode_value = schema_field['mode']
-    if mode_value == 'repeated' and type_value == 'record':
-      list_value = []
-      for single_data in data_value:
-        list_value.append(_ConvertJsonField(
-            single_data, schema_field['fields'], prob_cipher, pseudonym_cipher,
-            string_hasher, homomorphic_int_cipher, homomorphic_float_cipher))
-      rewritten_data[field_name] = list_value
-    elif mode_value == 'repeated':
-      encrypt_type = schema_field['encrypt']
-      if encrypt_type == 'probabilistic_searchwords':
-        searchwords_list = []
-        for single_data in data_value:
-          searchwords_list.append(_ConvertDataType(
-              single_data, 'searchwords', schema_field, prob_cipher,
-              pseudonym_cipher, string_hasher, homomorphic_int_cipher,
-              homomorphic_float_cipher))
-        rewritten_data[util.SEARCHWORDS_PREFIX +
-                       field_name] = searchwords_list
-        prob_list = []
-        for single_data in data_value:
-          prob_list.append(_ConvertDataType(
-              single_data, 'probabilistic', schema_field, prob_cipher,
-              pseudonym_cipher, string_hasher, homomorphic_int_cipher,
-              homomorphic_float_cipher))
-        rewritten_data[util.PROBABILISTIC_PREFIX + field_name] = prob_list
-      else:
-        list_value = []
-        for single_data in data_value:
-          list_value.append(_ConvertDataType(
-              single_data, encrypt_type, schema_field, prob_cipher,
-              pseudonym_cipher, string_hasher, homomorphic_int_cipher,
-              homomorphic_float_cipher))
-        rewritten_data[_RewriteFieldName(
-            field_name, encrypt_type, type_value)] = list_value
-    elif type_value == 'record':
-      rewritten_data[field_name] = _ConvertJsonField(
-          data_value, schema_field['fields'], prob_cipher, pseudonym_cipher,
-          string_hasher, homomorphic_int_cipher, homomorphic_float_cipher)
+  cipher_suite = ecrypto.GetCipherSuite(master_key, table_id)
+  encode_record = _CompileJsonEncoder(schema, cipher_suite)
+
+  if not os.path.exists(infile):
+    raise EncryptConvertError('%s file does not exist.' % infile)
+  with _RandomizerPool(cipher_suite, master_key, table_id), _ConversionCaches(
+      cipher_suite):
+    with open(infile, 'rb') as in_file, _CommittedOutput(outfile) as out_file:
+
+      def ConvertLine(line):
+        rewritten_data = encode_record(_json_codec.loads(line))
+        return _json_codec.dumps(
+            rewritten_data, separators=(',', ':'), check_circular=False) + '\n'
+
+      for rewritten_line in util.OrderedThreadMap(
+          ConvertLine, in_file, FLAGS.paillier_threads,
+          max_in_flight=_JSON_LINES_IN_FLIGHT):
+        out_file.write(rewritten_line)
+
+
+def _CompileJsonEncoder(schema, cipher_suite):
+  """Compiles the schema into an encoder of json records.
+
+  The schema is walked once; the encoder validates each value against the
+  type and mode of its field just before converting it.
+
+  Args:
+    schema: list of dict, the fields of the records.
+    cipher_suite: ecrypto.CipherSuite of the table.
+  Returns:
+    function which takes a record, as parsed from json, and returns the
+    encrypted record. It raises EncryptConvertError if the record does not
+    match the schema.
+  """
+  field_encoders = [
+      _CompileJsonFieldEncoder(schema_field, schema, cipher_suite)
+      for schema_field in schema]
+
+  def EncodeRecord(data):
+    if not isinstance(data, dict):
+      raise EncryptConvertError('Expected a dictionary: Got %s.' % str(data))
+    rewritten_data = {}
+    for encode_field in field_encoders:
+      encode_field(data, rewritten_data)
+    return rewritten_data
+
+  return EncodeRecord
+
+
+def _CompileJsonFieldEncoder(schema_field, schema, cipher_suite):
+  """Returns a function which encodes one field of a record.
+
+  Args:
+    schema_field: dict, the field to encode.
+    schema: list of dict, the fields of the record, schema_field among them.
+    cipher_suite: ecrypto.CipherSuite of the table.
+  Returns:
+    function of (data, rewritten_data) which validates the field of the record
+    data and stores its encrypted values in the new record rewritten_data.
+  """
+  field_name = schema_field['name']
+  type_value = schema_field['type']
+  mode_value = schema_field['mode']
+  if 'packing_group' in schema_field:
+    group = schema_field['packing_group']
+    names = util.GetPackingGroups(schema)[group]
+    if field_name != names[0]:
+      # the first field of the group encodes the others.
+      return lambda data, rewritten_data: None
+    packed_name = util.HOMOMORPHIC_PACKED_INT_PREFIX + group
+    encrypt_multiple = cipher_suite.homomorphic_int_cipher.EncryptMultiple
+
+    def EncodePackingGroup(data, rewritten_data):
+      for name in names:
+        if name not in data:
+          raise EncryptConvertError('%s not in data file.' % name)
+        _ValidateDataType('integer', data[name])
+      rewritten_data[packed_name] = encrypt_multiple(
+          [long(data[name]) for name in names])
+
+    return EncodePackingGroup
+
+  validate = lambda data_value: None
+  if type_value == 'record':
+    encode_record = _CompileJsonEncoder(schema_field['fields'], cipher_suite)
+    if mode_value == 'repeated':
+      validate = functools.partial(_ValidateJsonList, field_name, None)
+      outputs = [(field_name, functools.partial(map, encode_record))]
+    else:
+      outputs = [(field_name, encode_record)]
+  else:
+    encrypt_type = schema_field['encrypt']
+    if encrypt_type == 'probabilistic_searchwords':
+      outputs = [
+          (util.SEARCHWORDS_PREFIX + field_name,
+           _CompileJsonValue('searchwords', schema_field, cipher_suite)),
+          (util.PROBABILISTIC_PREFIX + field_name,
+           _CompileJsonValue('probabilistic', schema_field, cipher_suite))]
     else:
-      encrypt_type = schema_field['encrypt']
-      if encrypt_type == 'probabilistic_searchwords':
-        rewritten_data[util.SEARCHWORDS_PREFIX + field_name] = (
-            _ConvertDataType(data_value, 'searchwords', schema_field,
-                             prob_cipher, pseudonym_cipher, string_hasher,
-                             homomorphic_int_cipher, homomorphic_float_cipher))
-        rewritten_data[util.PROBABILISTIC_PREFIX + field_name] = (
-            _ConvertDataType(data_value, 'probabilistic', schema_field,
-                             prob_cipher, pseudonym_cipher, string_hasher,
-                             homomorphic_int_cipher, homomorphic_float_cipher))
+      outputs = [(_RewriteFieldName(field_name, encrypt_type, type_value),
+                  _CompileJsonValue(encrypt_type, schema_field, cipher_suite))]
+    if mode_value == 'repeated':
+      validate = functools.partial(_ValidateJsonList, field_name, type_value)
+      if encrypt_type == 'homomorphic':
+        outputs = [(outputs[0][0], _CompileJsonHomomorphicList(
+            type_value, cipher_suite))]
+      elif encrypt_type in ['probabilistic', 'pseudonym']:
+        outputs = [(outputs[0][0], _CompileJsonStringList(
+            encrypt_type, cipher_suite))]
       else:
-        rewritten_data[
-            _RewriteFieldName(field_name, encrypt_type, type_value)] = (
-                _ConvertDataType(data_value, encrypt_type, schema_field,
-                                 prob_cipher, pseudonym_cipher, string_hasher,
-                                 homomorphic_int_cipher,
-                                 homomorphic_float_cipher))
-  return rewritten_data
-
-
-def _ConvertDataType(data_value, encrypt_type, schema, prob_cipher,
-                     pseudonym_cipher, string_hasher, homomorphic_int_cipher,
-                     homomorphic_float_cipher):
-  type_value = schema['type']
+        outputs = [(output_name, functools.partial(map, convert))
+                   for output_name, convert in outputs]
+    else:
+      validate = functools.partial(_ValidateDataType, type_value)
+
+  def EncodeField(data, rewritten_data):
+    if field_name not in data:
+      if mode_value != 'nullable':
+        raise EncryptConvertError('%s not in data file.' % field_name)
+      return
+    data_value = data[field_name]
+    validate(data_value)
+    for output_name, convert in outputs:
+      rewritten_data[output_name] = convert(data_value)
+
+  return EncodeField
+
+
+def _ValidateJsonList(field_name, type_value, data_value):
+  """Validates a repeated value, and its items unless type_value is None."""
+  if not isinstance(data_value, list):
+    raise EncryptConvertError('Expected a repeated type for %s.' % field_name)
+  if type_value is not None:
+    for single_data in data_value:
+      _ValidateDataType(type_value, single_data)
+
+
+def _CompileJsonHomomorphicList(type_value, cipher_suite):
+  """Returns a function encrypting a repeated homomorphic value in one batch."""
+  if type_value == 'integer':
+    encrypt_column = cipher_suite.homomorphic_int_cipher.EncryptColumn
+    return lambda data_value: encrypt_column(map(long, data_value))
+  encrypt_column = cipher_suite.homomorphic_float_cipher.EncryptColumn
+  return lambda data_value: encrypt_column(map(float, data_value))
+
+
+def _CompileJsonStringList(encrypt_type, cipher_suite):
+  """Returns a function encrypting a repeated aes encrypted value at once."""
+  if encrypt_type == 'probabilistic':
+    encrypt_column = cipher_suite.probabilistic_cipher.EncryptColumn
+  else:
+    encrypt_column = cipher_suite.pseudonym_cipher.EncryptColumn
+  return lambda data_value: encrypt_column(map(unicode, data_value))
+
+
+def _CompileJsonValue(encrypt_type, schema_field, cipher_suite):
+  """Returns a function converting a single json value of schema_field.
+
+  Args:
+    encrypt_type: str, the encryption to apply; one part of the
+      probabilistic_searchwords encryption, or the encryption of schema_field.
+    schema_field: dict, the field of the value.
+    cipher_suite: ecrypto.CipherSuite of the table.
+  Returns:
+    function which takes a validated value and returns its converted value.
+  """
+  type_value = schema_field['type']
   if encrypt_type == NONE:
     if type_value == 'string':
-      return data_value.encode('utf-8')
+      return lambda data_value: data_value.encode('utf-8')
     elif type_value == 'integer':
-      return int(data_value)
+      return int
     elif type_value == 'float':
-      return float(data_value)
+      return float
     elif type_value == 'timestamp':
-      if (isinstance(data_value, (int, float, str, unicode)) and
-          data_value != ''):  # pylint: disable=g-explicit-bool-comparison
-        # valid input is an int, float, or non-empty string.
-        # BQ is happy to accept epoch seconds timestamp values inside of
-        # a string, so the safest transformation here is str().
-        return str(data_value)
-      else:
-        return None
+      return _ConvertJsonTimestamp
   elif encrypt_type == 'probabilistic':
-    return prob_cipher.Encrypt(unicode(data_value)).encode('utf-8')
+    encrypt = cipher_suite.probabilistic_cipher.Encrypt
+    return lambda data_value: encrypt(unicode(data_value))
   elif encrypt_type == 'pseudonym':
-    return pseudonym_cipher.Encrypt(unicode(data_value)).encode('utf-8')
+    encrypt = cipher_suite.pseudonym_cipher.Encrypt
+    return lambda data_value: encrypt(unicode(data_value))
   elif encrypt_type == 'homomorphic' and type_value == 'integer':
-    return homomorphic_int_cipher.Encrypt(long(data_value)).encode('utf-8')
+    encrypt = cipher_suite.homomorphic_int_cipher.Encrypt
+    return lambda data_value: encrypt(long(data_value))
   elif encrypt_type == 'homomorphic' and type_value == 'float':
-    return homomorphic_float_cipher.Encrypt(float(data_value)).encode('utf-8')
+    encrypt = cipher_suite.homomorphic_float_cipher.Encrypt
+    return lambda data_value: encrypt(float(data_value))
   elif encrypt_type == 'searchwords':
-    if 'searchwords_separator' in schema:
-      searchwords_separator = schema['searchwords_separator']
-    else:
-      searchwords_separator = None
-    if 'max_word_sequence' in schema:
-      max_word_sequence = schema['max_word_sequence']
-    else:
-      max_word_sequence = 5
-    return string_hasher.GetHashesForWordSubsequencesWithIv(
-        util.SEARCHWORDS_PREFIX + schema['name'], data_value,
-        separator=searchwords_separator,
-        max_sequence_len=max_word_sequence).encode('utf-8')
+    get_hashes = functools.partial(
+        cipher_suite.string_hasher.GetHashesForWordSubsequencesWithIv,
+        util.SEARCHWORDS_PREFIX + schema_field['name'],
+        separator=schema_field.get('searchwords_separator', None),
+        max_sequence_len=schema_field.get('max_word_sequence', 5))
+    # a json codec may return ascii strings as str.
+    return lambda data_value: get_hashes(_StrToUnicode(data_value))
+  elif encrypt_type == 'searchwords_bloom':
+    get_bloom_filter = _GetBloomFilterFunction(schema_field, cipher_suite)
+    return lambda data_value: get_bloom_filter(_StrToUnicode(data_value))
+  return lambda data_value: None
+
+
+def _GetBloomFilterFunction(field, cipher_suite):
+  """Returns a function of unicode data to the searchwords bloom filter."""
+  return functools.partial(
+      cipher_suite.string_hasher.GetBloomFilterForWordSubsequencesWithIv,
+      util.SEARCHWORDS_BLOOM_PREFIX + field['name'],
+      separator=field.get('searchwords_separator', None),
+      max_sequence_len=field.get('max_word_sequence', 5),
+      num_bits=field.get('searchwords_bloom_bits',
+                         ecrypto.SEARCHWORDS_BLOOM_BITS),
+      num_hashes=field.get('searchwords_bloom_hashes',
+                           ecrypto.SEARCHWORDS_BLOOM_HASHES))
+
+
+def _ConvertJsonTimestamp(data_value):
+  if (isinstance(data_value, (int, float, str, unicode)) and
+      data_value != ''):  # pylint: disable=g-explicit-bool-comparison
+    # valid input is an int, float, or non-empty string.
+    # BQ is happy to accept epoch seconds timestamp values inside of
+    # a string, so the safest transformation here is str().
+    return str(data_value)
+  else:
+    return None
 
 
 def _RewriteFieldName(name, encrypt_type, type_value):
@@ -609,78 +1052,12 @@ def _RewriteFieldName(name, encrypt_type, type_value):
     return util.PSEUDONYM_PREFIX + name
   elif encrypt_type == 'searchwords':
     return util.SEARCHWORDS_PREFIX + name
+  elif encrypt_type == 'searchwords_bloom':
+    return util.SEARCHWORDS_BLOOM_PREFIX + name
   else:
     raise ValueError('Unknown encryption type.')
 
 
-def _ValidateCsvDataFile(schema, filepath):
-  """Validates the data file against the table schema file provided.
-
-  Does some basic checks to make sure number of fields are correct and that the
-  type of data is consistent with the type specified in the table schema file.
-  Args:
-    schema: describes the type of data each field contains.
-    filepath: the data file; currently only utf8 encoded data is supported.
-  Raises:
-    EncryptConvertError: if there is more or less data than the number of fields
-      in a row as specified in the schema.
-  """
-  if not os.path.exists(filepath):
-    raise EncryptConvertError('%s file does not exist' % filepath)
-  num_columns = len(schema)
-  with open(filepath, 'rb') as f:
-    csv_reader = _Utf8CsvReader(f)
-    row_num = 0
-    for row in csv_reader:
-      row_num += 1
-      if len(row) != num_columns:
-        raise EncryptConvertError('Incorrect number of fields in row %d: %s'
-                                  % (row_num, row))
-      for i in xrange(num_columns):
-        _ValidateDataType(schema[i]['type'], row[i])
-
-
-def _ValidateJsonDataFile(schema, filepath):
-  if not os.path.exists(filepath):
-    raise EncryptConvertError('%s file does not exist.' % filepath)
-  with open(filepath, 'rb') as f:
-    row_i = -1
-    for line in f:
-      row_i += 1
-      data = json.loads(line)
-      _ValidateJsonField(data, schema, row_i)
-
-
-def _ValidateJsonField(data, schema, row_number):
-  if not isinstance(data, dict):
-    raise EncryptConvertError('Expected a dictionary: Got %s.' % str(data))
-  for schema_field in schema:
-    if schema_field['name'] not in data:
-      if schema_field['mode'] != 'nullable':
-        raise EncryptConvertError('%s not in data file.' % schema_field['name'])
-      else:
-        continue
-    data_value = data[schema_field['name']]
-    type_value = schema_field['type']
-    mode_value = schema_field['mode']
-    if mode_value == 'repeated' and type_value == 'record':
-      if not isinstance(data_value, list):
-        raise EncryptConvertError('Expected a repeated type for %s.'
-                                  % schema_field['name'])
-      for single_data in data_value:
-        _ValidateJsonField(single_data, schema_field['fields'], row_number)
-    elif mode_value == 'repeated':
-      if not isinstance(data_value, list):
-        raise EncryptConvertError('Expected a repeated type for %s.'
-                                  % schema_field['name'])
-      for single_data in data_value:
-        _ValidateDataType(type_value, single_data)
-    elif type_value == 'record':
-      _ValidateJsonField(data_value, schema_field['fields'], row_number)
-    else:
-      _ValidateDataType(type_value, data_value)
-
-
 def _ValidateDataTimestamp(data_value):
   """Validate a timestamp value.
 
@@ -700,27 +1077,7 @@ def _ValidateDataTimestamp(data_value):
     except (ValueError, AssertionError):
       pass
 
-  # Per the BigQuery documentation these formats are valid:
-  # 2014-08-19 07:41:35.220 -05:00
-  # 2014-08-19 12:41:35.220 UTC
-  # 2014-08-19 12:41:35.220
-  # 2014-08-19 12:41:35.220000
-  # 2014-08-19T12:41:35.220Z
-  # 1969-07-20 20:18:04
-  # 1969-07-20 20:18:04 UTC
-  # 1969-07-20T20:18:04
-
-  timestamp_re = re.compile(
-      r'^(?P<YMD>\d{4}-\d{2}-\d{2})[T ](?P<HMS>\d{2}:\d{2}:\d{2})'
-      r'(?P<FRACTS>\.\d{1,6})?'
-      r'((?P<ZULU>Z)|'
-      r'\s(?P<UTC>)|'
-      r'\s(?P<TZOFFSET>[\+\-]\d{2}:\d{2})|'
-      r'\s(?P<TZ>[A-Z]{3})|'
-      r')$'
-  )
-
-  m = timestamp_re.search(data_value)
+  m = _TIMESTAMP_RE.search(data_value)
   if m is None:
     raise ValueError('timestamp format')
   # TODO(user): One could perform further validation on portions of
@@ -753,13 +1110,16 @@ def _ValidateDataType(type_value, data_value):
                                 'cannot convert %s: %s' % (data_value, e))
 
 
-def _Utf8CsvReader(utf8_csv_data, skip_rows_writer=None, **kwargs):
+def _Utf8CsvReader(utf8_csv_data, skip_rows_writer=None, decode=True,
+                   **kwargs):
   """Read from utf8_csv_data filename and yield rows.
 
   Args:
     utf8_csv_data: str, filename like 'foo.csv'
     skip_rows_writer: callable like csv.writer, optional, where to write
         rows to if FLAGS.skip_leading_rows > 0
+    decode: bool, default True, yield unicode cells rather than the utf8
+        encoded bytes read.
     **kwargs: other options supplied directly to the csv.reader instance.
   Yields:
     rows of rows from utf8_csv_data file, read as a CSV file.
@@ -785,6 +1145,10 @@ def _Utf8CsvReader(utf8_csv_data, skip_rows_writer=None, **kwargs):
     if not FLAGS.allow_quoted_newlines:
       raise EncryptConvertError('ebq cannot be configured to not allow '
                                 'quoted newlines')
+  if not decode:
+    for row in csv_reader:
+      yield row
+    return
   for row in csv_reader:
     # decode UTF-8 back to Unicode, cell by cell:
     yield [unicode(cell, 'utf-8') for cell in row]
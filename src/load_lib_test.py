@@ -8,10 +8,14 @@
 
 
 import base64
+import csv
+import functools
 import hashlib
 import json
 import os
+import random
 import tempfile
+import time
 import types
 
 import mox
@@ -39,6 +43,21 @@ _RELATED_PSEUDONYM_SCHEMA = """[
   {"name": "dc", "type": "string", "encrypt": "pseudonym"}
 ]\n""" % _RELATED
 
+_PACKED_SCHEMA = """[
+  {"name": "a", "type": "integer", "encrypt": "homomorphic",
+   "packing_group": "m"},
+  {"name": "b", "type": "string"},
+  {"name": "c", "type": "integer", "encrypt": "homomorphic",
+   "packing_group": "m"}
+]\n"""
+
+_BLOOM_SCHEMA = """[
+  {"name": "a", "type": "string", "encrypt": "searchwords_bloom",
+   "searchwords_bloom_bits": 96, "searchwords_bloom_hashes": 2},
+  {"name": "b", "type": "string", "encrypt": "searchwords_bloom",
+   "searchwords_separator": "/"}
+]\n"""
+
 _BEFORE_MODIFY_SCHEMA = """[
   {"name": "Year", "type": "Integer"},
   {"name": "fullName", "type": "string", "mode": "nullable"},
@@ -371,6 +390,43 @@ class LoadLibraryTest(googletest.TestCase):
     self.assertRaises(
         load_lib.EncryptConvertError, load_lib._ValidateExtendedSchema, schema)
 
+  def testValidateExtendedSchemaWithPackingGroup(self):
+    """Test _ValidateExtendedSchema()."""
+    load_lib._ValidateExtendedSchema(json.loads(_PACKED_SCHEMA))
+    bad_schemas = [
+        [{'name': u'a', 'type': 'float', 'encrypt': 'homomorphic',
+          'packing_group': u'm'}],
+        [{'name': u'a', 'type': 'integer', 'packing_group': u'm'}],
+        [{'name': u'a', 'type': 'integer', 'encrypt': 'homomorphic',
+          'mode': 'nullable', 'packing_group': u'm'}],
+        [{'name': u'r', 'type': 'record', 'fields': [
+            {'name': u'a', 'type': 'integer', 'encrypt': 'homomorphic',
+             'packing_group': u'm'}]}],
+        [{'name': u'a%d' % i, 'type': 'integer', 'encrypt': 'homomorphic',
+          'packing_group': u'm'} for i in xrange(8)],
+    ]
+    for schema in bad_schemas:
+      self.assertRaises(load_lib.EncryptConvertError,
+                        load_lib._ValidateExtendedSchema, schema)
+
+  def testValidateExtendedSchemaWithSearchwordsBloom(self):
+    """Test _ValidateExtendedSchema()."""
+    load_lib._ValidateExtendedSchema(json.loads(_BLOOM_SCHEMA))
+    bad_schemas = [
+        [{'name': u'a', 'type': 'integer', 'encrypt': 'searchwords_bloom'}],
+        [{'name': u'a', 'type': 'string', 'encrypt': 'searchwords',
+          'searchwords_bloom_bits': 96}],
+        [{'name': u'a', 'type': 'string', 'encrypt': 'searchwords_bloom',
+          'searchwords_bloom_bits': 100}],
+        [{'name': u'a', 'type': 'string', 'encrypt': 'searchwords_bloom',
+          'searchwords_bloom_bits': 6 * 4097}],
+        [{'name': u'a', 'type': 'string', 'encrypt': 'searchwords_bloom',
+          'searchwords_bloom_hashes': 9}],
+    ]
+    for schema in bad_schemas:
+      self.assertRaises(load_lib.EncryptConvertError,
+                        load_lib._ValidateExtendedSchema, schema)
+
   def testReadandValidateSchemaFromFile(self):
     infile = os.path.join(self.dirname, 'test_schema_file')
     f = open(infile, 'wt')
@@ -446,6 +502,27 @@ class LoadLibraryTest(googletest.TestCase):
     expected_schema = json.loads(_JOBS_REWRITTEN_SCHEMA)
     self.assertEquals(expected_schema, new_schema)
 
+  def testRewriteSchemaWithPackingGroup(self):
+    schema = json.loads(_PACKED_SCHEMA)
+    load_lib._ModifyFields(schema)
+    expected_schema = [
+        {'name': util.HOMOMORPHIC_PACKED_INT_PREFIX + 'm', 'type': 'string',
+         'mode': 'required'},
+        {'name': 'b', 'type': 'string', 'mode': 'required'},
+    ]
+    self.assertEquals(expected_schema, load_lib.RewriteSchema(schema))
+
+  def testRewriteSchemaWithSearchwordsBloom(self):
+    schema = json.loads(_BLOOM_SCHEMA)
+    load_lib._ModifyFields(schema)
+    expected_schema = [
+        {'name': util.SEARCHWORDS_BLOOM_PREFIX + 'a', 'type': 'string',
+         'mode': 'required'},
+        {'name': util.SEARCHWORDS_BLOOM_PREFIX + 'b', 'type': 'string',
+         'mode': 'required'},
+    ]
+    self.assertEquals(expected_schema, load_lib.RewriteSchema(schema))
+
   def testRewriteSchemaTypeCheck(self):
     schema = json.loads(test_util.GetJobsSchemaString())
     self.assertTrue(isinstance(schema, types.ListType))
@@ -467,20 +544,32 @@ class LoadLibraryTest(googletest.TestCase):
     self.mox.VerifyAll()
     self.assertEqual(new_schema, [])
 
-  def testValidateCsvDataFile(self):
-    schema = json.loads(test_util.GetCarsSchemaString())
-    infile = self._WriteTempCarsCsvFile()
-    load_lib._ValidateCsvDataFile(schema, infile)
-
-  def testValidateJsonDataFile(self):
-    schema = json.loads(test_util.GetPlacesSchemaString())
-    infile = self._WriteTempPlacesJsonFile()
-    load_lib._ValidateJsonDataFile(schema, infile)
-
-  def testValidateComplexJsonDataFile(self):
-    schema = json.loads(test_util.GetJobsSchemaString())
-    infile = self._WriteTempJobsJsonFile()
-    load_lib._ValidateJsonDataFile(schema, infile)
+  def testConvertDataFilesRejectInvalidRows(self):
+    self._SetupTestFlags()
+    master_key = base64.b64decode(_MASTER_KEY)
+    cars_csv = test_util.GetCarsCsv()
+    job = json.loads(test_util.GetJobsJson().splitlines()[0])
+    no_kind = dict(job)
+    del no_kind['kind']
+    invalid_jobs = [job['citiesLived'], dict(job, age='x'),
+                    dict(job, citiesLived={}),
+                    dict(job, citiesLived=[{'place': 'Paris'}]), no_kind]
+    cases = [(load_lib.ConvertCsvDataFile, test_util.GetCarsSchema(), data)
+             for data in [cars_csv + '1997,Ford\n',
+                          cars_csv.replace('1997', 'x', 1),
+                          cars_csv.replace('3000.00', 'x', 1)]]
+    cases.extend(
+        (load_lib.ConvertJsonDataFile, test_util.GetJobsSchema(),
+         test_util.GetJobsJson() + json.dumps(data) + '\n')
+        for data in invalid_jobs)
+    infile = os.path.join(self.dirname, 'invalid.in')
+    outfile = os.path.join(self.dirname, 'invalid.out')
+    for convert, schema, data in cases:
+      with open(infile, 'wt') as f:
+        f.write(data)
+      self.assertRaises(load_lib.EncryptConvertError, convert, schema,
+                        master_key, _TABLE_ID, infile, outfile)
+      self.assertEqual(['invalid.in'], os.listdir(self.dirname))
 
   def testGenerateRelatedCiphers(self):
     """Test _GenerateRelatedCiphers()."""
@@ -489,7 +578,8 @@ class LoadLibraryTest(googletest.TestCase):
 
     related_cipher_key = 'related cipher key'
     related_cipher = 'related cipher'
-    default_cipher = 'default cipher'
+    cipher_suite = ecrypto.CipherSuite(master_key, _TABLE_ID)
+    default_cipher = cipher_suite.pseudonym_cipher
 
     self.mox.StubOutWithMock(load_lib.ecrypto, 'PseudonymCipher')
     self.mox.StubOutWithMock(load_lib.ecrypto, 'GeneratePseudonymCipherKey')
@@ -500,7 +590,7 @@ class LoadLibraryTest(googletest.TestCase):
         related_cipher)
 
     self.mox.ReplayAll()
-    load_lib._GenerateRelatedCiphers(schema, master_key, default_cipher)
+    load_lib._GenerateRelatedCiphers(schema, cipher_suite)
     self.mox.VerifyAll()
 
     for i in xrange(len(schema)):
@@ -523,9 +613,11 @@ class LoadLibraryTest(googletest.TestCase):
     pseudonym_cipher_related = ecrypto.PseudonymCipher(
         ecrypto.GeneratePseudonymCipherKey(master_key, _TABLE_ID))
     load_lib.ConvertCsvDataFile(schema, master_key, _TABLE_ID, infile, outfile)
-    # validate new data file against new rewritten schema.
+    # rows of the new data file match the new rewritten schema.
     new_schema = json.loads(_CARS_REWRITTEN_SCHEMA)
-    load_lib._ValidateCsvDataFile(new_schema, outfile)
+    with open(outfile, 'rb') as f:
+      for row in csv.reader(f):
+        self.assertEqual(len(new_schema), len(row))
     # Sanity check one row entries. Entries for semantic encrypted fields cannot
     # be checked because the values are randomized.
     fout = open(outfile, 'rt')
@@ -543,11 +635,254 @@ class LoadLibraryTest(googletest.TestCase):
     self.assertEquals(expected_model_hash, model_hash)
     fout.close()
 
-  def testConvertJsonField(self):
-    """Test _ConvertJsonField()."""
-    c = [None] * 5
-    for x in xrange(5):
-      c[x] = self.mox.CreateMockAnything()
+  def testConvertCsvRowsBenchmark(self):
+    """Logs cars csv conversion rates, projected to a million rows."""
+    schema = json.loads(test_util.GetCarsSchemaString())
+    master_key = base64.b64decode(_MASTER_KEY)
+    plan = load_lib._CompileCsvPlan(
+        schema, ecrypto.GetCipherSuite(master_key, _TABLE_ID))
+    non_homomorphic_plan = [
+        convert for field, convert in zip(schema, plan)
+        if field['encrypt'] != 'homomorphic']
+    rows = list(csv.reader(test_util.GetCarsCsv().splitlines(True))) * 64
+    for name, row_plan in [('all columns', plan),
+                           ('non homomorphic columns', non_homomorphic_plan)]:
+      start = time.time()
+      load_lib._ConvertCsvRows(rows, row_plan)
+      seconds_per_row = max(time.time() - start, 1e-9) / len(rows)
+      logging.info('cars csv, %s: %.0f rows/second, %.0f seconds per million '
+                   'rows', name, 1 / seconds_per_row, seconds_per_row * 1e6)
+
+  def testSearchwordsBenchmark(self):
+    """Checks searchwords hashing with the default flags against no cache."""
+    cipher_suite = ecrypto.GetCipherSuite(
+        base64.b64decode(_MASTER_KEY), _TABLE_ID)
+    get_hashes = functools.partial(
+        cipher_suite.string_hasher.GetHashesForWordSubsequencesWithIv,
+        util.SEARCHWORDS_PREFIX + u'Description')
+    texts = [u' '.join(u'word%d' % random.randrange(1000) for _ in xrange(200))
+             for _ in xrange(20)]
+    cache_sizes = [('default flags', FLAGS.searchwords_cache_size),
+                   ('no cache', 0)]
+    seconds = {}
+    for name, cache_size in cache_sizes:
+      cipher_suite.string_hasher.EnableKeyedHashCache(cache_size)
+      start = time.time()
+      for text in texts:
+        get_hashes(text)
+      seconds[name] = time.time() - start
+      logging.info('Searchwords hashing of 200 words, %s: %.1fms per row',
+                   name, 1000 * seconds[name] / len(texts))
+    cipher_suite.string_hasher.EnableKeyedHashCache(0)
+    self.assertTrue(seconds['default flags'] < 1.5 * seconds['no cache'])
+
+  def testConvertCsvDataFileWithPackingGroup(self):
+    self._SetupTestFlags()
+    schema = json.loads(_PACKED_SCHEMA)
+    load_lib._ModifyFields(schema)
+    infile = os.path.join(self.dirname, 'packed.csv')
+    with open(infile, 'wt') as f:
+      f.write('1,x,-2\n7,y,9\n')
+    outfile = os.path.join(self.dirname, 'packed.enc_data')
+    master_key = base64.b64decode(_MASTER_KEY)
+    load_lib.ConvertCsvDataFile(schema, master_key, _TABLE_ID, infile, outfile)
+    cipher = ecrypto.GetCipherSuite(
+        master_key, _TABLE_ID).homomorphic_int_cipher
+    with open(outfile, 'rt') as f:
+      rows = [line.strip().split(',') for line in f]
+    self.assertEqual(2, len(rows))
+    self.assertEqual([1, -2], cipher.DecryptMultiple(rows[0][0])[-2:])
+    self.assertEqual('x', rows[0][1])
+    self.assertEqual([7, 9], cipher.DecryptMultiple(rows[1][0])[-2:])
+
+  def testConvertDataFilesWithSearchwordsBloom(self):
+    self._SetupTestFlags()
+    schema = json.loads(_BLOOM_SCHEMA)
+    load_lib._ModifyFields(schema)
+    master_key = base64.b64decode(_MASTER_KEY)
+    hasher = ecrypto.GetCipherSuite(master_key, _TABLE_ID).string_hasher
+    a_name = util.SEARCHWORDS_BLOOM_PREFIX + 'a'
+    b_name = util.SEARCHWORDS_BLOOM_PREFIX + 'b'
+    csv_infile = os.path.join(self.dirname, 'bloom.csv')
+    with open(csv_infile, 'wt') as f:
+      f.write('"Moon roof, loaded",www.ford.com/e350\n')
+    csv_outfile = os.path.join(self.dirname, 'bloom.enc_data')
+    load_lib.ConvertCsvDataFile(schema, master_key, _TABLE_ID, csv_infile,
+                                csv_outfile)
+    with open(csv_outfile, 'rt') as f:
+      csv_row = f.readline().strip().split(',')
+    json_infile = os.path.join(self.dirname, 'bloom.json')
+    with open(json_infile, 'wt') as f:
+      f.write('{"a": "Moon roof, loaded", "b": "www.ford.com/e350"}\n')
+    json_outfile = os.path.join(self.dirname, 'bloom.enc_json')
+    load_lib.ConvertJsonDataFile(schema, master_key, _TABLE_ID, json_infile,
+                                 json_outfile)
+    with open(json_outfile, 'rt') as f:
+      json_row = json.loads(f.readline())
+    for a_filter, b_filter in [csv_row, (json_row[a_name], json_row[b_name])]:
+      self.assertEqual(24 + 96 / 6, len(a_filter))
+      self.assertEqual(24 + ecrypto.SEARCHWORDS_BLOOM_BITS / 6, len(b_filter))
+      self.assertTrue(ecrypto.SearchwordsBloomMightContain(
+          str(a_filter), hasher.GetStringKeyHash(a_name, u'roof loaded'), 2))
+      self.assertTrue(ecrypto.SearchwordsBloomMightContain(
+          str(b_filter), hasher.GetStringKeyHash(b_name, u'www.ford.com/e350'),
+          ecrypto.SEARCHWORDS_BLOOM_HASHES))
+
+  def testConvertDataFilesWithThreads(self):
+    self._SetupTestFlags(paillier_threads=3)
+    self.stubs.Set(load_lib, '_CSV_BATCH_ROWS', 2)
+    self.stubs.Set(load_lib, '_JSON_LINES_IN_FLIGHT', 2)
+    schema = json.loads(
+        '[{"name": "n", "type": "integer", "encrypt": "homomorphic"}]')
+    load_lib._ModifyFields(schema)
+    master_key = base64.b64decode(_MASTER_KEY)
+    cipher = ecrypto.GetCipherSuite(
+        master_key, _TABLE_ID).homomorphic_int_cipher
+    values = range(-3, 4)
+    infile = os.path.join(self.dirname, 'threads.csv')
+    with open(infile, 'wt') as f:
+      f.write(''.join('%d\n' % value for value in values))
+    outfile = os.path.join(self.dirname, 'threads.enc_data')
+    load_lib.ConvertCsvDataFile(schema, master_key, _TABLE_ID, infile, outfile)
+    with open(outfile, 'rt') as f:
+      self.assertEqual(values, [cipher.Decrypt(line.strip()) for line in f])
+    infile = os.path.join(self.dirname, 'threads.json')
+    with open(infile, 'wt') as f:
+      f.write(''.join('{"n": %d}\n' % value for value in values))
+    outfile = os.path.join(self.dirname, 'threads.enc_json')
+    load_lib.ConvertJsonDataFile(schema, master_key, _TABLE_ID, infile, outfile)
+    with open(outfile, 'rt') as f:
+      self.assertEqual(
+          values, [cipher.Decrypt(str(json.loads(line).values()[0]))
+                   for line in f])
+
+  def testRandomizerPoolSkipsForeignBank(self):
+    self._SetupTestFlags(paillier_randomizer_pool_size=2,
+                         paillier_randomizer_bank=os.path.join(
+                             self.dirname, 'bank'))
+    master_key = base64.b64decode(_MASTER_KEY)
+    cipher_suite = ecrypto.GetCipherSuite(master_key, _TABLE_ID)
+    load_lib.FillRandomizerBank(
+        master_key, 'other_table', FLAGS.paillier_randomizer_bank, 1)
+    self.assertRaises(ValueError, load_lib.FillRandomizerBank, master_key,
+                      'other_table', FLAGS.paillier_randomizer_bank, 0)
+    with load_lib._RandomizerPool(cipher_suite, master_key, _TABLE_ID):
+      cipher_suite.homomorphic_int_cipher.Encrypt(1)
+    # the bank is kept for the table it was filled for.
+    self.assertTrue(os.path.exists(FLAGS.paillier_randomizer_bank))
+    cipher_suite = ecrypto.GetCipherSuite(master_key, 'other_table')
+    with load_lib._RandomizerPool(cipher_suite, master_key, 'other_table'):
+      cipher_suite.homomorphic_int_cipher.Encrypt(1)
+    self.assertFalse(os.path.exists(FLAGS.paillier_randomizer_bank))
+
+  def testConvertCsvDataFileWithLoadWorkers(self):
+    self._SetupTestFlags(load_workers=2, pseudonym_cache_size=10)
+    self.stubs.Set(load_lib, '_CSV_BATCH_ROWS', 2)
+    logged_stats = []
+    self.stubs.Set(load_lib, '_LogCacheStats', logged_stats.extend)
+    schema = json.loads(
+        '[{"name": "n", "type": "integer", "encrypt": "homomorphic"},'
+        ' {"name": "s", "type": "string", "encrypt": "pseudonym"}]')
+    load_lib._ModifyFields(schema)
+    master_key = base64.b64decode(_MASTER_KEY)
+    cipher_suite = ecrypto.GetCipherSuite(master_key, _TABLE_ID)
+    values = range(-3, 4)
+    infile = os.path.join(self.dirname, 'workers.csv')
+    with open(infile, 'wt') as f:
+      # a quoted newline must stay within its row.
+      f.write(''.join('%d,"line\n%d"\n' % (value, value) for value in values))
+    outfile = os.path.join(self.dirname, 'workers.enc_data')
+    load_lib.ConvertCsvDataFile(schema, master_key, _TABLE_ID, infile, outfile)
+    with open(outfile, 'rb') as f:
+      rows = list(csv.reader(f))
+    self.assertEqual(
+        values,
+        [cipher_suite.homomorphic_int_cipher.Decrypt(row[0]) for row in rows])
+    self.assertEqual(
+        [u'line\n%d' % value for value in values],
+        [cipher_suite.pseudonym_cipher.Decrypt(row[1]) for row in rows])
+    # the pseudonym cache stats of the workers reach the parent.
+    self.assertTrue(logged_stats)
+    self.assertEqual(
+        len(values),
+        sum(sum(pseudonym_stats[None]) for _, pseudonym_stats in logged_stats))
+
+  def testConvertCsvDataFileWhenInvalidUtf8(self):
+    schema = json.loads(
+        '[{"name": "n", "type": "string", "encrypt": "none"},'
+        ' {"name": "p", "type": "string", "encrypt": "probabilistic"},'
+        ' {"name": "s", "type": "string", "encrypt": "pseudonym"}]')
+    load_lib._ModifyFields(schema)
+    master_key = base64.b64decode(_MASTER_KEY)
+    infile = os.path.join(self.dirname, 'utf8.csv')
+    outfile = os.path.join(self.dirname, 'utf8.enc_data')
+    for row in ['\xff,a,b\n', 'a,\xc3,b\n', 'a,b,\xe2\x82\n']:
+      with open(infile, 'wb') as f:
+        f.write('ok,\xc3\xa9,\xe2\x82\xac\n' + row)
+      self.assertRaises(load_lib.EncryptConvertError,
+                        load_lib.ConvertCsvDataFile, schema, master_key,
+                        _TABLE_ID, infile, outfile)
+      self.assertFalse(os.path.exists(outfile))
+
+  def testConvertCsvDataFileWithLoadWorkersAndRandomizerPool(self):
+    self._SetupTestFlags(load_workers=2, paillier_randomizer_pool_size=10)
+    schema = json.loads(
+        '[{"name": "n", "type": "integer", "encrypt": "homomorphic"}]')
+    load_lib._ModifyFields(schema)
+    infile = os.path.join(self.dirname, 'workers.csv')
+    with open(infile, 'wt') as f:
+      f.write('1\n')
+    outfile = os.path.join(self.dirname, 'workers.enc_data')
+    self.assertRaises(app.UsageError, load_lib.ConvertCsvDataFile, schema,
+                      base64.b64decode(_MASTER_KEY), _TABLE_ID, infile,
+                      outfile)
+    self.assertFalse(os.path.exists(outfile))
+
+  def testConvertDataFileWhenInvalidLeavesOutfile(self):
+    master_key = base64.b64decode(_MASTER_KEY)
+    schema = json.loads(
+        '[{"name": "n", "type": "integer", "encrypt": "none"}]')
+    load_lib._ModifyFields(schema)
+    outfile = os.path.join(self.dirname, 'invalid.out')
+    for convert, data in [(load_lib.ConvertCsvDataFile, '1\n2\nx\n'),
+                          (load_lib.ConvertJsonDataFile,
+                           '{"n": 1}\n{"n": "x"}\n')]:
+      self._SetupTestFlags()
+      infile = os.path.join(self.dirname, 'invalid.in')
+      with open(infile, 'wt') as f:
+        f.write(data)
+      with open(outfile, 'wt') as f:
+        f.write('previous')
+      self.assertRaises(load_lib.EncryptConvertError, convert, schema,
+                        master_key, _TABLE_ID, infile, outfile)
+      with open(outfile, 'rt') as f:
+        self.assertEqual('previous', f.read())
+      self.assertEqual(['invalid.in', 'invalid.out'],
+                       sorted(name for name in os.listdir(self.dirname)
+                              if name.startswith('invalid.')))
+
+  def testConvertJsonDataFileWithPackingGroup(self):
+    schema = json.loads(_PACKED_SCHEMA)
+    load_lib._ModifyFields(schema)
+    infile = os.path.join(self.dirname, 'packed.json')
+    with open(infile, 'wt') as f:
+      f.write('{"a": 1, "b": "x", "c": -2}\n')
+    outfile = os.path.join(self.dirname, 'packed.enc_json')
+    master_key = base64.b64decode(_MASTER_KEY)
+    load_lib.ConvertJsonDataFile(schema, master_key, _TABLE_ID, infile, outfile)
+    cipher = ecrypto.GetCipherSuite(
+        master_key, _TABLE_ID).homomorphic_int_cipher
+    with open(outfile, 'rt') as f:
+      row = json.loads(f.readline())
+    self.assertEqual(
+        set(['b', util.HOMOMORPHIC_PACKED_INT_PREFIX + 'm']), set(row))
+    self.assertEqual([1, -2], cipher.DecryptMultiple(
+        str(row[util.HOMOMORPHIC_PACKED_INT_PREFIX + 'm']))[-2:])
+
+  def testCompileJsonEncoder(self):
+    """Test _CompileJsonEncoder()."""
+    cipher_suite = self.mox.CreateMockAnything()
+    self.mox.ReplayAll()
 
     dt = '1464290907.0'
     dt_f = 1464290907.0
@@ -560,8 +895,56 @@ class LoadLibraryTest(googletest.TestCase):
             'encrypt': 'none'
         }
     ]
-    r = load_lib._ConvertJsonField(data, schema, *c)
+    r = load_lib._CompileJsonEncoder(schema, cipher_suite)(data)
     self.assertEqual(r, {'dt': dt_f})
+    self.mox.VerifyAll()
+
+  def testCompileJsonEncoderValidates(self):
+    """Test _CompileJsonEncoder() on records not matching the schema."""
+    cipher_suite = ecrypto.GetCipherSuite(
+        base64.b64decode(_MASTER_KEY), _TABLE_ID)
+    encode_record = load_lib._CompileJsonEncoder(
+        test_util.GetJobsSchema(), cipher_suite)
+    for line in test_util.GetJobsJson().splitlines():
+      encode_record(json.loads(line))
+    for line in test_util.GetJobsJson().splitlines():
+      bad_data = [
+          json.loads(line)['citiesLived'],
+          dict(json.loads(line), age='x'),
+          dict(json.loads(line), citiesLived={}),
+          dict(json.loads(line), citiesLived=[{'place': 'Paris'}]),
+      ]
+      no_kind = json.loads(line)
+      del no_kind['kind']
+      bad_data.append(no_kind)
+      for data in bad_data:
+        self.assertRaises(load_lib.EncryptConvertError, encode_record, data)
+
+  def testCompileJsonEncoderBenchmark(self):
+    """Logs jobs json conversion rates, with and without Paillier fields."""
+    master_key = base64.b64decode(_MASTER_KEY)
+    cipher_suite = ecrypto.GetCipherSuite(master_key, _TABLE_ID)
+
+    def WithoutHomomorphic(schema):
+      for field in schema:
+        if field.get('encrypt') == 'homomorphic':
+          field['encrypt'] = load_lib.NONE
+        WithoutHomomorphic(field.get('fields', []))
+      return schema
+
+    lines = test_util.GetJobsJson().splitlines() * 100
+    for name, schema in [
+        ('all fields', test_util.GetJobsSchema()),
+        ('non homomorphic fields',
+         WithoutHomomorphic(test_util.GetJobsSchema()))]:
+      encode_record = load_lib._CompileJsonEncoder(schema, cipher_suite)
+      start = time.time()
+      for line in lines:
+        json.dumps(encode_record(json.loads(line)))
+      seconds_per_record = max(time.time() - start, 1e-9) / len(lines)
+      logging.info('jobs json, %s: %.0f records/second, %.0f seconds per '
+                   'million records', name, 1 / seconds_per_record,
+                   seconds_per_record * 1e6)
 
   def testConvertJsonDataFile(self):
     schema = json.loads(test_util.GetPlacesSchemaString())
@@ -571,9 +954,12 @@ class LoadLibraryTest(googletest.TestCase):
     string_hasher = ecrypto.StringHash(
         ecrypto.GenerateStringHashKey(master_key, _TABLE_ID))
     load_lib.ConvertJsonDataFile(schema, master_key, _TABLE_ID, infile, outfile)
-    # validate new data file against new rewritten schema.
+    # records of the new data file only have fields of the rewritten schema.
     new_schema = json.loads(_PLACES_REWRITTEN_SCHEMA)
-    load_lib._ValidateJsonDataFile(new_schema, outfile)
+    with open(outfile, 'rt') as f:
+      for line in f:
+        self.assertLessEqual(set(json.loads(line)),
+                             set(field['name'] for field in new_schema))
     fout = open(outfile, 'rt')
     for line in fout:
       data = json.loads(line)
@@ -623,9 +1009,12 @@ class LoadLibraryTest(googletest.TestCase):
     string_hasher = ecrypto.StringHash(
         ecrypto.GenerateStringHashKey(master_key, _TABLE_ID))
     load_lib.ConvertJsonDataFile(schema, master_key, _TABLE_ID, infile, outfile)
-    # validate new data file against new rewritten schema.
+    # records of the new data file only have fields of the rewritten schema.
     new_schema = json.loads(_JOBS_REWRITTEN_SCHEMA)
-    load_lib._ValidateJsonDataFile(new_schema, outfile)
+    with open(outfile, 'rt') as f:
+      for line in f:
+        self.assertLessEqual(set(json.loads(line)),
+                             set(field['name'] for field in new_schema))
     fout = open(outfile, 'rt')
     for line in fout:
       data = json.loads(line)
@@ -658,24 +1047,6 @@ class LoadLibraryTest(googletest.TestCase):
                                              u'manager'][0].split(' ')), 4)
     fout.close()
 
-  def testValidateJsonField(self):
-    """Test _ValidateJsonField()."""
-    ts = '1464288851.0'
-    schema = [{
-        'name': 'dt',
-        'type': 'timestamp',
-        'mode': 'required',
-        'encrypt': 'none',
-    }]
-    data = {
-        'dt': ts,
-    }
-    self.mox.StubOutWithMock(load_lib, '_ValidateDataType')
-    load_lib._ValidateDataType('timestamp', ts).AndReturn(None)
-    self.mox.ReplayAll()
-    load_lib._ValidateJsonField(data, schema, 1)
-    self.mox.VerifyAll()
-
   def testUtf8CsvReader(self):
     """Test _Utf8CsvReader()."""
     self._SetupTestFlags()
@@ -792,7 +1163,9 @@ class LoadLibraryTest(googletest.TestCase):
     load_lib.ConvertJsonDataFile(
         schema, master_key, table_id, infile.name, outfile.name)
     # compare as json loaded structure because serialized format is unstable
-    json_output = json.loads(outfile.read())
+    # (outfile was replaced, so read it again by name).
+    with open(outfile.name) as f:
+      json_output = json.loads(f.read())
     self.assertEqual(json_output, json_after)
 
   def testConvertJsonDataFileUSuffixRegression(self):
@@ -820,45 +1193,44 @@ class LoadLibraryTest(googletest.TestCase):
     load_lib.ConvertJsonDataFile(
         schema, master_key, table_id, infile.name, outfile.name)
     # compare as json loaded structure because serialized format is unstable
-    json_output = json.loads(outfile.read())
+    # (outfile was replaced, so read it again by name).
+    with open(outfile.name) as f:
+      json_output = json.loads(f.read())
     self.assertEqual(json_output, json_after)
 
-  def testConvertDataTypeWhenFloatTimestamp(self):
-    """Test _ConvertDataType() with a timestamp data value of float."""
+  def testCompileJsonValueWhenFloatTimestamp(self):
+    """Test _CompileJsonValue() with a timestamp data value of float."""
     data_value = 1467922225.0
     encrypt_type = load_lib.NONE
     schema = {'name': 'foo', 'type': 'timestamp', 'encrypt': encrypt_type}
-    cipher = self.mox.CreateMockAnything()
+    cipher_suite = self.mox.CreateMockAnything()
     self.mox.ReplayAll()
-    output = load_lib._ConvertDataType(
-        data_value, encrypt_type, schema, cipher, cipher, cipher, cipher,
-        cipher)
+    output = load_lib._CompileJsonValue(
+        encrypt_type, schema, cipher_suite)(data_value)
     self.assertEqual(output, str(data_value))
     self.mox.VerifyAll()
 
-  def testConvertDataTypeWhenNoneTimestamp(self):
-    """Test _ConvertDataType() with a timestamp data value of None."""
+  def testCompileJsonValueWhenNoneTimestamp(self):
+    """Test _CompileJsonValue() with a timestamp data value of None."""
     data_value = None
     encrypt_type = load_lib.NONE
     schema = {'name': 'foo', 'type': 'timestamp', 'encrypt': encrypt_type}
-    cipher = self.mox.CreateMockAnything()
+    cipher_suite = self.mox.CreateMockAnything()
     self.mox.ReplayAll()
-    output = load_lib._ConvertDataType(
-        data_value, encrypt_type, schema, cipher, cipher, cipher, cipher,
-        cipher)
+    output = load_lib._CompileJsonValue(
+        encrypt_type, schema, cipher_suite)(data_value)
     self.assertEqual(output, None)
     self.mox.VerifyAll()
 
-  def testConvertDataTypeWhenEmptyTimestamp(self):
-    """Test _ConvertDataType() with a timestamp data value of empty str."""
+  def testCompileJsonValueWhenEmptyTimestamp(self):
+    """Test _CompileJsonValue() with a timestamp data value of empty str."""
     data_value = ''
     encrypt_type = load_lib.NONE
     schema = {'name': 'foo', 'type': 'timestamp', 'encrypt': encrypt_type}
-    cipher = self.mox.CreateMockAnything()
+    cipher_suite = self.mox.CreateMockAnything()
     self.mox.ReplayAll()
-    output = load_lib._ConvertDataType(
-        data_value, encrypt_type, schema, cipher, cipher, cipher, cipher,
-        cipher)
+    output = load_lib._CompileJsonValue(
+        encrypt_type, schema, cipher_suite)(data_value)
     self.assertEqual(output, None)
     self.mox.VerifyAll()
 
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Local cache of the EBQ metadata of tables.
+
+Every query and load needs the creation time of its table, from which the
+cipher keys are derived, and the EBQ description: the hash of the master key,
+the table version and the encrypted schema. The cache keeps these, with the
+schema decrypted, in one file per table under --table_metadata_cache_dir. Each
+file is encrypted with a key derived from the master key and the table
+reference, and is named after a hash of that key, so the cache reveals neither
+table names nor schemas. An HMAC of the ciphertext under a second derived key
+is appended to each file, so entries cannot be altered without the master key.
+"""
+
+
+
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import time
+
+import gflags as flags
+
+import ebq_crypto as ecrypto
+
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('table_metadata_cache_dir', None,
+                    'The path of a directory where the metadata of queried '
+                    'and loaded tables is cached, encrypted under the master '
+                    'key. By default no metadata is cached.')
+flags.DEFINE_integer('table_metadata_cache_ttl', 300,
+                     'Number of seconds during which queries use cached table '
+                     'metadata without checking that the table is unchanged. '
+                     'Loads always check the etag and last modified time.')
+
+# length of the hex HMAC-SHA256 at the end of each cache file.
+_MAC_LEN = 64
+
+
+class TableMetadataCache(object):
+  """Cache of table metadata, see the module docstring.
+
+  Entries are dicts with the keys 'creation_time', 'hashed_key', 'version' and
+  'schema', as well as 'etag' and 'last_modified' copied from the table
+  resource they were read from.
+  """
+
+  # pylint: disable=invalid-name
+  def __init__(self, cache_dir, master_key, ttl, _time=time.time):
+    """Cache is initialized with its directory, master key and ttl (seconds)."""
+    self._cache_dir = cache_dir
+    self._master_key = master_key
+    self._ttl = ttl
+    self._time = _time
+
+  def _GetPathAndCipher(self, reference):
+    key = ecrypto.GenerateTableMetadataKey(self._master_key, reference)
+    path = os.path.join(self._cache_dir, hashlib.sha1(key).hexdigest())
+    return path, ecrypto.ProbabilisticCipher(key)
+
+  def _Mac(self, reference, ciphertext):
+    # table references never contain '|', so this key is distinct from the
+    # encryption key of every table.
+    key = ecrypto.GenerateTableMetadataKey(self._master_key, reference + '|mac')
+    return hmac.new(key, ciphertext, hashlib.sha256).hexdigest()
+
+  def Get(self, reference):
+    """Returns the cached entry of reference, or None.
+
+    Args:
+      reference: str, the table reference.
+
+    Returns:
+      the entry dict with an extra 'cached_at' time, or None if reference is
+      not cached or its file is not authentic under the master key.
+    """
+    path, cipher = self._GetPathAndCipher(reference)
+    try:
+      with open(path, 'rb') as f:
+        contents = f.read()
+    except IOError:
+      return None
+    ciphertext, mac = contents[:-_MAC_LEN], contents[-_MAC_LEN:]
+    if not hmac.compare_digest(mac, self._Mac(reference, ciphertext)):
+      return None
+    try:
+      entry = json.loads(cipher.Decrypt(ciphertext))
+    except (TypeError, ValueError):
+      return None
+    if (not isinstance(entry, dict) or entry.get('reference') != reference or
+        not isinstance(entry.get('cached_at'), (int, long, float))):
+      return None
+    return entry
+
+  def IsFresh(self, entry):
+    """Returns whether entry was cached less than the ttl ago."""
+    return 0 <= self._time() - entry['cached_at'] < self._ttl
+
+  def Put(self, reference, entry):
+    """Caches entry for reference, see TableMetadataCache."""
+    entry = dict(entry, reference=reference, cached_at=self._time())
+    path, cipher = self._GetPathAndCipher(reference)
+    if not os.path.isdir(self._cache_dir):
+      os.makedirs(self._cache_dir, 0700)
+    fd, temp_path = tempfile.mkstemp(dir=self._cache_dir)
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        ciphertext = cipher.Encrypt(json.dumps(entry))
+        f.write(ciphertext + self._Mac(reference, ciphertext))
+      os.rename(temp_path, path)
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def Remove(self, reference):
+    """Removes the entry of reference, if cached."""
+    path, _ = self._GetPathAndCipher(reference)
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+
+def IsUnchanged(entry, object_info):
+  """Returns whether a cached entry was read from the table object_info.
+
+  Args:
+    entry: dict, as returned by TableMetadataCache.Get.
+    object_info: dict, the table resource.
+  """
+  if 'etag' not in object_info and 'lastModifiedTime' not in object_info:
+    return False
+  return (entry['etag'] == object_info.get('etag') and
+          entry['last_modified'] == object_info.get('lastModifiedTime') and
+          entry['creation_time'] == object_info.get('creationTime'))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Unit test for metadata_cache module."""
+
+
+
+import json
+import os
+import shutil
+import tempfile
+
+from google.apputils import app
+import logging
+from google.apputils import basetest as googletest
+
+import metadata_cache
+
+_KEY1 = '0123456789abcdef'
+_KEY2 = 'fedcba9876543210'
+_ENTRY = {
+    'creation_time': '1400000000000',
+    'hashed_key': 'hashed key',
+    'version': '1',
+    'schema': [{'name': 'Year', 'type': 'integer', 'encrypt': 'none'}],
+    'etag': 'etag1',
+    'last_modified': '1400000000001',
+}
+
+
+class TableMetadataCacheTest(googletest.TestCase):
+
+  def setUp(self):
+    """Run once for each test in the class."""
+    self.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+    self.now = 1000.0
+    self.cache = metadata_cache.TableMetadataCache(
+        self.cache_dir, _KEY1, 300, _time=lambda: self.now)
+
+  def tearDown(self):
+    shutil.rmtree(os.path.dirname(self.cache_dir))
+
+  def testPutGet(self):
+    logging.debug('Running testPutGet method.')
+    self.assertEqual(None, self.cache.Get('dataset.cars'))
+    self.cache.Put('dataset.cars', _ENTRY)
+    entry = self.cache.Get('dataset.cars')
+    for key, value in _ENTRY.iteritems():
+      self.assertEqual(value, entry[key])
+    self.assertEqual(1000.0, entry['cached_at'])
+    self.assertEqual(None, self.cache.Get('dataset.jobs'))
+    # files are encrypted and do not reveal the table.
+    [name] = os.listdir(self.cache_dir)
+    with open(os.path.join(self.cache_dir, name)) as f:
+      contents = f.read()
+    self.assertFalse('cars' in contents or 'Year' in contents)
+    self.assertFalse('cars' in name)
+    self.cache.Remove('dataset.cars')
+    self.assertEqual(None, self.cache.Get('dataset.cars'))
+    self.cache.Remove('dataset.cars')
+
+  def testGetWithOtherMasterKey(self):
+    logging.debug('Running testGetWithOtherMasterKey method.')
+    self.cache.Put('dataset.cars', _ENTRY)
+    other_cache = metadata_cache.TableMetadataCache(self.cache_dir, _KEY2, 300)
+    self.assertEqual(None, other_cache.Get('dataset.cars'))
+    # corrupt files are misses.
+    [name] = os.listdir(self.cache_dir)
+    with open(os.path.join(self.cache_dir, name), 'wb') as f:
+      f.write('garbage')
+    self.assertEqual(None, self.cache.Get('dataset.cars'))
+
+  def testGetWhenTampered(self):
+    logging.debug('Running testGetWhenTampered method.')
+    self.cache.Put('dataset.cars', _ENTRY)
+    [name] = os.listdir(self.cache_dir)
+    path = os.path.join(self.cache_dir, name)
+    with open(path, 'rb') as f:
+      contents = f.read()
+    for i in [0, len(contents) // 2, len(contents) - 1]:
+      with open(path, 'wb') as f:
+        f.write(contents[:i] + chr(ord(contents[i]) ^ 1) + contents[i + 1:])
+      self.assertEqual(None, self.cache.Get('dataset.cars'))
+    # authentic entries that are not dicts are misses too.
+    path, cipher = self.cache._GetPathAndCipher('dataset.cars')
+    for value in [[], 'entry', {'reference': 'dataset.cars'}]:
+      ciphertext = cipher.Encrypt(json.dumps(value))
+      with open(path, 'wb') as f:
+        f.write(ciphertext + self.cache._Mac('dataset.cars', ciphertext))
+      self.assertEqual(None, self.cache.Get('dataset.cars'))
+
+  def testIsFresh(self):
+    logging.debug('Running testIsFresh method.')
+    self.cache.Put('dataset.cars', _ENTRY)
+    entry = self.cache.Get('dataset.cars')
+    self.now += 299
+    self.assertTrue(self.cache.IsFresh(entry))
+    self.now += 1
+    self.assertFalse(self.cache.IsFresh(entry))
+
+  def testIsUnchanged(self):
+    logging.debug('Running testIsUnchanged method.')
+    object_info = {'creationTime': '1400000000000', 'etag': 'etag1',
+                   'lastModifiedTime': '1400000000001'}
+    self.assertTrue(metadata_cache.IsUnchanged(_ENTRY, object_info))
+    for key, value in [('etag', 'etag2'), ('lastModifiedTime', '1'),
+                       ('creationTime', '1')]:
+      changed_info = dict(object_info)
+      changed_info[key] = value
+      self.assertFalse(metadata_cache.IsUnchanged(_ENTRY, changed_info))
+    self.assertFalse(metadata_cache.IsUnchanged(
+        dict(_ENTRY, etag=None, last_modified=None),
+        {'creationTime': '1400000000000'}))
+
+
+def main(_):
+  googletest.main()
+
+
+if __name__ == '__main__':
+  app.run()
@@ -5,12 +5,28 @@
 
 
 
+import binascii
 import math
-import struct
 
 import common_crypto as ccrypto
 
 
+def _SmallOddPrimes(limit):
+  """Returns the odd primes below limit, by the sieve of Eratosthenes."""
+  is_prime = bytearray([1]) * limit
+  for i in xrange(3, int(math.sqrt(limit)) + 1, 2):
+    if is_prime[i]:
+      is_prime[i * i::2 * i] = bytearray(len(xrange(i * i, limit, 2 * i)))
+  return [i for i in xrange(3, limit, 2) if is_prime[i]]
+
+
+# Candidates of GetPrime with a factor in this table are skipped without a
+# primality test.
+_SIEVE_PRIMES = _SmallOddPrimes(2048)
+# Number of consecutive odd candidates sieved at a time.
+_SIEVE_WINDOW = 1024
+
+
 def GCD(arg0, arg1):
   """Computes the greatest common divisor of given inputs."""
   # Euclidean algorithm is used to compute GCD.
@@ -76,13 +92,63 @@ def GetRandomNumber(bit_length, rand_func=None):
 
 
 def GetPrime(bit_length, rand_func=None):
-  """Generates N bit random prime number."""
-  number = GetRandomNBitOddNumber(bit_length, rand_func)
-  while not IsPrime(number):
-    number += 2
-    if number >= 2 ** bit_length:
-      number = GetRandomNBitOddNumber(bit_length, rand_func)
-  return number
+  """Generates N bit random prime number.
+
+  The prime is the first one found scanning upwards through odd numbers from a
+  random N bit starting point, which is drawn again if the scan runs past N
+  bits. Only the starting points consume output of rand_func, so the prime is
+  deterministic for a deterministic rand_func.
+
+  Args:
+    bit_length: number of bits of the prime.
+    rand_func: function returning a given number of random bytes, defaults to
+      ccrypto.GetRandBytes.
+
+  Returns:
+    a long, prime with high probability.
+  """
+  upper_limit = 2 ** bit_length
+  while True:
+    start = GetRandomNBitOddNumber(bit_length, rand_func)
+    for candidate in _SievedCandidates(start, upper_limit):
+      if _FermatBaseTwoTest(candidate) and IsPrime(candidate):
+        return candidate
+
+
+def _SievedCandidates(start, upper_limit):
+  """Yields odd numbers in [start, upper_limit) without small prime factors.
+
+  Args:
+    start: odd long, first candidate.
+    upper_limit: candidates are less than this.
+
+  Yields:
+    in increasing order, odd numbers from start which are either in
+    _SIEVE_PRIMES or not divisible by any of them.
+  """
+  # residues of the first candidate of the current window, updated per window.
+  residues = [start % p for p in _SIEVE_PRIMES]
+  window_start = start
+  while window_start < upper_limit:
+    size = min(_SIEVE_WINDOW, (upper_limit - window_start + 1) // 2)
+    composite = bytearray(size)
+    for j, p in enumerate(_SIEVE_PRIMES):
+      # index i holds window_start + 2 * i, and (p + 1) / 2 is 1/2 mod p.
+      i = (p - residues[j]) * ((p + 1) // 2) % p
+      if window_start + 2 * i == p:
+        i += p  # p itself is prime.
+      if i < size:
+        composite[i::p] = '\x01' * len(xrange(i, size, p))
+      residues[j] = (residues[j] + 2 * size) % p
+    for i in xrange(size):
+      if not composite[i]:
+        yield window_start + 2 * i
+    window_start += 2 * size
+
+
+def _FermatBaseTwoTest(number):
+  """Returns False if number is composite by Fermat's test with base 2."""
+  return pow(2, number - 1, number) == 1
 
 
 def IsPrime(number, error_probability=1e-6):
@@ -96,28 +162,17 @@ def IsPrime(number, error_probability=1e-6):
 
 def LongToBytes(number):
   """Converts an arbitrary length number to a byte string."""
-  number_32bitunit_components = []
-  if number == 0:
-    return struct.Struct('>I').pack(0)
-  while number != 0:
-    number_32bitunit_components.insert(0, number & 0xffffffff)
-    number >>= 32
-  converter = struct.Struct('>' + str(len(number_32bitunit_components)) + 'I')
-  return converter.pack(*number_32bitunit_components)
+  hex_string = '%x' % number
+  # pad to a multiple of 4 bytes, as a big endian sequence of 32 bit units.
+  padded_length = max(8, -(-len(hex_string) // 8) * 8)
+  return binascii.unhexlify(hex_string.zfill(padded_length))
 
 
 def BytesToLong(byte_string):
   """Converts given byte string to a long."""
-  result = 0
-  (component_length, remainder) = divmod(len(byte_string), 4)
-  if remainder:
-    component_length += 1
-    byte_string = byte_string.rjust(component_length * 4, '\0')
-  converter = struct.Struct('>' + str(component_length) + 'I')
-  unpacked_data = converter.unpack(byte_string)
-  for i in range(0, component_length):
-    result += unpacked_data[i] << (32 * (component_length - i - 1))
-  return result
+  if not byte_string:
+    return 0L
+  return long(binascii.hexlify(byte_string), 16)
 
 
 def _RabinMillerTest(number, rounds):
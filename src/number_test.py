@@ -10,6 +10,7 @@ import struct
 from google.apputils import app
 from google.apputils import basetest as googletest
 
+import common_crypto as ccrypto
 import number
 
 
@@ -63,6 +64,29 @@ class NumberTheoryTest(googletest.TestCase):
       prime_number = number.GetPrime(20)
       self.assertTrue(prime_number < 2**20 and number.IsPrime(prime_number))
 
+  def testGetPrimeDeterministicPerSeed(self):
+    def _UnsievedGetPrime(bit_length, rand_func):
+      candidate = number.GetRandomNBitOddNumber(bit_length, rand_func)
+      while not number.IsPrime(candidate):
+        candidate += 2
+        if candidate >= 2 ** bit_length:
+          candidate = number.GetRandomNBitOddNumber(bit_length, rand_func)
+      return candidate
+
+    for bit_length in [4, 11, 12, 64, 512]:
+      for seed in ['0123456789abcdef', 'fedcba9876543210']:
+        self.assertEqual(
+            _UnsievedGetPrime(bit_length, ccrypto.PRG(seed).GetNextBytes),
+            number.GetPrime(bit_length, ccrypto.PRG(seed).GetNextBytes))
+
+  def testSievedCandidates(self):
+    candidates = list(number._SievedCandidates(5, 2 ** 12))
+    self.assertEqual([p for p in xrange(5, 2 ** 12, 2) if number.IsPrime(p)],
+                     [c for c in candidates if number.IsPrime(c)])
+    for c in candidates:
+      self.assertTrue(c in number._SIEVE_PRIMES or
+                      all(c % p for p in number._SIEVE_PRIMES))
+
   def testIsPrime(self):
     self.assertTrue(number.IsPrime(373))
     self.assertTrue(number.IsPrime(2963))
@@ -78,6 +102,7 @@ class NumberTheoryTest(googletest.TestCase):
     self.assertTrue(number.IsPrime(98764321234333546549887553))
 
   def testBytesToLong(self):
+    self.assertEqual(0, number.BytesToLong(''))
     self.assertEqual(205, number.BytesToLong('\xcd'))
     self.assertEqual(64, number.BytesToLong('\x00\x00\x00\x40'))
     self.assertEqual(64, number.BytesToLong('\x40'))
@@ -93,6 +118,7 @@ class NumberTheoryTest(googletest.TestCase):
                      number.BytesToLong(struct.pack('>6I', 1, 1, 1, 1, 1, 7)))
 
   def testLongToBytes(self):
+    self.assertEqual(struct.pack('>I', 0), number.LongToBytes(0))
     self.assertEqual(struct.pack('>I', 3), number.LongToBytes(3))
     self.assertEqual(struct.pack('>2I', 1, 7), number.LongToBytes(4294967303))
     self.assertEqual(struct.pack('>3I', 1, 0, 0), number.LongToBytes(2 ** 64))
@@ -5,11 +5,20 @@
 
 
 
+import base64
+import collections
 import ctypes
 import ctypes.util
+import errno
+import hashlib
+import hmac
 import math
+import os
 import platform
+import Queue
 import struct
+import threading
+import time
 
 import logging
 from google.apputils import resources
@@ -17,6 +26,16 @@ from google.apputils import resources
 import common_crypto as ccrypto
 import number
 
+try:
+  import gmpy2  # pylint: disable=g-import-not-at-top
+except ImportError:
+  gmpy2 = None
+
+try:
+  import numpy  # pylint: disable=g-import-not-at-top
+except ImportError:
+  numpy = None
+
  # number of int64s that can be packed into a single Paillier payload.
 PACKING_LIMIT = 7
 # 96 bits are used to represent signed int64s to detect overflows and
@@ -49,10 +68,16 @@ FLOAT_MANTISSA_LSB = FLOAT_SIGN_LOW_LSB - MANTISSA_BITS  # 778
 FLOAT_MANTISSA_ZERO = FLOAT_MANTISSA_LSB / 2  # 389
 _ONES_CARRYOVER_LSB = long('1' * FLOAT_CARRYOVER_LSB, 2)
 _ONES_FLOAT_SIGN_LOW_LSB = long('1' * FLOAT_SIGN_LOW_LSB, 2)
+# Defaults for the optional pool of precomputed randomizers.
+DEFAULT_RANDOMIZER_HIGH_WATER_MARK = 1024
+DEFAULT_RANDOMIZER_WORKERS = 2
+# File, next to ~/.bigqueryrc, recording the big integer backend picked by
+# CalibrateBackends.
+BACKEND_CONFIG_PATH = os.path.join(os.path.expanduser('~'),
+                                   '.ebq_bigint_backend')
 
 # -- openssl function args and return types
 _FOUND_SSL = False
-_TESTED_SSL = False
 try:
   if platform.system() == 'Windows':
     ssl_libpath = ctypes.util.find_library('libeay32')
@@ -84,6 +109,18 @@ if _FOUND_SSL:
   ssl.BN_mod_exp.restype = ctypes.c_int
   ssl.BN_mod_exp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
                              ctypes.c_void_p, ctypes.c_void_p]
+  ssl.BN_MONT_CTX_new.restype = ctypes.c_void_p
+  ssl.BN_MONT_CTX_new.argtypes = []
+  ssl.BN_MONT_CTX_free.argtypes = [ctypes.c_void_p]
+  ssl.BN_MONT_CTX_set.restype = ctypes.c_int
+  ssl.BN_MONT_CTX_set.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                  ctypes.c_void_p]
+  ssl.BN_mod_exp_mont.restype = ctypes.c_int
+  ssl.BN_mod_exp_mont.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                  ctypes.c_void_p, ctypes.c_void_p,
+                                  ctypes.c_void_p, ctypes.c_void_p]
+# Maximum number of moduli whose Montgomery setup a BignumSession keeps.
+_MAX_CACHED_MODULI = 16
 
 
 class Paillier(object):
@@ -116,14 +153,18 @@ class Paillier(object):
       self.n = n
       self.nsquare = n * n
       self.g = g
+      self._g_is_n_plus_one = (g == n + 1)
       self.__lambda = Lambda
       self.__mu = mu
+      self.__crt_params = None
+      self._randomizer_pool = None
       return
     if not isinstance(seed, str):
       raise ValueError('Expected string type data for seed, but got: %s' %
                        type(seed))
     if not seed:
       raise ValueError('Provided seed cannot be empty')
+    self._randomizer_pool = None
     prg = ccrypto.PRG(seed)
     n_len = 0
     while n_len != N_LENGTH:
@@ -135,9 +176,29 @@ class Paillier(object):
     # Simpler paillier variant with g=n+1 results in lamda equal to phi
     # and mu is phi inverse mod n.
     self.g = self.n + 1
+    self._g_is_n_plus_one = True
     phi_n = (p-1) * (q-1)
     self.__lambda = phi_n
     self.__mu = number.Inverse(phi_n, self.n)
+    self.__crt_params = self._ComputeCrtParams(p, q)
+
+  def _ComputeCrtParams(self, p, q):
+    """Precomputes constants for Chinese Remainder Theorem based decryption.
+
+    Args:
+      p: Long integer, prime factor of n.
+      q: Long integer, the other prime factor of n.
+
+    Returns:
+      a tuple of (p, q, p^2, q^2, hp, hq, p^-1 mod q), where hp and hq are
+      the inverses of L_p(g^(p-1) mod p^2) mod p and L_q(g^(q-1) mod q^2) mod q.
+    """
+    psquare = p * p
+    qsquare = q * q
+    hp = number.Inverse((ModExp(self.g, p - 1, psquare) - 1) // p, p)
+    hq = number.Inverse((ModExp(self.g, q - 1, qsquare) - 1) // q, q)
+    p_inverse = number.Inverse(p, q)
+    return p, q, psquare, qsquare, hp, hq, p_inverse
 
   def Encrypt(self, plaintext, r_value=None):
     """Paillier encryption of plaintext.
@@ -157,9 +218,62 @@ class Paillier(object):
     if not isinstance(plaintext, int) and not isinstance(plaintext, long):
       raise ValueError('Expected int or long type plaintext but got: %s' %
                        type(plaintext))
-    r = r_value or self._GetRandomFromZNStar(N_LENGTH, self.n)
-    return (ModExp(self.g, plaintext, self.nsquare) *
-            ModExp(r, self.n, self.nsquare)) % self.nsquare
+    if r_value:
+      r_to_n = ModExp(r_value, self.n, self.nsquare)
+    elif self._randomizer_pool is not None:
+      r_to_n = self._randomizer_pool.Get()
+    else:
+      r_to_n = self.ComputeRandomizer()
+    return (self._GToThe(plaintext) * r_to_n) % self.nsquare
+
+  def _GToThe(self, exponent):
+    """Returns g^exponent mod n^2, in closed form when g = n + 1."""
+    if self._g_is_n_plus_one:
+      # by the binomial theorem (1 + n)^m = 1 + m*n mod n^2.
+      return (1 + exponent % self.n * self.n) % self.nsquare
+    return ModExp(self.g, exponent, self.nsquare)
+
+  def ComputeRandomizer(self):
+    """Returns r^n mod n^2 for a fresh random r, independent of plaintexts."""
+    r = self._GetRandomFromZNStar(N_LENGTH, self.n)
+    return ModExp(r, self.n, self.nsquare)
+
+  def ComputeRandomizers(self, count):
+    """Returns count values r^n mod n^2, each for a fresh random r."""
+    return ModExpMany(
+        [self._GetRandomFromZNStar(N_LENGTH, self.n) for _ in xrange(count)],
+        self.n, self.nsquare)
+
+  def SetRandomizerPool(self, pool):
+    """Draws randomizers for Encrypt from pool, or computes them if None."""
+    self._randomizer_pool = pool
+
+  def EncryptMany(self, plaintexts):
+    """Paillier encryption of a batch of plaintexts.
+
+    The randomizers for the whole batch are computed with a single call to
+    ModExpMany (or drawn from the randomizer pool, if one is set).
+
+    Args:
+      plaintexts: list of ints or longs to be paillier encrypted.
+
+    Returns:
+      a list of longs, the paillier encryptions in the order of plaintexts.
+
+    Raises:
+      ValueError: if any plaintext is neither int nor long.
+    """
+    for plaintext in plaintexts:
+      if not isinstance(plaintext, (int, long)):
+        raise ValueError('Expected int or long type plaintext but got: %s' %
+                         type(plaintext))
+    if self._randomizer_pool is not None:
+      r_to_ns = [self._randomizer_pool.Get() for _ in plaintexts]
+    else:
+      r_to_ns = self.ComputeRandomizers(len(plaintexts))
+    nsquare = self.nsquare
+    return [(self._GToThe(plaintext) * r_to_n) % nsquare
+            for plaintext, r_to_n in zip(plaintexts, r_to_ns)]
 
   def Decrypt(self, ciphertext):
     """Paillier decryption of ciphertext.
@@ -176,10 +290,58 @@ class Paillier(object):
     if not isinstance(ciphertext, int) and not isinstance(ciphertext, long):
       raise ValueError('Expected int or long type ciphertext but got: %s' %
                        type(ciphertext))
+    if self.__crt_params is not None:
+      return self._DecryptCrt(ciphertext)
     u = ModExp(ciphertext, self.__lambda, self.nsquare)
     l_of_u = (u - 1) // self.n
     return (l_of_u * self.__mu) % self.n
 
+  def DecryptMany(self, ciphertexts):
+    """Paillier decryption of a batch of ciphertexts.
+
+    Args:
+      ciphertexts: list of longs that are to be paillier decrypted.
+
+    Returns:
+      a list of longs, the paillier decryptions in the order of ciphertexts.
+
+    Raises:
+      ValueError: if any ciphertext is neither int nor long.
+    """
+    for ciphertext in ciphertexts:
+      if not isinstance(ciphertext, (int, long)):
+        raise ValueError('Expected int or long type ciphertext but got: %s' %
+                         type(ciphertext))
+    if self.__crt_params is not None:
+      p, q, psquare, qsquare, hp, hq, p_inverse = self.__crt_params
+      ups = ModExpMany([c % psquare for c in ciphertexts], p - 1, psquare)
+      uqs = ModExpMany([c % qsquare for c in ciphertexts], q - 1, qsquare)
+      plaintexts = []
+      for up, uq in zip(ups, uqs):
+        mp = (up - 1) // p * hp % p
+        mq = (uq - 1) // q * hq % q
+        plaintexts.append(mp + p * ((mq - mp) * p_inverse % q))
+      return plaintexts
+    return [(u - 1) // self.n * self.__mu % self.n
+            for u in ModExpMany(ciphertexts, self.__lambda, self.nsquare)]
+
+  def _DecryptCrt(self, ciphertext):
+    """Paillier decryption using the factors of n.
+
+    Exponentiates modulo p^2 and q^2 separately, which is several times faster
+    than a single exponentiation modulo n^2, then recombines the two halves.
+
+    Args:
+      ciphertext: a long that is to be paillier decrypted.
+
+    Returns:
+      a long, representing paillier decryption of ciphertext.
+    """
+    p, q, psquare, qsquare, hp, hq, p_inverse = self.__crt_params
+    mp = (ModExp(ciphertext % psquare, p - 1, psquare) - 1) // p * hp % p
+    mq = (ModExp(ciphertext % qsquare, q - 1, qsquare) - 1) // q * hq % q
+    return mp + p * ((mq - mp) * p_inverse % q)
+
   # TODO(user): use a pluggable random generator here and other places to test
   # more of the code base.
   def _GetRandomFromZNStar(self, n_length, n):
@@ -216,7 +378,11 @@ class Paillier(object):
     # First multiply ciphertext with a
     a_mult_ciphertext = pow(ciphertext, a, self.nsquare)
     # Add b to it.
-    return a_mult_ciphertext * pow(self.g, b, self.nsquare) % self.nsquare
+    if self._g_is_n_plus_one:
+      g_to_b = self._GToThe(b)
+    else:
+      g_to_b = pow(self.g, b, self.nsquare)
+    return a_mult_ciphertext * g_to_b % self.nsquare
 
   def EncryptInt64(self, plaintext, r_value=None):
     """Paillier encryption of an Int64 plaintext.
@@ -241,14 +407,32 @@ class Paillier(object):
       ValueError: if not an int nor long, or less than MIN_INT64 or more than
         MAX_INT64.
     """
+    return self.Encrypt(self._EncodeInt64(plaintext), r_value=r_value)
+
+  def EncryptInt64s(self, plaintexts):
+    """Paillier encryption of a column of Int64 plaintexts.
+
+    Args:
+      plaintexts: list of 64 bit ints or longs, see EncryptInt64.
+
+    Returns:
+      a list of longs, the encryptions in the order of plaintexts.
+
+    Raises:
+      ValueError: if any plaintext is not an int nor long, or less than
+        MIN_INT64 or more than MAX_INT64.
+    """
+    return self.EncryptMany([self._EncodeInt64(p) for p in plaintexts])
+
+  def _EncodeInt64(self, plaintext):
+    """Validates an int64 and returns its 96 bit twos complement encoding."""
     if not isinstance(plaintext, int) and not isinstance(plaintext, long):
       raise ValueError('Expected int or long plaintext but got: %s' %
                        type(plaintext))
     if plaintext < MIN_INT64 or plaintext > MAX_INT64:
       raise ValueError('Int64 values need to be between %d and %d but got %d'
                        % (MIN_INT64, MAX_INT64, plaintext))
-    plaintext = self._Extend64bitTo96bitTwosComplement(plaintext)
-    return self.Encrypt(plaintext, r_value=r_value)
+    return self._Extend64bitTo96bitTwosComplement(plaintext)
 
   def EncryptMultipleInt64s(self, numberlist, r_value=None):
     """Paillier encryption of  multiple 64 bit integers into a single payload.
@@ -352,6 +536,22 @@ class Paillier(object):
     plaintext = self.Decrypt(ciphertext)
     return self._Unwrap96bitTo64bit(plaintext)
 
+  def DecryptInt64s(self, ciphertexts):
+    """Paillier decryption of a column of ciphertexts into int64 values.
+
+    Args:
+      ciphertexts: list of longs that are to be paillier decrypted into int64s.
+
+    Returns:
+      a list of longs, the decrypted int64 values in the order of ciphertexts.
+
+    Raises:
+      ValueError: if any ciphertext is neither int nor long.
+      OverflowError: if overflow is detected in a decrypted int.
+    """
+    return [self._Unwrap96bitTo64bit(plaintext)
+            for plaintext in self.DecryptMany(ciphertexts)]
+
   def EncryptFloat(self, plaintext, r_value=None):
     """Encrypt float (IEEE754 binary64bit) values with limited exponents.
 
@@ -387,8 +587,36 @@ class Paillier(object):
     """
     if not isinstance(plaintext, float):
       raise ValueError('Expected float plaintext but got: %s' % type(plaintext))
+    return self.Encrypt(
+        self._EncodeFloat(plaintext, _FloatsToBits([plaintext])[0]),
+        r_value=r_value)
+
+  def EncryptFloats(self, plaintexts):
+    """Paillier encryption of a column of floats, see EncryptFloat.
+
+    The IEEE754 bit patterns of the whole column are extracted at once (with
+    NumPy when it is installed).
+
+    Args:
+      plaintexts: list of floats to be paillier encrypted.
 
-    input_as_long = struct.unpack('Q', struct.pack('d', plaintext))[0]
+    Returns:
+      a list of longs, the encryptions in the order of plaintexts.
+
+    Raises:
+      ValueError: if any plaintext is not a float.
+    """
+    for plaintext in plaintexts:
+      if not isinstance(plaintext, float):
+        raise ValueError('Expected float plaintext but got: %s' %
+                         type(plaintext))
+    return self.EncryptMany(
+        [self._EncodeFloat(plaintext, input_as_long)
+         for plaintext, input_as_long
+         in zip(plaintexts, _FloatsToBits(plaintexts))])
+
+  def _EncodeFloat(self, plaintext, input_as_long):
+    """Returns the paillier payload of a float given its IEEE754 bits."""
     mantissa = (input_as_long & 0xfffffffffffff) | 0x10000000000000
     exponent = ((input_as_long >> 52) & 0x7ff) - EXPONENT_BIAS
     sign = input_as_long >> (EXPLICIT_MANTISSA_BITS + EXPONENT_BITS)
@@ -421,7 +649,7 @@ class Paillier(object):
       if sign == 1:  # neg number
         # make 895 bit (831 + 64 extended sign bits) 2s complement
         plaintext = (plaintext  ^ _ONES_CARRYOVER_LSB) + 1L
-    return self.Encrypt(plaintext, r_value=r_value)
+    return plaintext
 
   def DecryptFloat(self, ciphertext):
     """Paillier decryption of ciphertext into a IEEE754 binary64 float value.
@@ -435,7 +663,26 @@ class Paillier(object):
     Raises:
       ValueError: if nan, +inf or -inf is not set correctly in decrypted value.
     """
-    original_plaintext = self.Decrypt(ciphertext)
+    return self._DecodeFloat(self.Decrypt(ciphertext))
+
+  def DecryptFloats(self, ciphertexts):
+    """Paillier decryption of a column of ciphertexts into floats.
+
+    Args:
+      ciphertexts: list of longs that are to be paillier decrypted into floats.
+
+    Returns:
+      a list of floats, the decrypted values in the order of ciphertexts.
+
+    Raises:
+      ValueError: if nan, +inf or -inf is not set correctly in a decrypted
+        value.
+    """
+    return [self._DecodeFloat(plaintext)
+            for plaintext in self.DecryptMany(ciphertexts)]
+
+  def _DecodeFloat(self, original_plaintext):
+    """Returns the float represented by a decrypted paillier payload."""
     plaintext = original_plaintext
     mantissa_and_exponent = plaintext & _ONES_FLOAT_SIGN_LOW_LSB
     plaintext >>= FLOAT_SIGN_LOW_LSB  # >>= 831
@@ -516,6 +763,173 @@ class Paillier(object):
                      'bits aren\'t set correctly: %s' % hex(original_plaintext))
 
 
+class RandomizerPool(object):
+  """Pool of Paillier randomizers r^n mod n^2 precomputed in the background.
+
+  The randomizer is the most expensive part of a Paillier encryption and does
+  not depend on the plaintext, so it can be computed ahead of time by worker
+  threads (ModExp releases the GIL while in openssl). Every randomizer is handed
+  out at most once. Randomizers can also be saved to an encrypted bank file
+  during idle time and loaded later; loading a bank deletes the file so that no
+  randomizer is ever reused.
+  """
+
+  def __init__(self, paillier_obj,
+               high_water_mark=DEFAULT_RANDOMIZER_HIGH_WATER_MARK,
+               num_workers=DEFAULT_RANDOMIZER_WORKERS):
+    """Pool is initialized with the Paillier object it computes randomizers for.
+
+    Args:
+      paillier_obj: Paillier instance whose n is used for the randomizers.
+      high_water_mark: maximum number of randomizers kept ready by workers.
+      num_workers: number of background threads filling the pool.
+
+    Raises:
+      ValueError: if high_water_mark or num_workers is not positive.
+    """
+    if high_water_mark < 1:
+      raise ValueError('high_water_mark has to be positive.')
+    if num_workers < 1:
+      raise ValueError('num_workers has to be positive.')
+    self._paillier = paillier_obj
+    self._queue = Queue.Queue(high_water_mark)
+    self._banked = collections.deque()
+    self._num_workers = num_workers
+    self._workers = []
+    self._stop_event = threading.Event()
+
+  def Start(self):
+    """Starts the background worker threads."""
+    self._stop_event.clear()
+    for _ in xrange(self._num_workers):
+      worker = threading.Thread(target=self._Fill)
+      worker.daemon = True
+      worker.start()
+      self._workers.append(worker)
+
+  def Stop(self):
+    """Stops the background worker threads and waits for them to exit."""
+    self._stop_event.set()
+    for worker in self._workers:
+      worker.join()
+    self._workers = []
+
+  def _Fill(self):
+    while not self._stop_event.is_set():
+      r_to_n = self._paillier.ComputeRandomizer()
+      while not self._stop_event.is_set():
+        try:
+          self._queue.put(r_to_n, timeout=0.1)
+          break
+        except Queue.Full:
+          pass
+
+  def Get(self):
+    """Returns an unused randomizer, computing one inline if none is ready."""
+    try:
+      return self._banked.popleft()
+    except IndexError:
+      pass
+    try:
+      return self._queue.get_nowait()
+    except Queue.Empty:
+      return self._paillier.ComputeRandomizer()
+
+  def _BankHeader(self, key):
+    # identifies the paillier key and bank key a bank was created for.
+    return base64.b64encode(hmac.new(
+        key, number.LongToBytes(self._paillier.n), hashlib.sha1).digest())
+
+  def FillBank(self, filepath, key, count):
+    """Computes count randomizers and appends them to an encrypted bank file.
+
+    Args:
+      filepath: path of the bank file, created if it does not exist.
+      key: str, AES key used to encrypt randomizers at rest.
+      count: number of randomizers to add.
+
+    Raises:
+      ValueError: if an existing bank was created for a different Paillier
+        key or bank key.
+    """
+    cipher = ccrypto.AesCbc(key)
+    header = self._BankHeader(key)
+    try:
+      fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+      is_new = True
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+      # randomizers appended under another key's header would all be lost.
+      with open(filepath, 'rb') as f:
+        if f.readline().strip() != header:
+          raise ValueError('Randomizer bank %s was created for a different '
+                           'key.' % filepath)
+      fd = os.open(filepath, os.O_WRONLY | os.O_APPEND)
+      is_new = False
+    with os.fdopen(fd, 'ab') as f:
+      if is_new:
+        f.write(header + '\n')
+      for r_to_n in self._paillier.ComputeRandomizers(count):
+        f.write(base64.b64encode(cipher.Encrypt(
+            number.LongToBytes(r_to_n))) + '\n')
+
+  def LoadBank(self, filepath, key):
+    """Loads all randomizers from a bank file and deletes the file.
+
+    Args:
+      filepath: path of a bank file written by FillBank.
+      key: str, AES key the bank was encrypted with.
+
+    Returns:
+      number of randomizers loaded, 0 if another load claimed the bank first.
+
+    Raises:
+      ValueError: if the bank was created for a different Paillier key or
+        bank key, or is corrupt. The file is left in place.
+    """
+    # randomizers must never be reused, so the bank is claimed by an atomic
+    # rename before it is read; a load that loses the race gets none of it.
+    claimed = '%s.%d' % (filepath, os.getpid())
+    try:
+      os.rename(filepath, claimed)
+    except OSError:
+      return 0
+    try:
+      with open(claimed, 'rb') as f:
+        randomizers = self._DecryptBank(f.read().split(), filepath, key)
+    except (IOError, ValueError):
+      # the bank is handed back for a load that has its key.
+      os.rename(claimed, filepath)
+      raise
+    os.remove(claimed)
+    self._banked.extend(randomizers)
+    return len(randomizers)
+
+  def _DecryptBank(self, lines, filepath, key):
+    cipher = ccrypto.AesCbc(key)
+    if lines and lines[0] != self._BankHeader(key):
+      raise ValueError('Randomizer bank %s was created for a different key.'
+                       % filepath)
+    randomizers = []
+    for line in lines[1:]:
+      try:
+        randomizers.append(
+            number.BytesToLong(cipher.Decrypt(base64.b64decode(line))))
+      except (TypeError, ValueError):
+        raise ValueError('Randomizer bank %s is corrupt.' % filepath)
+    return randomizers
+
+
+def _FloatsToBits(values):
+  """Returns the IEEE754 binary64 bit patterns of floats as a list of longs."""
+  if numpy is not None:
+    return numpy.asarray(values, dtype=numpy.float64).view(
+        numpy.uint64).tolist()
+  return list(struct.unpack('%dQ' % len(values),
+                            struct.pack('%dd' % len(values), *values)))
+
+
 def IsNan(x):
   return math.isnan(x)
 
@@ -537,51 +951,257 @@ def _NumBytesBn(bn):
   return int(math.ceil(size_in_bits / 8.0))
 
 
+class BignumSession(object):
+  """Reusable openssl state for modular exponentiation.
+
+  Keeps one BN_CTX, scratch BIGNUMs, and a BN_MONT_CTX per (odd) modulus so
+  that repeated exponentiations modulo the same nsquare skip their setup. A
+  session is not thread safe; ModExp and ModExpMany use one per thread.
+  """
+
+  def __init__(self):
+    if not _FOUND_SSL:
+      raise RuntimeError('Cannot create BignumSession because ssl library was '
+                         'not found')
+    self._ctx = ssl.BN_CTX_new()
+    self._bn_base = ssl.BN_new()
+    self._bn_exponent = ssl.BN_new()
+    self._bn_result = ssl.BN_new()
+    self._moduli = {}  # modulus -> (bn_modulus, mont_ctx or None)
+
+  def __del__(self):
+    try:
+      self.Close()
+    except (AttributeError, TypeError):
+      pass  # interpreter shutdown.
+
+  def Close(self):
+    """Frees all openssl state held by the session."""
+    if not self._ctx:
+      return
+    self._ClearModuli()
+    for bn in (self._bn_base, self._bn_exponent, self._bn_result):
+      ssl.BN_free(bn)
+    ssl.BN_CTX_free(self._ctx)
+    self._ctx = None
+
+  def _ClearModuli(self):
+    for bn_modulus, mont in self._moduli.itervalues():
+      if mont:
+        ssl.BN_MONT_CTX_free(mont)
+      ssl.BN_free(bn_modulus)
+    self._moduli = {}
+
+  def _GetModulus(self, modulus):
+    if modulus not in self._moduli:
+      if len(self._moduli) >= _MAX_CACHED_MODULI:
+        self._ClearModuli()
+      bn_modulus = _LongToBn(modulus)
+      mont = None
+      # Montgomery multiplication is only defined for odd moduli.
+      if modulus & 1:
+        mont = ssl.BN_MONT_CTX_new()
+        ssl.BN_MONT_CTX_set(mont, bn_modulus, self._ctx)
+      self._moduli[modulus] = (bn_modulus, mont)
+    return self._moduli[modulus]
+
+  def _ModExpLoaded(self, bn_modulus, mont):
+    if mont:
+      ssl.BN_mod_exp_mont(self._bn_result, self._bn_base, self._bn_exponent,
+                          bn_modulus, self._ctx, mont)
+    else:
+      ssl.BN_mod_exp(self._bn_result, self._bn_base, self._bn_exponent,
+                     bn_modulus, self._ctx)
+    return _BnToLong(self._bn_result)
+
+  def ModExp(self, a, b, c):
+    """Returns a^b mod c where a, b, c are non negative longs."""
+    bn_modulus, mont = self._GetModulus(c)
+    _LongToBn(a, self._bn_base)
+    _LongToBn(b, self._bn_exponent)
+    return self._ModExpLoaded(bn_modulus, mont)
+
+  def ModExpMany(self, bases, b, c):
+    """Returns [a^b mod c for a in bases], marshalling b and c only once."""
+    bn_modulus, mont = self._GetModulus(c)
+    _LongToBn(b, self._bn_exponent)
+    results = []
+    for a in bases:
+      _LongToBn(a, self._bn_base)
+      results.append(self._ModExpLoaded(bn_modulus, mont))
+    return results
+
+
+def _LongToBn(x, bn=None):
+  """Converts a long to a (newly allocated, unless bn is given) Bignum."""
+  bytes_x = number.LongToBytes(x)
+  return ssl.BN_bin2bn(bytes_x, len(bytes_x), bn)
+
+
+def _BnToLong(bn):
+  """Converts a Bignum to a long."""
+  bytes_result = ctypes.create_string_buffer(_NumBytesBn(bn))
+  ssl.BN_bn2bin(bn, bytes_result)
+  return number.BytesToLong(bytes_result.raw)
+
+
+_bignum_sessions = threading.local()
+
+
+def _GetBignumSession():
+  """Returns the BignumSession of the calling thread."""
+  session = getattr(_bignum_sessions, 'session', None)
+  if session is None:
+    session = BignumSession()
+    _bignum_sessions.session = session
+  return session
+
+
+def _OpensslModExp(a, b, c):
+  return _GetBignumSession().ModExp(a, b, c)
+
+
+def _OpensslModExpMany(bases, b, c):
+  return _GetBignumSession().ModExpMany(bases, b, c)
+
+
+def _Gmpy2ModExp(a, b, c):
+  return long(gmpy2.powmod(a, b, c))
+
+
+# Registered big integer backends, in order of default preference. Each maps
+# a name to a (mod_exp, mod_exp_many) pair; mod_exp_many may be None.
+_BACKENDS = collections.OrderedDict()
+_selected_backend = None
+
+
+def RegisterBackend(name, mod_exp, mod_exp_many=None):
+  """Makes a big integer backend available to ModExp and ModExpMany.
+
+  Args:
+    name: str, name of the backend.
+    mod_exp: function computing a^b mod c for non negative longs a, b, c.
+    mod_exp_many: optional function computing [a^b mod c for a in bases],
+      given (bases, b, c); defaults to calling mod_exp for each base.
+  """
+  _BACKENDS[name] = (mod_exp, mod_exp_many)
+
+
+def GetBackends():
+  """Returns the names of the registered backends."""
+  return _BACKENDS.keys()
+
+
+def GetSelectedBackend():
+  """Returns the name of the backend used by ModExp and ModExpMany."""
+  return _selected_backend
+
+
+def SelectBackend(name):
+  """Selects the backend used by ModExp and ModExpMany and checks it.
+
+  Args:
+    name: str, name of a registered backend.
+
+  Raises:
+    ValueError: if name is not a registered backend.
+  """
+  global _selected_backend  # pylint: disable=global-statement
+  if name not in _BACKENDS:
+    raise ValueError('Unknown big integer backend %r, expected one of %s.' %
+                     (name, GetBackends()))
+  _selected_backend = name
+  TestBackendRegression()
+
+
 def ModExp(a, b, c):
-  """Uses openssl, if available, to do a^b mod c where a,b,c are longs."""
-  if not _FOUND_SSL:
-    return pow(a, b, c)
-  # convert arbitrary long args to bytes
-  bytes_a = number.LongToBytes(a)
-  bytes_b = number.LongToBytes(b)
-  bytes_c = number.LongToBytes(c)
-
-  # convert bytes to (pointer to) Bignums.
-  bn_a = ssl.BN_bin2bn(bytes_a, len(bytes_a), 0)
-  bn_b = ssl.BN_bin2bn(bytes_b, len(bytes_b), 0)
-  bn_c = ssl.BN_bin2bn(bytes_c, len(bytes_c), 0)
-  bn_result = ssl.BN_new()
-  ctx = ssl.BN_CTX_new()
-
-  # exponentiate and convert result to long
-  ssl.BN_mod_exp(bn_result, bn_a, bn_b, bn_c, ctx)
-  num_bytes_in_result = _NumBytesBn(bn_result)
-  bytes_result = ctypes.create_string_buffer(num_bytes_in_result)
-  ssl.BN_bn2bin(bn_result, bytes_result)
-  long_result = number.BytesToLong(bytes_result.raw)
-
-  # clean up
-  ssl.BN_CTX_free(ctx)
-  ssl.BN_free(bn_a)
-  ssl.BN_free(bn_b)
-  ssl.BN_free(bn_c)
-  ssl.BN_free(bn_result)
-
-  return long_result
-
-
-def TestSslRegression():
-  """Test openssl BN functions ctypes setup for regressions."""
-  if not _FOUND_SSL:
-    return
+  """Uses the selected backend to do a^b mod c where a,b,c are longs."""
+  return _BACKENDS[_selected_backend][0](a, b, c)
+
+
+def ModExpMany(bases, b, c):
+  """Returns a list of a^b mod c for each a in bases, using selected backend.
+
+  Args:
+    bases: iterable of longs, e.g. a whole column of values.
+    b: long, exponent shared by all bases.
+    c: long, modulus shared by all bases.
+
+  Returns:
+    list of longs, in the order of bases.
+  """
+  mod_exp, mod_exp_many = _BACKENDS[_selected_backend]
+  if mod_exp_many is None:
+    return [mod_exp(a, b, c) for a in bases]
+  return mod_exp_many(bases, b, c)
+
+
+def TestBackendRegression():
+  """Test the selected big integer backend for regressions."""
   a = 13237154333272387305  # random
   b = 14222796656191241573  # random
   c = 14335739297692523692  # random
   expect_m = 10659231545499717801  # pow(a, b, c)
   m = ModExp(a, b, c)
-  assert m == expect_m, 'TestSslRegression: unexpected ModExp result'
+  assert m == expect_m, (
+      'TestBackendRegression: unexpected ModExp result from %s' %
+      _selected_backend)
+  odd_c = c + 1  # exercises Montgomery setup, where the backend has one.
+  expect_odd_m = pow(a, b, odd_c)
+  assert ModExpMany([a, a], b, odd_c) == [expect_odd_m, expect_odd_m], (
+      'TestBackendRegression: unexpected ModExpMany result from %s' %
+      _selected_backend)
 
 
-if not _TESTED_SSL:
-  TestSslRegression()
-  _TESTED_SSL = True
+def CalibrateBackends(config_path=BACKEND_CONFIG_PATH, iterations=20):
+  """Selects the fastest backend on this machine and records it.
+
+  Times ModExp of a random base to a 1024 bit exponent modulo a 2048 bit
+  modulus, the shape of a Paillier randomizer, with every registered backend.
+
+  Args:
+    config_path: file to record the name of the fastest backend in, or None.
+    iterations: number of exponentiations timed per backend.
+
+  Returns:
+    dict mapping backend names to seconds taken.
+  """
+  modulus = number.BytesToLong(ccrypto.GetRandBytes(N_LENGTH / 4)) | 1
+  base = number.BytesToLong(ccrypto.GetRandBytes(N_LENGTH / 4)) % modulus
+  exponent = number.BytesToLong(ccrypto.GetRandBytes(N_LENGTH / 8))
+  timings = {}
+  for name in GetBackends():
+    SelectBackend(name)
+    start = time.time()
+    for _ in xrange(iterations):
+      ModExp(base, exponent, modulus)
+    timings[name] = time.time() - start
+  fastest = min(timings, key=timings.get)
+  SelectBackend(fastest)
+  logging.info('Big integer backend timings %s, selected %s', timings, fastest)
+  if config_path:
+    with open(config_path, 'wt') as f:
+      f.write(fastest + '\n')
+  return timings
+
+
+def _ReadBackendConfig(config_path=BACKEND_CONFIG_PATH):
+  """Returns the backend name recorded by CalibrateBackends, or None."""
+  try:
+    with open(config_path, 'rt') as f:
+      return f.read().strip() or None
+  except (OSError, IOError):
+    return None
+
+
+if _FOUND_SSL:
+  RegisterBackend('openssl', _OpensslModExp, _OpensslModExpMany)
+if gmpy2 is not None:
+  RegisterBackend('gmpy2', _Gmpy2ModExp)
+RegisterBackend('pow', pow)
+
+_configured_backend = _ReadBackendConfig()
+if _configured_backend in _BACKENDS:
+  SelectBackend(_configured_backend)
+else:
+  SelectBackend(GetBackends()[0])
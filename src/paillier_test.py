@@ -7,6 +7,11 @@
 
 
 
+import copy
+import os
+import tempfile
+import time
+
 from google.apputils import app
 import logging
 from google.apputils import basetest as googletest
@@ -55,6 +60,22 @@ class PaillierTest(googletest.TestCase):
     self.assertEqual(m1, expect)
     self.assertEqual(m2, expect)
 
+  def testModExpMany(self):
+    bases = [0, 1, 2, _PAILLIER1.nsquare - 1, _PAILLIER1.nsquare + 5]
+    for modulus in [_PAILLIER1.nsquare, 2 ** 64]:
+      self.assertEqual([pow(a, _PAILLIER1.n, modulus) for a in bases],
+                       paillier.ModExpMany(bases, _PAILLIER1.n, modulus))
+    self.assertEqual([], paillier.ModExpMany([], 3, 7))
+
+  def testBignumSessionCachesModuli(self):
+    session = paillier.BignumSession()
+    for modulus in xrange(3, 3 + 2 * paillier._MAX_CACHED_MODULI + 2, 2):
+      self.assertEqual(pow(12345, 678, modulus),
+                       session.ModExp(12345, 678, modulus))
+    self.assertTrue(len(session._moduli) <= paillier._MAX_CACHED_MODULI)
+    session.Close()
+    session.Close()
+
   def testEncryptDecrypt(self):
     logging.debug('Running testEncryptDecrypt method.')
     data = 123456789123456789123456789123456789
@@ -122,6 +143,21 @@ class PaillierTest(googletest.TestCase):
     decryption = paillier1.Decrypt(848742150)
     self.assertEquals(10100, decryption)
 
+  def testDecryptCrtMatchesDecryptWithoutFactors(self):
+    logging.debug('Running testDecryptCrtMatchesDecryptWithoutFactors method.')
+    # pylint: disable=protected-access
+    paillier_no_factors = paillier.Paillier(
+        None, _PAILLIER1.g, _PAILLIER1.n, _PAILLIER1._Paillier__lambda,
+        _PAILLIER1._Paillier__mu)
+    for plaintext in (0, 1, 123456789123456789123456789123456789,
+                      _PAILLIER1.n - 1):
+      ciphertext = _PAILLIER1.Encrypt(plaintext)
+      self.assertEquals(plaintext, _PAILLIER1._DecryptCrt(ciphertext))
+      self.assertEquals(plaintext, paillier_no_factors.Decrypt(ciphertext))
+    ciphertext = _PAILLIER1.EncryptInt64(-5)
+    self.assertEquals(paillier_no_factors.DecryptInt64(ciphertext),
+                      _PAILLIER1.DecryptInt64(ciphertext))
+
   def testGetRandomFromZNStar(self):
     logging.debug('Running testGetRandomFromZNStar method.')
     # 8 bit values not relatively prime to 143 and less than 143.
@@ -598,10 +634,178 @@ class PaillierTest(googletest.TestCase):
     except OverflowError:
       pass  # success
 
-  def testTestSslRegression(self):
-    """Test TestSslRegression() module method."""
+  def testEncryptClosedFormMatchesGenericModExp(self):
+    generic = copy.copy(_PAILLIER1)
+    generic._g_is_n_plus_one = False
+    for m in [0, 1, 2**96 - 1, _PAILLIER1.n - 1]:
+      self.assertEqual(generic.Encrypt(m, r_value=7),
+                       _PAILLIER1.Encrypt(m, r_value=7))
+    ciphertext = _PAILLIER1.Encrypt(5, r_value=7)
+    self.assertEqual(generic.Affine(ciphertext, 3, 4),
+                     _PAILLIER1.Affine(ciphertext, 3, 4))
+    self.assertEqual(
+        19, _PAILLIER1.Decrypt(_PAILLIER1.Affine(ciphertext, 3, 4)))
+
+  def testEncryptBenchmark(self):
+    """Logs g^m and encryption rates with and without the closed form."""
+    # pylint: disable=protected-access
+    generic = copy.copy(_PAILLIER1)
+    generic._g_is_n_plus_one = False
+    num_encryptions = 50
+    m = -12345 % _PAILLIER1.n
+    g_rates = []
+    for paillier_obj in (generic, _PAILLIER1):
+      start = time.time()
+      for _ in xrange(num_encryptions):
+        paillier_obj._GToThe(m)
+      g_rates.append(num_encryptions / max(time.time() - start, 1e-9))
+    logging.info('g^m/second: generic ModExp %.0f, closed form %.0f',
+                 g_rates[0], g_rates[1])
+    self.assertTrue(g_rates[1] > g_rates[0])
+
+    # a precomputed randomizer leaves only g^m and the encoding to time.
+    class _FixedRandomizer(object):
+
+      def Get(self):
+        return 7
+
+    for name, encrypt, value in [('EncryptInt64', 'EncryptInt64', -12345),
+                                 ('EncryptFloat', 'EncryptFloat', -1.5e100)]:
+      rates = []
+      for paillier_obj in (generic, _PAILLIER1):
+        paillier_obj.SetRandomizerPool(_FixedRandomizer())
+        try:
+          start = time.time()
+          for _ in xrange(num_encryptions):
+            getattr(paillier_obj, encrypt)(value)
+          rates.append(num_encryptions / max(time.time() - start, 1e-9))
+        finally:
+          paillier_obj.SetRandomizerPool(None)
+      logging.info('%s encryptions/second with a precomputed randomizer: '
+                   'generic %.0f, closed form %.0f', name, rates[0], rates[1])
+
+  def testDecryptManyMatchesDecrypt(self):
+    # pylint: disable=protected-access
+    paillier_no_factors = paillier.Paillier(
+        None, _PAILLIER1.g, _PAILLIER1.n, _PAILLIER1._Paillier__lambda,
+        _PAILLIER1._Paillier__mu)
+    plaintexts = [0, 1, 123456789123456789, _PAILLIER1.n - 1]
+    ciphertexts = _PAILLIER1.EncryptMany(plaintexts)
+    self.assertEquals(plaintexts, _PAILLIER1.DecryptMany(ciphertexts))
+    self.assertEquals(plaintexts, paillier_no_factors.DecryptMany(ciphertexts))
+    self.assertEquals([], _PAILLIER1.EncryptMany([]))
+    self.assertRaises(ValueError, _PAILLIER1.EncryptMany, [1, 'a'])
+    self.assertRaises(ValueError, _PAILLIER1.DecryptMany, [1.0])
+
+  def testEncryptColumnsMatchScalarMethods(self):
+    int64s = [0, 1, -1, paillier.MAX_INT64, paillier.MIN_INT64, 42]
+    ciphertexts = _PAILLIER1.EncryptInt64s(int64s)
+    self.assertEquals(int64s, _PAILLIER1.DecryptInt64s(ciphertexts))
+    self.assertEquals(int64s, [_PAILLIER1.DecryptInt64(c) for c in ciphertexts])
+    self.assertRaises(ValueError, _PAILLIER1.EncryptInt64s,
+                      [1, paillier.MAX_INT64 + 1])
+    floats = [0.0, -1.5, 3.25e-100, 1.5e100, float('inf'), float('-inf')]
+    ciphertexts = _PAILLIER1.EncryptFloats(floats)
+    self.assertEquals(floats, _PAILLIER1.DecryptFloats(ciphertexts))
+    self.assertEquals(floats, [_PAILLIER1.DecryptFloat(c) for c in ciphertexts])
+    self.assertTrue(paillier.IsNan(
+        _PAILLIER1.DecryptFloats(_PAILLIER1.EncryptFloats([float('nan')]))[0]))
+    self.assertRaises(ValueError, _PAILLIER1.EncryptFloats, [1.0, 1])
+
+  def testEncryptColumnBenchmark(self):
+    """Logs int64 encryptions/second, value by value and as one column."""
+    int64s = range(-50, 50)
+    start = time.time()
+    for value in int64s:
+      _PAILLIER1.EncryptInt64(value)
+    scalar_rate = len(int64s) / max(time.time() - start, 1e-9)
+    start = time.time()
+    _PAILLIER1.EncryptInt64s(int64s)
+    column_rate = len(int64s) / max(time.time() - start, 1e-9)
+    logging.info('EncryptInt64 encryptions/second: scalar %.0f, column %.0f',
+                 scalar_rate, column_rate)
+
+  def testKeyDerivationBenchmark(self):
+    """Logs the time taken to derive Paillier keys from seeds."""
+    seeds = ['%016d' % i for i in xrange(3)]
+    start = time.time()
+    for seed in seeds:
+      paillier.Paillier(seed)
+    logging.info('Paillier key derivation: %.3f seconds per key',
+                 (time.time() - start) / len(seeds))
+
+  def testRandomizerPool(self):
+    pool = paillier.RandomizerPool(_PAILLIER1, high_water_mark=4,
+                                   num_workers=2)
+    pool.Start()
+    _PAILLIER1.SetRandomizerPool(pool)
+    try:
+      for m in [0, 1, 123456789, _PAILLIER1.n - 1]:
+        self.assertEqual(m, _PAILLIER1.Decrypt(_PAILLIER1.Encrypt(m)))
+    finally:
+      _PAILLIER1.SetRandomizerPool(None)
+      pool.Stop()
+    # a stopped, empty pool still hands out freshly computed randomizers.
+    self.assertNotEqual(pool.Get(), pool.Get())
+    self.assertRaises(ValueError, paillier.RandomizerPool, _PAILLIER1, 0)
+
+  def testRandomizerBank(self):
+    key = 'bank_key_0123456'
+    filepath = os.path.join(tempfile.mkdtemp(), 'bank')
+    pool = paillier.RandomizerPool(_PAILLIER1)
+    pool.FillBank(filepath, key, 2)
+    pool.FillBank(filepath, key, 1)
+    self.assertEqual(3, pool.LoadBank(filepath, key))
+    self.assertFalse(os.path.exists(filepath))
+    for _ in xrange(3):
+      r_to_n = pool.Get()
+      c = (_PAILLIER1.Encrypt(0, r_value=1) * r_to_n) % _PAILLIER1.nsquare
+      self.assertEqual(0, _PAILLIER1.Decrypt(c))
+    other = paillier.RandomizerPool(paillier.Paillier('fedcba9876543210'))
+    other.FillBank(filepath, key, 1)
+    self.assertRaises(ValueError, pool.LoadBank, filepath, key)
+    # a foreign bank is left alone for its own key to load.
+    self.assertTrue(os.path.exists(filepath))
+    os.remove(filepath)
+    pool.FillBank(filepath, key, 1)
+    self.assertRaises(ValueError, pool.LoadBank, filepath, 'other_key_012345')
+    self.assertTrue(os.path.exists(filepath))
+    # randomizers are not appended under another key's header.
+    self.assertRaises(ValueError, pool.FillBank, filepath, 'other_key_012345',
+                      1)
+    self.assertEqual(1, pool.LoadBank(filepath, key))
+    self.assertEqual(os.listdir(os.path.dirname(filepath)), [])
+    # a bank another load has claimed is not read again.
+    self.assertEqual(0, pool.LoadBank(filepath, key))
+
+  def testTestBackendRegression(self):
+    """Test TestBackendRegression() module method against every backend."""
     self.assertTrue(paillier._FOUND_SSL)
-    paillier.TestSslRegression()
+    self.assertIn('openssl', paillier.GetBackends())
+    self.assertIn('pow', paillier.GetBackends())
+    selected = paillier.GetSelectedBackend()
+    try:
+      for name in paillier.GetBackends():
+        paillier.SelectBackend(name)
+        paillier.TestBackendRegression()
+        m = _PAILLIER1.n - 1
+        self.assertEqual(m, _PAILLIER1.Decrypt(_PAILLIER1.Encrypt(m)))
+    finally:
+      paillier.SelectBackend(selected)
+    self.assertRaises(ValueError, paillier.SelectBackend, 'abacus')
+
+  def testCalibrateBackends(self):
+    config_path = os.path.join(tempfile.mkdtemp(), 'backend')
+    selected = paillier.GetSelectedBackend()
+    try:
+      timings = paillier.CalibrateBackends(config_path, iterations=2)
+      self.assertEqual(set(paillier.GetBackends()), set(timings))
+      self.assertEqual(min(timings, key=timings.get),
+                       paillier.GetSelectedBackend())
+      self.assertEqual(paillier.GetSelectedBackend(),
+                       paillier._ReadBackendConfig(config_path))
+    finally:
+      paillier.SelectBackend(selected)
 
 
 def main(_):
@@ -204,18 +204,17 @@ def RewriteSelectionCriteria(stack, schema, master_key, table_id):
     (such as searching non-searchable encrypted fields, etc).
   """
 
-  pseudonym_cipher = ecrypto.PseudonymCipher(
-      ecrypto.GeneratePseudonymCipherKey(master_key, table_id))
-  string_hasher = ecrypto.StringHash(
-      ecrypto.GenerateStringHashKey(master_key, table_id))
+  cipher_suite = ecrypto.GetCipherSuite(master_key, table_id)
+  pseudonym_cipher = cipher_suite.pseudonym_cipher
+  string_hasher = cipher_suite.string_hasher
 
   pseudonym_ciphers = {}
 
   for field in schema:
     if (field.get('encrypt', '') in ['pseudonym'] and
         field.get('related', None) is not None):
-      pseudonym_ciphers[field['related']] = ecrypto.PseudonymCipher(
-          ecrypto.GeneratePseudonymCipherKey(master_key, field['related']))
+      pseudonym_ciphers[field['related']] = (
+          cipher_suite.GetRelatedPseudonymCipher(field['related']))
 
   def FailIfEncrypted(tokens):
     if util.IsEncryptedExpression(tokens):
@@ -283,6 +282,46 @@ def RewriteSelectionCriteria(stack, schema, master_key, table_id):
         % (modified_field, keyed_hash))
     return (modified_field, modified_string)
 
+  def RewriteSearchwordsBloomEncryption(field, literal):
+    """Rewrites a containment check of literal in a bloom filter field.
+
+    Arguments:
+      field: The searchwords bloom field which is being checked if literal is
+      contained within.
+      literal: Substring being searched for.
+
+    Returns:
+      An expression that is true iff every bit of the bloom filter that the
+      literal sets in the row is set; see ecrypto.GetSearchwordsBloomProbes.
+    """
+    row = util.GetEntryFromSchema(field.original_name, schema)
+    searchwords_separator = row.get('searchwords_separator', None)
+    word_list = ecrypto.CleanUnicodeString(
+        unicode(literal.value), separator=searchwords_separator)
+    word_seq = (searchwords_separator or ' ').join(word_list)
+    keyed_hash = string_hasher.GetStringKeyHash(
+        util.SEARCHWORDS_BLOOM_PREFIX + row['name'], word_seq)
+    num_slots = row.get('searchwords_bloom_bits',
+                        ecrypto.SEARCHWORDS_BLOOM_BITS) // 6
+    num_hashes = row.get('searchwords_bloom_hashes',
+                         ecrypto.SEARCHWORDS_BLOOM_HASHES)
+    probe_hash = u'to_base64(bytes(sha1(concat(left(%s, 24), \'%s\'))))' % (
+        field, keyed_hash)
+
+    def Base64Value(string, index):
+      return u'(instr(\'%s\', substr(%s, %s, 1)) - 1)' % (
+          ecrypto.BASE64_ALPHABET, string, index)
+
+    bit_tests = []
+    for k in xrange(0, 3 * num_hashes, 3):
+      slot = u'(64 * %s + %s) %% %d' % (Base64Value(probe_hash, k + 1),
+                                       Base64Value(probe_hash, k + 2),
+                                       num_slots)
+      bit = u'%s %% 6' % Base64Value(probe_hash, k + 3)
+      bit_tests.append(u'((%s >> (%s)) & 1) = 1' % (
+          Base64Value(field, u'25 + %s' % slot), bit))
+    return u'(%s)' % u' AND '.join(bit_tests)
+
   def CheckSearchableField(op1):
     """Checks if the operand is a searchable encrypted field.
 
@@ -327,6 +366,8 @@ def RewriteSelectionCriteria(stack, schema, master_key, table_id):
     elif not isinstance(op2, util.StringLiteralToken):
       raise bigquery_client.BigqueryInvalidQueryError(
           'The substring to be checked must be a literal.', None, None, None)
+    elif isinstance(op1, util.SearchwordsBloomToken):
+      return (op1, RewriteSearchwordsBloomEncryption(op1, op2))
     return RewriteSearchwordsEncryption(op1, op2)
 
   def CheckAndRewriteStack(postfix):
@@ -350,6 +391,8 @@ def RewriteSelectionCriteria(stack, schema, master_key, table_id):
       elif str(top) == 'contains':
         FailIfEncrypted([args[1]])
         args[0], args[1] = RewriteContainsOrFail(args[0], args[1])
+        if isinstance(args[0], util.SearchwordsBloomToken):
+          return args[1]
       else:
         FailIfEncrypted(args)
       return '(%s %s %s)' % (args[0], str(top), args[1])
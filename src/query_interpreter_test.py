@@ -5,6 +5,8 @@
 
 
 
+import base64
+import hashlib
 import math
 
 from google.apputils import app
@@ -14,6 +16,7 @@ from google.apputils import basetest as googletest
 
 import bigquery_client
 import common_util as util
+import ebq_crypto as ecrypto
 import query_interpreter as interpreter
 import test_util
 
@@ -292,6 +295,43 @@ class QueryInterpreterTest(googletest.TestCase):
         'to_base64(left(bytes(sha1(concat(left(citiesLived.' +
         util.SEARCHWORDS_PREFIX + 'place, 24), \'cBKPKGiY2cg=\'))), 8)))')
 
+  def testEncryptedContainsWhenSearchwordsBloom(self):
+    schema = [{'name': 'Notes', 'type': 'string', 'mode': 'nullable',
+               'encrypt': 'searchwords_bloom', 'searchwords_bloom_bits': 120,
+               'searchwords_bloom_hashes': 3}]
+    key = test_util.GetMasterKey()
+    column = util.SEARCHWORDS_BLOOM_PREFIX + 'Notes'
+    cell = ecrypto.GetCipherSuite(key, _TABLE_ID).string_hasher.\
+        GetBloomFilterForWordSubsequencesWithIv(
+            unicode(column), u'air, moon roof, loaded', num_bits=120,
+            num_hashes=3, rand_gen=lambda size: size * '1')
+    # Evaluates the rewritten expression on cell with the BigQuery functions
+    # it uses.
+    functions = {
+        'bytes': lambda data: data,
+        'concat': lambda a, b: a + b,
+        'instr': lambda string, part: string.find(part) + 1,
+        'left': lambda string, n: string[:n],
+        'sha1': lambda data: hashlib.sha1(data).digest(),
+        'substr': lambda string, i, n: string[i - 1:i - 1 + n],
+        'to_base64': base64.b64encode,
+        column: cell,
+    }
+
+    def Contains(literal):
+      stack = [util.SearchwordsBloomToken('Notes'),
+               util.StringLiteralToken('"%s"' % literal),
+               util.OperatorToken('contains', 2)]
+      expression = interpreter.RewriteSelectionCriteria(stack, schema, key,
+                                                        _TABLE_ID)
+      self.assertEqual(3, expression.count(' & 1) = 1'))
+      return eval(expression.replace(' AND ', ' and ').replace(' = ', ' == '),
+                  functions)
+
+    for literal in ['air', 'Moon roof', 'roof, loaded', 'air moon roof']:
+      self.assertTrue(Contains(literal))
+    self.assertFalse(Contains('sunroof'))
+
   def testGetSingleValue(self):
     stack = [1, 1, 1, util.OperatorToken('+', 2)]
     start, postfix = interpreter.GetSingleValue(stack)
@@ -410,7 +410,7 @@ class _GroupByClause(_Clause):
       row = util.GetEntryFromSchema(argument, self.schema)
       if (row['encrypt'].startswith('probabilistic') or
           row['encrypt'] == 'homomorphic' or
-          row['encrypt'] == 'searchwords'):
+          row['encrypt'].startswith('searchwords')):
         raise bigquery_client.BigqueryInvalidQueryError(
             'Cannot GROUP BY %s encryption.' % row['encrypt'], None, None, None)
     # Group by arguments have no alias, so an empty dictionary is adequate.
@@ -547,8 +547,7 @@ def RewriteQuery(clauses, schema, master_key, table_id, manifest=None):
     bigquery_client.BigqueryInvalidQueryError: Invalid original query.
     ValueError: Invalid clause type given.
   """
-  nsquare = ecrypto.HomomorphicIntCipher(
-      ecrypto.GenerateHomomorphicCipherKey(master_key, table_id)).nsquare
+  nsquare = ecrypto.GetCipherSuite(master_key, table_id).nsquare
 
   as_clause = _AsClause(clauses['AS'])
   within_clause = _WithinClause(clauses['WITHIN'])
@@ -633,9 +632,12 @@ def _ExtractAggregationQueries(stacks, within, alias):
       if isinstance(stacks[i][j], util.AggregationQueryToken):
         if i in within:
           query = '%s WITHIN %s' % (stacks[i][j], within[i])
+          lane = getattr(stacks[i][j], 'lane', None)
           stacks[i][j] = (
               util.AggregationQueryToken(
                   '%s WITHIN %s' % (stacks[i][j], within[i])))
+          if lane is not None:
+            stacks[i][j].lane = lane
         else:
           query = stacks[i][j]
         if i in alias:
@@ -853,12 +855,18 @@ def _RewriteEncryptedFields(postfix_expressions, schema):
         return util.PseudonymToken(str(field), related=row['related'])
       else:
         return util.PseudonymToken(str(field))
+    elif 'packing_group' in row:
+      return util.HomomorphicPackedIntToken(
+          str(field), row['packing_group'],
+          util.GetPackingLane(str(field), schema))
     elif row['encrypt'] == 'homomorphic' and row['type'] == 'integer':
       return util.HomomorphicIntToken(str(field))
     elif row['encrypt'] == 'homomorphic' and row['type'] == 'float':
       return util.HomomorphicFloatToken(str(field))
     elif row['encrypt'] == 'searchwords':
       return util.SearchwordsToken(str(field))
+    elif row['encrypt'] == 'searchwords_bloom':
+      return util.SearchwordsBloomToken(str(field))
     return field
 
   rewritten_expressions = []
@@ -465,6 +465,25 @@ class QueryLibraryTest(googletest.TestCase):
         query_lib.RewriteQuery(clauses, schema, master_key, _TABLE_ID)[0],
         rewritten_query)
 
+  def testRewriteQueryWhenSumPacked(self):
+    master_key = test_util.GetMasterKey()
+    schema = [
+        {'name': 'a', 'type': 'integer', 'mode': 'required',
+         'encrypt': 'homomorphic', 'packing_group': u'm'},
+        {'name': 'b', 'type': 'integer', 'mode': 'required',
+         'encrypt': 'homomorphic', 'packing_group': u'm'},
+    ]
+    query = 'SELECT SUM(a), SUM(b) FROM t'
+    clauses = parser.ParseQuery(query)
+    rewritten_query, print_arguments = query_lib.RewriteQuery(
+        clauses, schema, master_key, _TABLE_ID)
+    packed_name = util.HOMOMORPHIC_PACKED_INT_PREFIX + 'm'
+    self.assertEqual(
+        1, rewritten_query.count('PAILLIER_SUM(FROM_BASE64(%s' % packed_name))
+    lanes = [token.lane for stack in print_arguments['table_expressions']
+             for token in stack if hasattr(token, 'lane')]
+    self.assertEqual([-2, -1], lanes)
+
   def testRewriteQueryWhenLocalEvaluate(self):
     master_key = test_util.GetMasterKey()
     schema = test_util.GetCarsSchema()
@@ -9,26 +9,50 @@ that they can be modified before being sent to BigQuery.
 
 
 
+import threading
+
 import pyparsing as pp
 
 import bigquery_client
 import common_util as util
 
 
-def _MathParser(math_stack):
+# Memoize the results of parsing each grammar element at each location, so
+# backtracking over alternatives does not reparse the same subexpressions.
+pp.ParserElement.enablePackrat()
+
+
+class _ParseState(object):
+  """State the parse actions write to while one query is parsed.
+
+  The grammar is built once, with actions bound to a single _ParseState, which
+  is reset before each parse.
+
+  Attributes:
+    clauses: dict mapping clause names to their arguments, see _EBQParser.
+    temp_stack: list, the postfix notation of the expression being parsed.
+  """
+
+  def __init__(self):
+    self.Reset(None)
+
+  def Reset(self, clauses):
+    self.clauses = clauses
+    self.temp_stack = []
+
+
+def _MathParser(state):
   """Defines the entire math expression for BigQuery queries.
 
   Converts the expression into postfix notation. The stack is reversed
   (i.e. the last element acts the top of the stack).
 
   Actions do not occur unless parseString is called on the BNF returned.
-  The actions will modify the original list that was passed when the BNF
-  was generated.
-
-  The <math_stack> will return the single expression converted to postfix.
+  The actions will push onto the temp_stack of state at the time of parsing,
+  which will hold the single expression converted to postfix.
 
   Arguments:
-    math_stack: Returns postfix notation of one math expression.
+    state: _ParseState the actions write to.
 
   Returns:
     A BNF of an math/string expression.
@@ -61,7 +85,8 @@ def _MathParser(math_stack):
     for token in tokens:
       if token == ',':
         num_args += 1
-    math_stack.append(util.AggregationFunctionToken(function_name, num_args))
+    state.temp_stack.append(
+        util.AggregationFunctionToken(function_name, num_args))
 
   def PushFunction(tokens):
     """Push a function token onto the stack.
@@ -69,7 +94,7 @@ def _MathParser(math_stack):
     Args:
       tokens: list of all tokens, tokens[0] is the function name str.
     """
-    math_stack.append(util.BuiltInFunctionToken(tokens[0]))
+    state.temp_stack.append(util.BuiltInFunctionToken(tokens[0]))
 
   def PushSingleToken(tokens):
     """Push the topmost token onto the stack."""
@@ -85,12 +110,12 @@ def _MathParser(math_stack):
                                 util.BIGQUERY_CONSTANTS[tokens[0].lower()])
     else:
       token = util.FieldToken(tokens[0])
-    math_stack.append(token)
+    state.temp_stack.append(token)
 
   def PushCountStar(tokens):
     if tokens[0] != '*':
       raise ValueError('Not a count star argument.')
-    math_stack.append(util.CountStarToken())
+    state.temp_stack.append(util.CountStarToken())
 
   def PushUnaryOperators(tokens):
     # The list must be reversed since unary operations are unwrapped in the
@@ -98,15 +123,15 @@ def _MathParser(math_stack):
     # inversion.
     for i in reversed(range(0, len(tokens))):
       if tokens[i] == '-':
-        math_stack.append(int('-1'))
-        math_stack.append(util.OperatorToken('*', 2))
+        state.temp_stack.append(int('-1'))
+        state.temp_stack.append(util.OperatorToken('*', 2))
       elif tokens[i] == '~':
-        math_stack.append(util.OperatorToken('~', 1))
+        state.temp_stack.append(util.OperatorToken('~', 1))
       elif tokens[i].lower() == 'not':
-        math_stack.append(util.OperatorToken('not', 1))
+        state.temp_stack.append(util.OperatorToken('not', 1))
 
   def PushBinaryOperator(tokens):
-    math_stack.append(util.OperatorToken(tokens[0], 2))
+    state.temp_stack.append(util.OperatorToken(tokens[0], 2))
 
   # Miscellaneous symbols and keywords.
   comma = pp.Literal(',')
@@ -234,12 +259,12 @@ def _MathParser(math_stack):
   return full_expression
 
 
-def _EBQParser(clauses):
+def _EBQParser(state):
   """Defines the entire EBQ query.
 
   Actions only occur when parseString is called on the BNF returned.
-  All actions will modify the original dictionary passed in as the argument
-  when the BNF was generated.
+  All actions will modify the clauses dictionary of state at the time of
+  parsing.
 
   The dictionary will map clause names to their respective argument. Below
   each clause's argument arrangement is explained:
@@ -282,44 +307,43 @@ def _EBQParser(clauses):
   LIMIT n --> [n]
 
   Arguments:
-    clauses: Dictionary containing clause name to arguments. Originally, all
-      arguments have initial, empty values.
+    state: _ParseState the actions write to. Its clauses dictionary contains
+      clause name to arguments; originally, all arguments have initial, empty
+      values.
 
   Returns:
     A BNF of a EBQ query.
   """
 
   def AddAll(tokens):
-    temp_stack.append(''.join(tokens))
+    state.temp_stack.append(''.join(tokens))
 
   def AddArgument(tokens):
-    clauses[tokens[0]].extend(temp_stack)
-    temp_stack[:] = []
+    state.clauses[tokens[0]].extend(state.temp_stack)
+    state.temp_stack[:] = []
 
   def AddSelectArgument():
-    clauses['SELECT'].append(list(temp_stack))
-    temp_stack[:] = []
+    state.clauses['SELECT'].append(list(state.temp_stack))
+    state.temp_stack[:] = []
 
   def AddLabel(tokens):
-    temp_stack.append(tokens[0])
+    state.temp_stack.append(tokens[0])
 
   def AddAlias(tokens):
-    clauses['AS'][len(clauses['SELECT'])] = tokens[0]
+    state.clauses['AS'][len(state.clauses['SELECT'])] = tokens[0]
 
   def AddInteger(tokens):
-    temp_stack.append(int(tokens[0]))
+    state.temp_stack.append(int(tokens[0]))
 
   def AddLast(tokens):
-    temp_stack[len(temp_stack) - 1] += ' ' + tokens[0]
+    state.temp_stack[-1] += ' ' + tokens[0]
 
   def AddWithin(tokens):
-    clauses['WITHIN'][len(clauses['SELECT'])] = tokens[0]
+    state.clauses['WITHIN'][len(state.clauses['SELECT'])] = tokens[0]
 
   def AddJoinArgument(tokens):
-    clauses[tokens[0]].append(list(temp_stack))
-    temp_stack[:] = []
-
-  temp_stack = []
+    state.clauses[tokens[0]].append(list(state.temp_stack))
+    state.temp_stack[:] = []
 
   as_kw = pp.CaselessKeyword('AS')
   select_kw = pp.CaselessKeyword('SELECT')
@@ -347,7 +371,7 @@ def _EBQParser(clauses):
   within_label = pp.Word(
       pp.alphas, pp.alphas + pp.nums + '_' + '.').setParseAction(AddWithin)
 
-  math_expr = _MathParser(temp_stack)
+  math_expr = _MathParser(state)
   within_expr = math_expr + pp.Optional(within_kw + within_label)
   alias_expr = within_expr + pp.Optional((
       (as_kw + alias_label) |
@@ -365,14 +389,14 @@ def _EBQParser(clauses):
       from_kw + (flatten_expr | push_label)).setParseAction(AddArgument))
   join_expr = from_expr + pp.ZeroOrMore((
       join_kw + push_label + join_on_kw +
-      _MathParser(temp_stack)).setParseAction(AddJoinArgument))
+      math_expr).setParseAction(AddJoinArgument))
   where_expr = join_expr + pp.Optional((
-      where_kw + _MathParser(temp_stack)).setParseAction(AddArgument))
+      where_kw + math_expr).setParseAction(AddArgument))
   group_expr = where_expr + pp.Optional((
       group_kw + push_label + pp.ZeroOrMore(
           pp.Literal(',') + push_label)).setParseAction(AddArgument))
   having_expr = group_expr + pp.Optional((
-      having_kw + _MathParser(temp_stack)).setParseAction(AddArgument))
+      having_kw + math_expr).setParseAction(AddArgument))
   order_expr = having_expr + pp.Optional((
       order_kw + order_label + pp.ZeroOrMore(
           pp.Literal(',') + order_label)).setParseAction(AddArgument))
@@ -383,6 +407,25 @@ def _EBQParser(clauses):
   return entire_expr
 
 
+# The grammars are built on first use; parses are serialized by the lock, as
+# they share the state and the packrat cache.
+_parse_lock = threading.Lock()
+_parse_state = _ParseState()
+_ebq_grammar = None
+_math_grammar = None
+
+
+def _ParseMath(expression):
+  """Returns the postfix notation of a single math expression."""
+  global _math_grammar
+  with _parse_lock:
+    if _math_grammar is None:
+      _math_grammar = _MathParser(_parse_state)
+    _parse_state.Reset(None)
+    _math_grammar.parseString(expression)
+    return _parse_state.temp_stack
+
+
 def ParseQuery(query):
   """Parses the entire query.
 
@@ -395,6 +438,7 @@ def ParseQuery(query):
   Raises:
     bigquery_client.BigqueryInvalidQueryError: When invalid query is given.
   """
+  global _ebq_grammar
   clause_arguments = {
       'SELECT': [],
       'AS': {},
@@ -407,8 +451,14 @@ def ParseQuery(query):
       'ORDER BY': [],
       'LIMIT': [],
   }
-  try:
-    _EBQParser(clause_arguments).parseString(query)
-  except ValueError as e:
-    raise bigquery_client.BigqueryInvalidQueryError(e, None, None, None)
+  with _parse_lock:
+    if _ebq_grammar is None:
+      _ebq_grammar = _EBQParser(_parse_state)
+    _parse_state.Reset(clause_arguments)
+    try:
+      _ebq_grammar.parseString(query)
+    except ValueError as e:
+      raise bigquery_client.BigqueryInvalidQueryError(e, None, None, None)
+    finally:
+      _parse_state.Reset(None)
   return clause_arguments
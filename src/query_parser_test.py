@@ -7,6 +7,8 @@
 
 
 
+import time
+
 from pyparsing import ParseException
 
 import logging
@@ -14,14 +16,28 @@ from google.apputils import basetest as googletest
 import query_parser as parser
 
 
+# Queries of the tests below, parsed by testParseQueryBenchmark.
+_BENCHMARK_QUERIES = [
+    'SELECT 1 + 4 / 2 * 3 - 5',
+    'Select a, 1 + 1, cos(1), "hello"',
+    """select a, b, c, d from table where a < b
+         group by d, c, b, a
+         having c == d
+         order by a, b, c, d limit 4""",
+    'select a, b, c, d order by a Asc, b, c deSC, d Desc',
+    """Select 1 as a, 2, 3 as b, 4, 5, 6 as c from table where a
+         contains b order by a, b, c""",
+    'SELECT COUNT(*) as a, a * 2 from table',
+    'SELECT a from (FLATTEN(table1, field1))',
+    ('SELECT a, SUM(a.b) within a, COUNT(c.d.h) within c.d as e, '
+     'f as g from table'),
+]
 
 
 class QueryParserTest(googletest.TestCase):
 
   def _RunMathQuery(self, expression, stack):
-    test_stack = []
-    parser._MathParser(test_stack).parseString(expression)
-    self.assertEqual(stack, test_stack)
+    self.assertEqual(stack, parser._ParseMath(expression))
 
   def testNumber(self):
     logging.debug('Running testNumber method.')
@@ -356,6 +372,23 @@ class QueryParserTest(googletest.TestCase):
                    as_arg={2: 'e', 3: 'g'},
                    within_arg={1: 'a', 2: 'c.d'})
 
+  def testParseQueryBenchmark(self):
+    logging.debug('Running testParseQueryBenchmark method.')
+    parser.ParseQuery(_BENCHMARK_QUERIES[0])  # builds the grammar.
+    num_rounds = 5
+    start = time.time()
+    for _ in xrange(num_rounds):
+      for query in _BENCHMARK_QUERIES:
+        parser.ParseQuery(query)
+    parse_seconds = (time.time() - start) / (
+        num_rounds * len(_BENCHMARK_QUERIES))
+    start = time.time()
+    parser._EBQParser(parser._ParseState())
+    build_seconds = time.time() - start
+    logging.info('ParseQuery: %.2fms per query, building the grammar once '
+                 'saves %.2fms per query.', 1000 * parse_seconds,
+                 1000 * build_seconds)
+
   def _CheckParseFail(self, command):
     self.assertRaises(ParseException, parser.ParseQuery, command)
 
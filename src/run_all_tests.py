@@ -25,11 +25,13 @@ _EBQ_TESTS = [
     'ebq_crypto_test',
     'encrypted_bigquery_client_test',
     'load_lib_test',
+    'metadata_cache_test',
     'number_test',
     'paillier_test',
     'query_interpreter_test',
     'query_parser_test',
     'show_lib_test',
+    'unicode_punctuation_test',
 ]
 
 
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Unit tests for the unicode punctuation table."""
+
+
+
+import sys
+import unicodedata
+
+from google.apputils import app
+from google.apputils import basetest as googletest
+
+import unicode_punctuation
+
+
+class UnicodePunctuationTest(googletest.TestCase):
+
+  def testPunctuationRangesMatchUnicodedata(self):
+    # Regenerate the table if this fails after a unicodedata upgrade.
+    self.assertEqual(unicode_punctuation.UNIDATA_VERSION,
+                     unicodedata.unidata_version)
+    expected = unicode_punctuation.ComputePunctuationRanges()
+    ranges = [(first, last)
+              for first, last in unicode_punctuation.PUNCTUATION_RANGES
+              if first < sys.maxunicode]
+    self.assertEqual(list(expected), ranges)
+
+  def testPunctuationRangesAreSortedAndDisjoint(self):
+    previous_last = -2
+    for first, last in unicode_punctuation.PUNCTUATION_RANGES:
+      self.assertTrue(previous_last + 1 < first <= last)
+      previous_last = last
+
+
+def main(_):
+  googletest.main()
+
+if __name__ == '__main__':
+  app.run()